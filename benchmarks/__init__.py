@@ -0,0 +1,4 @@
+"""
+The House reloaded
+Benchmarks
+"""
@@ -0,0 +1,98 @@
+"""
+The House reloaded
+Deterministic synthetic board for benchmarks
+"""
+
+from dataclasses import asdict, dataclass
+
+from thehouse.models import Post, Thread, User
+from thehouse.search import rebuild_search_index
+from thehouse.seeding import seed_board
+
+INDEX_CHUNK_SIZE = 1000
+
+
+@dataclass
+class DatasetSize:
+    """Shape of a synthetic board"""
+
+    users: int = 100
+    categories: int = 5
+    threads: int = 200
+    posts: int = 2000
+    reply_depth: int = 3
+    deleted_ratio: float = 0.02
+    seed: int = 1
+
+    def as_dict(self) -> dict:
+        """Serialize for benchmark results"""
+        return asdict(self)
+
+
+def add_dataset_arguments(parser):
+    """Add a command line option for every DatasetSize field"""
+    for field, value in DatasetSize().as_dict().items():
+        parser.add_argument(
+            "--" + field.replace("_", "-"),
+            type=type(value),
+            default=value,
+            help=f"dataset {field.replace('_', ' ')} (default: {value})",
+        )
+
+
+def dataset_size(arguments) -> DatasetSize:
+    """DatasetSize from the options added by add_dataset_arguments()"""
+    return DatasetSize(
+        **{field: getattr(arguments, field) for field in DatasetSize().as_dict()}
+    )
+
+
+def build_dataset(db, size: DatasetSize) -> dict:
+    """Fill an empty database with a synthetic board, see thehouse.seeding
+
+    Returns the ids of a typical thread, its category and first post, and of
+    the busiest user so that benchmarks can target them.
+    """
+    seed_board(
+        size.users,
+        size.categories,
+        size.threads,
+        size.posts,
+        reply_depth=size.reply_depth,
+        deleted_ratio=size.deleted_ratio,
+        seed=size.seed,
+    )
+    # Seeded rows bypass the ORM hooks that index them
+    rebuild_search_index(INDEX_CHUNK_SIZE)
+
+    # A thread of median size, view_thread() renders every post of a thread
+    # and the busiest ones would measure the size of the dataset instead
+    post_count = db.func.count(Post.id)
+    live_threads = db.session.execute(
+        db.select(Thread.id, Thread.cat_id)
+        .outerjoin(Post, Post.thread_id == Thread.id)
+        .where(Thread.deleted.is_(False))
+        .group_by(Thread.id, Thread.cat_id)
+        .order_by(post_count, Thread.id)
+    ).all()
+    thread_id, cat_id = live_threads[len(live_threads) // 2]
+
+    busiest_user = db.session.execute(
+        db.select(User.id)
+        .join(Post, Post.author == User.id)
+        .where(User.deleted.is_(False))
+        .group_by(User.id)
+        .order_by(db.func.count(Post.id).desc(), User.id)
+        .limit(1)
+    ).scalar()
+
+    return {
+        "thread": thread_id,
+        "category": cat_id,
+        "user": busiest_user,
+        "post": db.session.execute(
+            db.select(db.func.min(Post.id)).where(
+                Post.thread_id == thread_id, Post.deleted.is_(False)
+            )
+        ).scalar(),
+    }
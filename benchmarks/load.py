@@ -0,0 +1,333 @@
+"""
+The House reloaded
+Mixed-workload load test against a local gunicorn server
+
+    uv run python -m benchmarks.load --readers 8 --posters 2 --pollers 2
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlencode
+
+from thehouse import create_app
+from thehouse.models import Category, Thread, User
+
+from .dataset import add_dataset_arguments, build_dataset, dataset_size
+from .routes import make_config, percentile
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LOCKED_MESSAGE = "database is locked"
+
+
+class Recorder:
+    """Latencies and statuses per endpoint, shared by the client threads"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self._lock = threading.Lock()
+
+    def record(self, endpoint: str, milliseconds: float, status: str):
+        """Record a finished request"""
+        with self._lock:
+            self.latencies[endpoint].append(milliseconds)
+            self.statuses[endpoint][status] += 1
+
+
+class Client:
+    """Keep-alive HTTP client of a single simulated user"""
+
+    def __init__(self, port: int, recorder: Recorder, token: str):
+        self.port = port
+        self.recorder = recorder
+        self.token = token
+        self.connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+
+    def request(self, endpoint: str, method: str, path: str, form: dict = None):
+        """Send a request and record how it went"""
+        headers = {"Authorization": self.token}
+        body = None
+
+        if form is not None:
+            body = urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+
+        started = time.perf_counter()
+
+        try:
+            self.connection.request(method, path, body=body, headers=headers)
+            response = self.connection.getresponse()
+            response.read()
+            status = str(response.status)
+        except (OSError, http.client.HTTPException) as error:
+            status = type(error).__name__
+            self.connection.close()
+            self.connection = http.client.HTTPConnection(
+                "127.0.0.1", self.port, timeout=60
+            )
+
+        self.recorder.record(endpoint, (time.perf_counter() - started) * 1000, status)
+
+
+def reader(client: Client, board: dict, rng: random.Random):
+    """Browse the web interface"""
+    choice = rng.random()
+
+    if choice < 0.1:
+        client.request("main.index", "GET", "/")
+    elif choice < 0.3:
+        client.request(
+            "main.view_category", "GET", f"/{rng.choice(board['categories'])}/"
+        )
+    elif choice < 0.9:
+        cat_title, thread_id = rng.choice(board["threads"])
+        client.request("main.view_thread", "GET", f"/{cat_title}/{thread_id}/")
+    else:
+        client.request("main.view_user", "GET", f"/~{rng.choice(board['usernames'])}")
+
+
+def poster(client: Client, board: dict, rng: random.Random):
+    """Reply to threads, sometimes start one"""
+    cat_id, thread_id = rng.choice(board["thread_ids"])
+
+    if rng.random() < 0.1:
+        client.request(
+            "api.create_thread",
+            "POST",
+            "/api/threads/",
+            {"cat_id": cat_id, "title": "load test", "content": "load test thread"},
+        )
+    else:
+        client.request(
+            "api.create_post",
+            "POST",
+            "/api/posts/",
+            {"cat_id": cat_id, "thread_id": thread_id, "content": "load test reply"},
+        )
+
+
+def poller(client: Client, board: dict, rng: random.Random):
+    """Poll a thread and the inbox like an API client would"""
+    if rng.random() < 0.5:
+        _, thread_id = rng.choice(board["thread_ids"])
+        client.request("api.get_thread", "GET", f"/api/threads/{thread_id}/")
+    else:
+        client.request("api.inbox", "GET", "/api/inbox/")
+
+
+def seed(work_directory: str, arguments) -> dict:
+    """Build the board and collect what the clients need to browse it"""
+    app, db = create_app(make_config(work_directory))
+
+    with app.app_context():
+        db.create_all()
+        build_dataset(db, dataset_size(arguments))
+
+        titles = {
+            category.id: category.title
+            for category in Category.query.filter_by(deleted=False)
+        }
+        threads = [
+            (thread.cat_id, thread.id)
+            for thread in Thread.query.filter_by(deleted=False)
+            if thread.cat_id in titles
+        ]
+        users = User.query.filter_by(deleted=False).all()
+
+        board = {
+            "categories": list(titles.values()),
+            "threads": [(titles[cat_id], thread_id) for cat_id, thread_id in threads],
+            "thread_ids": threads,
+            "usernames": [user.username for user in users],
+            "tokens": [user.token for user in users],
+        }
+
+        db.engine.dispose()
+
+    return board
+
+
+def start_server(work_directory: str, port: int, arguments, log) -> subprocess.Popen:
+    """Start gunicorn on the seeded database and wait until it answers"""
+    config = make_config(work_directory)
+    environment = {
+        **os.environ,
+        "THR_SECRET_KEY": config.SECRET_KEY,
+        "THR_DATABASE_URI": config.SQLALCHEMY_DATABASE_URI,
+        "THR_UPLOADS_DIRECTORY": config.UPLOADS_DIRECTORY,
+        "THR_CATEGORY_REGISTRY_STAMP": config.CATEGORY_REGISTRY_STAMP,
+        "THR_GUNICORN_BIND": f"127.0.0.1:{port}",
+        "THR_GUNICORN_WORKERS": str(arguments.workers),
+        "THR_GUNICORN_THREADS": str(arguments.threads_per_worker),
+    }
+
+    if arguments.worker_class:
+        environment["THR_GUNICORN_WORKER_CLASS"] = arguments.worker_class
+
+    server = subprocess.Popen(  # pylint: disable=consider-using-with
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app"],
+        cwd=ROOT_DIRECTORY,
+        env=environment,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+
+    deadline = time.monotonic() + 30
+
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            with open(log.name, encoding="utf-8") as output:
+                raise RuntimeError("gunicorn exited:\n" + output.read())
+
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return server
+        except OSError:
+            time.sleep(0.2)
+
+    server.terminate()
+    raise RuntimeError("gunicorn did not start in time")
+
+
+def free_port() -> int:
+    """Pick an unused TCP port"""
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def report(recorder: Recorder, duration: float, locked_errors: int) -> dict:
+    """Summarize the run per endpoint"""
+    endpoints = {}
+
+    for endpoint, latencies in sorted(recorder.latencies.items()):
+        statuses = dict(recorder.statuses[endpoint])
+        errors = sum(
+            count
+            for status, count in statuses.items()
+            if not status.isdigit() or int(status) >= 500
+        )
+        endpoints[endpoint] = {
+            "requests": len(latencies),
+            "throughput": round(len(latencies) / duration, 2),
+            "p50_ms": round(percentile(latencies, 50), 3),
+            "p95_ms": round(percentile(latencies, 95), 3),
+            "p99_ms": round(percentile(latencies, 99), 3),
+            "mean_ms": round(statistics.fmean(latencies), 3),
+            "error_rate": round(errors / len(latencies), 4),
+            "statuses": statuses,
+        }
+
+    total = sum(endpoint["requests"] for endpoint in endpoints.values())
+
+    return {
+        "duration": round(duration, 2),
+        "requests": total,
+        "throughput": round(total / duration, 2),
+        "database_locked_errors": locked_errors,
+        "endpoints": endpoints,
+    }
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    add_dataset_arguments(parser)
+    parser.add_argument("--readers", type=int, default=8, help="concurrent readers")
+    parser.add_argument("--posters", type=int, default=2, help="concurrent posters")
+    parser.add_argument("--pollers", type=int, default=2, help="concurrent API pollers")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument(
+        "--threads-per-worker", type=int, default=4, help="gunicorn threads"
+    )
+    parser.add_argument("--worker-class", help="gunicorn worker class")
+    parser.add_argument("--output", help="write the report to this JSON file")
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_directory:
+        print("Seeding the board...")
+        board = seed(work_directory, arguments)
+        port = free_port()
+        log_path = os.path.join(work_directory, "gunicorn.log")
+
+        with open(log_path, "w", encoding="utf-8") as log:
+            server = start_server(work_directory, port, arguments, log)
+
+        try:
+            recorder = Recorder()
+            stop = threading.Event()
+            rng = random.Random(arguments.seed)
+
+            def simulate(behaviour, client_seed: int):
+                client_rng = random.Random(client_seed)
+                client = Client(port, recorder, client_rng.choice(board["tokens"]))
+
+                while not stop.is_set():
+                    behaviour(client, board, client_rng)
+
+            clients = [
+                threading.Thread(
+                    target=simulate, args=(behaviour, rng.getrandbits(32)), daemon=True
+                )
+                for behaviour, count in (
+                    (reader, arguments.readers),
+                    (poster, arguments.posters),
+                    (poller, arguments.pollers),
+                )
+                for _ in range(count)
+            ]
+
+            print(f"Running {len(clients)} clients for {arguments.duration} seconds...")
+            started = time.perf_counter()
+
+            for client in clients:
+                client.start()
+
+            time.sleep(arguments.duration)
+            stop.set()
+
+            for client in clients:
+                client.join()
+
+            duration = time.perf_counter() - started
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait(timeout=60)
+
+        with open(log_path, encoding="utf-8") as log:
+            locked_errors = log.read().count(LOCKED_MESSAGE)
+
+    results = report(recorder, duration, locked_errors)
+
+    for endpoint, stats in results["endpoints"].items():
+        print(
+            f"{endpoint:20} {stats['throughput']:8.2f} req/s"
+            f"  p50 {stats['p50_ms']:9.2f}  p95 {stats['p95_ms']:9.2f}"
+            f"  p99 {stats['p99_ms']:9.2f} ms  errors {stats['error_rate']:.2%}"
+        )
+
+    print(
+        f"Total: {results['throughput']} req/s,"
+        f" {results['database_locked_errors']} '{LOCKED_MESSAGE}' errors logged"
+    )
+
+    if arguments.output:
+        with open(arguments.output, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+"""
+The House reloaded
+Route benchmarks through the Flask test client
+
+    uv run python -m benchmarks.routes --output results.json
+    uv run python -m benchmarks.routes --baseline results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import sqlalchemy
+from flask import has_request_context, url_for
+from sqlalchemy import event
+
+from thehouse import create_app
+from thehouse.config import Config
+from thehouse.models import Category, User
+
+from .dataset import (
+    DatasetSize,
+    add_dataset_arguments,
+    build_dataset,
+    dataset_size,
+)
+
+MAIN_ENDPOINTS = [
+    "main.index",
+    "main.view_category",
+    "main.view_thread",
+    "main.view_user",
+    "main.inbox",
+    "main.search",
+]
+# Query strings of the endpoints that need one, the search words are part
+# of the seeded texts
+QUERY_ARGUMENTS = {
+    "main.search": {"q": "python flask"},
+    "api.search": {"q": "python flask"},
+}
+SKIPPED_ENDPOINTS = [
+    "api.get_memory",  # instrumentation, not a board route
+    "api.events",  # a stream, lasts THR_EVENTS_STREAM_SECONDS
+]
+
+
+def make_config(work_directory: str):
+    """App config isolated from the environment of the machine"""
+
+    class BenchmarkConfig(Config):  # pylint: disable=too-few-public-methods
+        """Benchmark app config"""
+
+        SECRET_KEY = "benchmark"
+        SQLALCHEMY_DATABASE_URI = "sqlite:///" + os.path.join(
+            work_directory, "benchmark.db"
+        )
+        DATABASE_REPLICA_URI = None
+        UPLOADS_DIRECTORY = os.path.join(work_directory, "uploads")
+        UPLOADS_OFFLOAD = None
+        CATEGORY_REGISTRY_STAMP = os.path.join(work_directory, "category.stamp")
+        JOB_WORKER_THREADS = 0
+        METRICS_ENABLED = False
+        QUERY_BUDGET = 0
+        PROFILING_ENABLED = False
+        WTF_CSRF_ENABLED = False
+
+    return BenchmarkConfig
+
+
+def percentile(samples: list, percent: int) -> float:
+    """Percentile of a list of samples (inclusive method)"""
+    if len(samples) == 1:
+        return samples[0]
+
+    return statistics.quantiles(samples, n=100, method="inclusive")[percent - 1]
+
+
+def benchmark_urls(app, targets: dict) -> dict:
+    """URL of every benchmarked endpoint, filled with the dataset targets"""
+    urls = {}
+
+    with app.test_request_context():
+        for rule in app.url_map.iter_rules():
+            if "GET" not in rule.methods or rule.endpoint in SKIPPED_ENDPOINTS:
+                continue
+
+            if rule.endpoint not in MAIN_ENDPOINTS and not rule.endpoint.startswith(
+                "api."
+            ):
+                continue
+
+            missing = rule.arguments - targets.keys()
+
+            if missing:
+                print(f"Skipping {rule.endpoint}: no value for {missing}")
+                continue
+
+            urls[rule.endpoint] = url_for(
+                rule.endpoint,
+                **{name: targets[name] for name in rule.arguments},
+                **QUERY_ARGUMENTS.get(rule.endpoint, {}),
+            )
+
+    return dict(sorted(urls.items()))
+
+
+def run(size: DatasetSize, requests: int, warmup: int) -> dict:
+    """Build the dataset and time every endpoint"""
+    with tempfile.TemporaryDirectory() as work_directory:
+        app, db = create_app(make_config(work_directory))
+        query_count = [0]
+
+        with app.app_context():
+            db.create_all()
+            ids = build_dataset(db, size)
+
+            user = db.session.get(User, ids["user"])
+            category = db.session.get(Category, ids["category"])
+            targets = {
+                "username": user.username,
+                "cat_title": category.title,
+                "cat_id": category.id,
+                "thread_id": ids["thread"],
+                "post_id": ids["post"],
+            }
+            token = user.token
+
+            @event.listens_for(db.engine, "after_cursor_execute")
+            def count_query(*_):
+                # Leaves out the view counts flushed by the job thread
+                if has_request_context():
+                    query_count[0] += 1
+
+        client = app.test_client()
+
+        with client.session_transaction() as session:
+            session["_user_id"] = ids["user"]
+            session["_fresh"] = True
+
+        routes = {}
+
+        for endpoint, url in benchmark_urls(app, targets).items():
+            timings = []
+            queries = []
+            statuses = {}
+
+            for index in range(warmup + requests):
+                query_count[0] = 0
+                started = time.perf_counter()
+                response = client.get(url, headers={"Authorization": token})
+                elapsed = (time.perf_counter() - started) * 1000
+
+                if index < warmup:
+                    continue
+
+                timings.append(elapsed)
+                queries.append(query_count[0])
+                statuses[str(response.status_code)] = (
+                    statuses.get(str(response.status_code), 0) + 1
+                )
+
+            # Once more with allocations traced, which would skew the timings
+            tracemalloc.start()
+            client.get(url, headers={"Authorization": token})
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            routes[endpoint] = {
+                "url": url,
+                "mean_ms": round(statistics.fmean(timings), 3),
+                "p50_ms": round(percentile(timings, 50), 3),
+                "p90_ms": round(percentile(timings, 90), 3),
+                "p95_ms": round(percentile(timings, 95), 3),
+                "p99_ms": round(percentile(timings, 99), 3),
+                "queries": int(statistics.median(queries)),
+                "peak_kib": round(peak / 1024, 1),
+                "statuses": statuses,
+            }
+            print(
+                f"{endpoint:32} p50 {routes[endpoint]['p50_ms']:9.2f} ms"
+                f"  p95 {routes[endpoint]['p95_ms']:9.2f} ms"
+                f"  {routes[endpoint]['queries']:6} queries"
+                f"  {routes[endpoint]['peak_kib']:9.1f} KiB"
+            )
+
+        with app.app_context():
+            db.engine.dispose()
+
+    return {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlalchemy": sqlalchemy.__version__,
+        "dataset": size.as_dict(),
+        "requests": requests,
+        "routes": routes,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Describe every route slower, running more queries or needing more memory
+    than in the baseline
+    """
+    regressions = []
+
+    if baseline.get("dataset") != results["dataset"]:
+        print("Warning: the baseline was recorded on a different dataset")
+
+    for endpoint, route in results["routes"].items():
+        before = baseline.get("routes", {}).get(endpoint)
+
+        if before is None:
+            continue
+
+        if route["p50_ms"] > before["p50_ms"] * (1 + tolerance):
+            regressions.append(
+                f"{endpoint}: p50 {before['p50_ms']} ms -> {route['p50_ms']} ms"
+            )
+
+        if route["queries"] > before["queries"]:
+            regressions.append(
+                f"{endpoint}: {before['queries']} -> {route['queries']} queries"
+            )
+
+        # Older baselines have no memory peaks
+        if "peak_kib" in before and route["peak_kib"] > before["peak_kib"] * (
+            1 + tolerance
+        ):
+            regressions.append(
+                f"{endpoint}: peak {before['peak_kib']} KiB -> {route['peak_kib']} KiB"
+            )
+
+    return regressions
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    add_dataset_arguments(parser)
+
+    parser.add_argument(
+        "--requests", type=int, default=20, help="timed requests per route"
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=3, help="untimed requests per route"
+    )
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results to compare with")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="allowed p50 slowdown relative to the baseline (default: 0.25)",
+    )
+    arguments = parser.parse_args()
+
+    results = run(dataset_size(arguments), arguments.requests, arguments.warmup)
+
+    if arguments.output:
+        with open(arguments.output, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2)
+
+    if arguments.baseline:
+        with open(arguments.baseline, encoding="utf-8") as baseline:
+            regressions = compare(results, json.load(baseline), arguments.tolerance)
+
+        for regression in regressions:
+            print("Regression:", regression)
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
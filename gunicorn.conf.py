@@ -0,0 +1,83 @@
+"""
+The House reloaded
+Gunicorn configuration, see the THR_GUNICORN_* variables in README.md
+"""
+
+import gc
+import glob
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+bind = os.getenv("THR_GUNICORN_BIND") or "127.0.0.1:8000"
+workers = int(os.getenv("THR_GUNICORN_WORKERS") or multiprocessing.cpu_count() * 2 + 1)
+threads = int(os.getenv("THR_GUNICORN_THREADS") or 1)
+worker_class = os.getenv("THR_GUNICORN_WORKER_CLASS") or (
+    "gthread" if threads > 1 else "sync"
+)
+preload_app = os.getenv("THR_GUNICORN_PRELOAD") != "no"
+max_requests = int(os.getenv("THR_GUNICORN_MAX_REQUESTS") or 1000)
+max_requests_jitter = int(os.getenv("THR_GUNICORN_MAX_REQUESTS_JITTER") or 100)
+timeout = int(os.getenv("THR_GUNICORN_TIMEOUT") or 30)
+graceful_timeout = int(os.getenv("THR_GUNICORN_GRACEFUL_TIMEOUT") or 30)
+keepalive = int(os.getenv("THR_GUNICORN_KEEPALIVE") or 5)
+
+if os.getenv("THR_METRICS") == "yes" and not os.getenv("THR_METRICS_DIRECTORY"):
+    # Where workers share their counters, read by the app config
+    os.environ["THR_METRICS_DIRECTORY"] = TEMPORARY_METRICS_DIRECTORY = (
+        tempfile.mkdtemp(prefix="thehouse-metrics-")
+    )
+else:
+    TEMPORARY_METRICS_DIRECTORY = None
+
+if worker_class == "gevent":
+    # Must happen before the app (and its locks and sockets) is preloaded
+    from gevent import monkey  # pylint: disable=import-outside-toplevel
+
+    monkey.patch_all()
+
+
+def when_ready(server):  # pylint: disable=unused-argument
+    """Freeze the preloaded app so that workers share its memory pages"""
+    if preload_app:
+        # Keeps the collector from touching (and copying) the objects of the
+        # master in every worker
+        gc.collect()
+        gc.freeze()
+
+
+def on_starting(server):  # pylint: disable=unused-argument
+    """Start counting from zero, stale counters of a previous run would be added"""
+    if os.getenv("THR_METRICS_DIRECTORY"):
+        for path in glob.glob(
+            os.path.join(os.environ["THR_METRICS_DIRECTORY"], "*.json")
+        ):
+            os.remove(path)
+
+
+def worker_exit(server, worker):  # pylint: disable=unused-argument
+    """Save the last counters of a worker before it exits"""
+    if os.getenv("THR_METRICS_DIRECTORY"):
+        from thehouse.metrics import metrics  # pylint: disable=import-outside-toplevel
+
+        metrics.save()
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """Fold the counters of an exited worker into those of the retired ones"""
+    if os.getenv("THR_METRICS_DIRECTORY"):
+        # pylint: disable-next=import-outside-toplevel
+        from thehouse.metrics import retire_worker_metrics
+
+        retire_worker_metrics(os.environ["THR_METRICS_DIRECTORY"], worker.pid)
+
+
+def on_exit(server):  # pylint: disable=unused-argument
+    """Remove the metrics directory created for this run"""
+    if TEMPORARY_METRICS_DIRECTORY:
+        shutil.rmtree(TEMPORARY_METRICS_DIRECTORY, ignore_errors=True)
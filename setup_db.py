@@ -4,6 +4,17 @@ Database setup script
 """
 
 from app import app, db
+from thehouse.migrations import add_missing_columns
 
 with app.app_context():
     db.create_all()
+
+    # create_all() skips existing tables, add columns introduced since
+    with db.engine.begin() as connection:
+        for column in add_missing_columns(connection):
+            print("Added column", column)
+
+    # create_all() skips existing tables, add indexes introduced since
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
@@ -8,7 +8,27 @@ from flask import Flask
 
 from .api_routes import api
 from .before_request_callbacks import logout_if_deleted, set_default_theme
+from .commands import (
+    archive_database,
+    backfill_paths,
+    collect_uploads,
+    compress_content,
+    export_database,
+    import_database,
+    reindex_search,
+    run_jobs,
+    seed_database,
+    shard_uploads,
+)
+from .compression import init_compression
 from .config import Config
+from .database import (
+    apply_sqlite_pragmas,
+    configure_engine_options,
+    pin_to_primary_after_write,
+    reset_engines_after_fork,
+    use_replica_for_reads,
+)
 from .error_handlers import (
     api_handle_method_not_allowed,
     api_handle_server_error,
@@ -16,10 +36,17 @@ from .error_handlers import (
     main_handle_method_not_allowed,
     main_handle_server_error,
 )
-from .extensions import bcrypt, db, ma
+from .events import init_events
+from .extensions import bcrypt, category_registry, db, ma
+from .jobs import start_job_threads
+from .loaders import inject_loader
+from .memory import record_request_peak, start_request_peak
+from .metrics import init_metrics
+from .profiling import init_profiling
 from .routes import main
+from .search import init_search
 from .user_callbacks import login_manager
-from .utils import generate_file_embed, render_content
+from .utils import generate_file_embed, render_content, thumbnail_url
 
 
 def register_blueprints(app):
@@ -36,6 +63,20 @@ def register_blueprints(app):
     app.register_blueprint(api)
 
 
+def register_commands(app):
+    """Register CLI commands to app"""
+    app.cli.add_command(shard_uploads)
+    app.cli.add_command(run_jobs)
+    app.cli.add_command(seed_database)
+    app.cli.add_command(reindex_search)
+    app.cli.add_command(export_database)
+    app.cli.add_command(import_database)
+    app.cli.add_command(archive_database)
+    app.cli.add_command(collect_uploads)
+    app.cli.add_command(backfill_paths)
+    app.cli.add_command(compress_content)
+
+
 def create_app(config_class=Config):  # pylint: disable=unused-argument
     """App init function"""
     app = Flask(__name__, static_folder=os.path.join(os.path.pardir, "static"))
@@ -49,15 +90,39 @@ def create_app(config_class=Config):  # pylint: disable=unused-argument
         )
 
     login_manager.init_app(app)
+    configure_engine_options(app)
     db.init_app(app)
+
+    with app.app_context():
+        for engine in db.engines.values():
+            apply_sqlite_pragmas(app, engine)
+
+    reset_engines_after_fork(app, db)
+    init_metrics(app, db)
+    init_profiling(app)
+    init_compression(app)
+    init_search(app)
+    init_events(app)
+
     bcrypt.init_app(app)
     ma.init_app(app)
+    category_registry.init_app(app)
 
     register_blueprints(app)
+    register_commands(app)
     app.errorhandler(404)(handle_page_not_found)
+    app.before_request(start_request_peak)
+    app.before_request(use_replica_for_reads)
     app.before_request(logout_if_deleted)
+    app.before_request(start_job_threads)
+    app.after_request(pin_to_primary_after_write)
+    app.after_request(record_request_peak)
+
+    app.context_processor(inject_loader)
 
     app.jinja_env.filters["render_content"] = render_content
-    app.jinja_env.globals.update(embed_file=generate_file_embed)
+    app.jinja_env.globals.update(
+        embed_file=generate_file_embed, thumbnail_url=thumbnail_url
+    )
 
     return app, db
@@ -3,21 +3,38 @@ The House reloaded
 API Routes
 """
 
-from flask import Blueprint, current_app, request
-
-from .extensions import db
-from .models import Category, Post, Thread, User
+from datetime import timedelta
+
+from flask import Blueprint, Response, current_app, g, request, stream_with_context
+
+from .events import event_stream
+from .extensions import category_registry, db
+from .jobs import count_view
+from .memory import memory_status, start_tracing, stop_tracing, take_snapshot
+from .models import (
+    Category,
+    Post,
+    Thread,
+    User,
+    add_post,
+    delete_posts,
+    delete_threads,
+    enqueue_job,
+    utcnow,
+)
 from .schemas import CategorySchema, PostSchema, ThreadSchema, UserSchema
+from .search import search_page
 from .utils import (
-    delete_upload,
     form_response,
-    generate_uploads_filename,
     get_inbox,
     save_to_uploads,
 )
 
 api = Blueprint("api", __name__, url_prefix="/api")
 
+MAX_EVENT_THREADS = 100
+SYNC_WORKER_RETRY = 60  # seconds
+
 
 def authorize(payload):
     """Authorize an API User"""
@@ -31,6 +48,45 @@ def authorize(payload):
     return None
 
 
+@api.before_request
+def use_primary_while_pinned():
+    """Read from the primary while the client's writes may not be replicated yet
+
+    API clients keep no session cookie, so they are pinned through the user
+    their token belongs to.
+    """
+
+    token = request.headers.get("Authorization")
+
+    if g.get("use_replica") and token:
+        primary_until = db.session.execute(
+            db.select(User.primary_until).where(User.token == token),
+            bind_arguments={"bind": db.engine},
+        ).scalar()
+
+        g.use_replica = primary_until is None or primary_until < utcnow()
+
+
+@api.after_request
+def pin_to_primary_after_api_write(response):
+    """Keep an API client on the primary while the replica catches up on its writes"""
+
+    token = request.headers.get("Authorization")
+
+    if current_app.config["DATABASE_REPLICA_URI"] and g.get("db_wrote") and token:
+        pin = timedelta(seconds=current_app.config["DATABASE_REPLICA_PIN"])
+
+        # On its own connection, the request's session may be done already
+        with db.engine.begin() as connection:
+            connection.execute(
+                db.update(User)
+                .where(User.token == token)
+                .values(primary_until=utcnow() + pin)
+            )
+
+    return response
+
+
 @api.get("/")
 def index():
     """API status message"""
@@ -145,14 +201,11 @@ def update_user(username: str):
                     picture = request.files["picture"]
 
                     if current_user.picture_filename:
-                        delete_upload(current_user.picture_filename)
-
-                    profile_picture_filename = generate_uploads_filename(picture)
-
-                    current_user.picture_filename = profile_picture_filename
+                        enqueue_job(
+                            "delete_upload", filename=current_user.picture_filename
+                        )
 
-                    if len(current_user.picture_filename) > 0:
-                        save_to_uploads(picture, current_user.picture_filename)
+                    current_user.picture_filename = save_to_uploads(picture)
 
                     altered = True
                 else:
@@ -175,21 +228,12 @@ def delete_user(username: str):
 
     current_user = authorize(request)
     user = User.query.filter_by(username=username).first()
-    threads = Thread.query.filter_by(creator=user.id).all()
-    posts = Post.query.filter_by(author=user.id).all()
 
     if user:
         if not user.deleted:
             if current_user.role == "admin" or current_user.id == user.id:
-                for post in posts:  # pylint: disable=duplicate-code
-                    if not post.deleted:  # pylint: disable=duplicate-code
-                        post.delete()  # pylint: disable=duplicate-code
-                        db.session.add(post)  # pylint: disable=duplicate-code
-
-                for thread in threads:  # pylint: disable=duplicate-code
-                    if not thread.deleted:  # pylint: disable=duplicate-code
-                        thread.delete()  # pylint: disable=duplicate-code
-                        db.session.add(thread)  # pylint: disable=duplicate-code
+                delete_posts(Post.author == user.id)
+                delete_threads(Thread.creator == user.id)
 
                 user.delete()  # pylint: disable=duplicate-code
                 db.session.add(user)  # pylint: disable=duplicate-code
@@ -220,6 +264,7 @@ def create_category():
 
                 db.session.add(new_category)
                 db.session.commit()
+                category_registry.invalidate()
 
                 result = category_schema.dump(new_category)
 
@@ -241,6 +286,57 @@ def get_categories():
     return form_response(result)
 
 
+@api.get("/search/", strict_slashes=False)
+def search():
+    """Search threads and posts, snippets are HTML with <mark> highlights"""
+
+    query = request.args.get("q", "").strip()
+    page = request.args.get("page", 1, type=int)
+
+    if not query:
+        return form_response(error="Bad request"), 400
+
+    return form_response(search_page(query, page))
+
+
+@api.get("/events/", strict_slashes=False)
+def events():
+    """Server-Sent Events of the given threads, and of the user's inbox"""
+
+    user = authorize(request)
+    thread_ids = request.args.get("threads", "")
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get(
+        "last_event_id"
+    )
+
+    try:
+        threads = {int(thread_id) for thread_id in thread_ids.split(",") if thread_id}
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        return form_response(error="Bad request"), 400
+
+    if (not threads and user is None) or len(threads) > MAX_EVENT_THREADS:
+        return form_response(error="Bad request"), 400
+
+    # A stream would take the only thread of a sync worker until its timeout
+    # killed it, gunicorn's gthread and gevent workers are multithreaded
+    if not request.environ.get("wsgi.multithread"):
+        return Response(
+            f"retry: {SYNC_WORKER_RETRY * 1000}\n\n",
+            status=503,
+            mimetype="text/event-stream",
+            headers={"Retry-After": str(SYNC_WORKER_RETRY)},
+        )
+
+    return Response(
+        stream_with_context(
+            event_stream(threads, user.id if user else None, last_event_id)
+        ),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @api.get("/categories/<int:cat_id>/", strict_slashes=False)
 def get_category(cat_id: int):
     """Get a specific category by its id"""
@@ -280,6 +376,7 @@ def update_category(cat_id: int):
                 if updated:
                     db.session.add(category)
                     db.session.commit()
+                    category_registry.invalidate()
 
                     category_schema = CategorySchema()
 
@@ -300,26 +397,18 @@ def delete_category(cat_id: int):
 
     current_user = authorize(request)
     category = Category.query.filter_by(id=cat_id).first()
-    threads = Thread.query.filter_by(cat_id=category.id).all()
-    posts = Post.query.filter_by(cat_id=category.id).all()
 
     if category:
         if not category.deleted:
             if current_user.role == "admin":
-                for post in posts:  # pylint: disable=duplicate-code
-                    if not post.deleted:  # pylint: disable=duplicate-code
-                        post.delete()  # pylint: disable=duplicate-code
-                        db.session.add(post)  # pylint: disable=duplicate-code
-
-                for thread in threads:  # pylint: disable=duplicate-code
-                    if not thread.deleted:  # pylint: disable=duplicate-code
-                        thread.delete()  # pylint: disable=duplicate-code
-                        db.session.add(thread)  # pylint: disable=duplicate-code
+                delete_posts(Post.cat_id == category.id)
+                delete_threads(Thread.cat_id == category.id)
 
                 category.delete()  # pylint: disable=duplicate-code
                 db.session.add(category)  # pylint: disable=duplicate-code
 
                 db.session.commit()  # pylint: disable=duplicate-code
+                category_registry.invalidate()
 
                 return form_response("Category deleted successfully!")
 
@@ -341,12 +430,13 @@ def create_thread():
             content = request.form["content"].strip()
             attachment_filename = None
 
+            if category_registry.get(cat_id) is None:
+                return form_response(error="Category not found"), 404
+
             if "attachment" in request.files:
                 attachment = request.files["attachment"]
 
-                attachment_filename = generate_uploads_filename(attachment)
-
-                save_to_uploads(attachment, attachment_filename)
+                attachment_filename = save_to_uploads(attachment)
 
             new_thread = Thread(
                 cat_id=cat_id,
@@ -356,11 +446,7 @@ def create_thread():
                 attachment_filename=attachment_filename,
             )
 
-            category = Category.query.filter_by(id=cat_id).first()
-
             db.session.add(new_thread)
-            category.last_active_user = current_user.id
-            category.last_activity_date = db.func.current_timestamp()
             db.session.commit()
 
             thread_schema = ThreadSchema()
@@ -398,8 +484,7 @@ def get_thread(thread_id: int):
     if not thread:
         return form_response(error="Thread not found"), 404
 
-    thread.views += 1
-    db.session.commit()
+    count_view(thread.id)
 
     result = thread_schema.dump(thread)
 
@@ -431,14 +516,11 @@ def update_thread(thread_id: int):
                     attachment = request.files["attachment"]
 
                     if thread.attachment_filename:
-                        delete_upload(thread.attachment_filename)
-
-                    new_attachment_filename = generate_uploads_filename(attachment)
-
-                    thread.attachment_filename = new_attachment_filename
+                        enqueue_job(
+                            "delete_upload", filename=thread.attachment_filename
+                        )
 
-                    if len(thread.attachment_filename) > 0:
-                        save_to_uploads(attachment, thread.attachment_filename)
+                    thread.attachment_filename = save_to_uploads(attachment)
 
                     updated = True
 
@@ -474,9 +556,7 @@ def delete_thread(thread_id: int):
                 or (current_user.role == "moderator" and creator.role == "user")
                 or current_user.id == creator.id
             ):
-                for post in Post.query.filter_by(thread_id=thread.id).all():  # pylint: disable=duplicate-code
-                    post.delete()  # pylint: disable=duplicate-code
-                    db.session.add(post)  # pylint: disable=duplicate-code
+                delete_posts(Post.thread_id == thread.id)
 
                 thread.delete()  # pylint: disable=duplicate-code
                 db.session.add(thread)  # pylint: disable=duplicate-code
@@ -501,6 +581,9 @@ def create_post():
             thread_id = request.form["thread_id"].strip()
             content = request.form["content"].strip()
 
+            if category_registry.get(cat_id) is None:
+                return form_response(error="Category not found"), 404
+
             replying_to = None
             attachment_filename = None
 
@@ -510,9 +593,7 @@ def create_post():
             if "attachment" in request.files:
                 attachment = request.files["attachment"]
 
-                attachment_filename = generate_uploads_filename(attachment)
-
-                save_to_uploads(attachment, attachment_filename)
+                attachment_filename = save_to_uploads(attachment)
 
             new_post = Post(
                 cat_id=cat_id,
@@ -523,13 +604,9 @@ def create_post():
                 attachment_filename=attachment_filename,
             )
 
-            category = Category.query.filter_by(id=cat_id).first()
             thread = Thread.query.filter_by(id=thread_id).first()
 
-            db.session.add(new_post)  # pylint: disable=duplicate-code
-
-            category.last_active_user = current_user.id  # pylint: disable=duplicate-code
-            category.last_activity_date = db.func.current_timestamp()  # pylint: disable=duplicate-code
+            add_post(new_post)  # pylint: disable=duplicate-code
 
             thread.last_active_user = current_user.id  # pylint: disable=duplicate-code
             thread.last_activity_date = db.func.current_timestamp()  # pylint: disable=duplicate-code
@@ -597,14 +674,9 @@ def update_post(post_id: int):
                     attachment = request.files["attachment"]
 
                     if post.attachment_filename:
-                        delete_upload(post.attachment_filename)
-
-                    new_attachment_filename = generate_uploads_filename(attachment)
-
-                    post.attachment_filename = new_attachment_filename
+                        enqueue_job("delete_upload", filename=post.attachment_filename)
 
-                    if len(post.attachment_filename) > 0:
-                        save_to_uploads(attachment, post.attachment_filename)
+                    post.attachment_filename = save_to_uploads(attachment)
 
                     updated = True
 
@@ -649,3 +721,73 @@ def delete_post(post_id: int):
             return form_response(error="Unauthorized"), 401
 
     return form_response(error="Post not found"), 404
+
+
+def authorize_admin(payload):
+    """Authorize an API User that is an administrator"""
+
+    user = authorize(payload)
+
+    if user is not None and user.role == "admin":
+        return user
+
+    return None
+
+
+@api.get("/memory/", strict_slashes=False)
+def get_memory():
+    """Memory tracing status of the worker serving the request"""
+
+    if authorize_admin(request) is None:
+        return form_response(error="Unauthorized"), 401
+
+    return form_response(memory_status())
+
+
+@api.post("/memory/start/", strict_slashes=False)
+def start_memory_tracing():
+    """Start tracing allocations in the worker serving the request"""
+
+    if authorize_admin(request) is None:
+        return form_response(error="Unauthorized"), 401
+
+    frames = request.form.get("frames", "1")
+
+    if not frames.isdigit() or not 1 <= int(frames) <= 50:
+        return form_response(error="Bad request"), 400
+
+    start_tracing(int(frames))
+
+    return form_response(memory_status())
+
+
+@api.post("/memory/stop/", strict_slashes=False)
+def stop_memory_tracing():
+    """Stop tracing allocations in the worker serving the request"""
+
+    if authorize_admin(request) is None:
+        return form_response(error="Unauthorized"), 401
+
+    stop_tracing()
+
+    return form_response(memory_status())
+
+
+@api.post("/memory/snapshot/", strict_slashes=False)
+def take_memory_snapshot():
+    """Snapshot allocations and compare them to the previous snapshot"""
+
+    if authorize_admin(request) is None:
+        return form_response(error="Unauthorized"), 401
+
+    limit = request.form.get("limit", "20")
+
+    if not limit.isdigit():
+        return form_response(error="Bad request"), 400
+
+    result = take_snapshot(int(limit))
+
+    if result is None:
+        return form_response(error="Tracing is not started"), 409
+
+    return form_response(result)
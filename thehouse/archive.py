@@ -0,0 +1,204 @@
+"""
+The House reloaded
+Archival of old soft-deleted rows
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import OperationalError
+
+from .extensions import db
+from .models import Category, Post, Thread, User, utcnow
+
+ARCHIVE_BATCH_SIZE = 1000
+ARCHIVE_PREFIX = "archived_"
+
+
+def _archive_table(model) -> db.Table:
+    """Table with the columns of a model, without its constraints and indexes
+
+    Ids are not unique there, SQLite may hand the id of an archived row to a
+    new one which can be archived in turn. Columns are nullable so that
+    columns added to the model later can be added to the archive as well.
+    """
+    return db.Table(
+        ARCHIVE_PREFIX + model.__tablename__,
+        db.metadata,
+        *[db.Column(column.name, column.type) for column in model.__table__.columns],
+        db.Column("archived_date", db.DateTime, nullable=False),
+    )
+
+
+ARCHIVE_TABLES = {
+    model: _archive_table(model) for model in (User, Category, Thread, Post)
+}
+
+
+def _deleted_before(model, cutoff: datetime):
+    """Criterion of the rows of a model deleted before cutoff
+
+    Rows deleted before deleted_date existed fall back to when they were
+    created, categories have no such date and are then always old enough.
+    """
+    if model is Category:
+        return db.or_(Category.deleted_date.is_(None), Category.deleted_date < cutoff)
+
+    created = User.joined_date if model is User else model.creation_date
+
+    return db.func.coalesce(model.deleted_date, created) < cutoff
+
+
+def _archivable(model, cutoff: datetime):
+    """Criteria of the rows of a model that can be archived
+
+    Rows stay as tombstones while anything still points to them: a deleted
+    post with replies keeps its place in the reply tree, a deleted thread
+    its remaining posts, and a deleted user the author of any thread or post.
+    """
+    # NOT IN rather than NOT EXISTS, the referencing columns have no index
+    # and the subqueries are then computed once instead of once per row
+    if model is Post:
+        return [
+            _deleted_before(Post, cutoff),
+            Post.id.not_in(
+                db.select(Post.replying_to).where(Post.replying_to.is_not(None))
+            ),
+        ]
+
+    if model is Thread:
+        return [
+            _deleted_before(Thread, cutoff),
+            Thread.id.not_in(db.select(Post.thread_id)),
+        ]
+
+    if model is Category:
+        # Their threads are archived first
+        return [
+            _deleted_before(Category, cutoff),
+            Category.id.not_in(db.select(Thread.cat_id)),
+        ]
+
+    return [
+        _deleted_before(User, cutoff),
+        User.id.not_in(db.select(Thread.creator)),
+        User.id.not_in(db.select(Post.author)),
+    ]
+
+
+def archive_deleted(retention: timedelta, batch_size: int, progress=None) -> dict:
+    """Move rows soft-deleted longer than retention ago to the archived_ tables
+
+    Posts go first, leaves of the reply trees before their parents, then
+    threads, categories and users, each batch in its own transaction.
+    progress(table, rows) is called after every batch. Returns the rows
+    archived per table.
+    """
+    cutoff = utcnow() - retention
+    archived = {}
+
+    for model in (Post, Thread, Category, User):
+        table = model.__tablename__
+        archive = ARCHIVE_TABLES[model]
+        archived[table] = 0
+
+        while True:
+            row_ids = (
+                db.session.execute(
+                    db.select(model.id)
+                    .where(model.deleted.is_(True), *_archivable(model, cutoff))
+                    .limit(batch_size)
+                )
+                .scalars()
+                .all()
+            )
+
+            if not row_ids:
+                break
+
+            columns = list(model.__table__.columns)
+            db.session.execute(
+                db.insert(archive).from_select(
+                    [column.name for column in columns] + ["archived_date"],
+                    db.select(*columns, db.literal(utcnow(), db.DateTime)).where(
+                        model.id.in_(row_ids)
+                    ),
+                )
+            )
+            db.session.execute(
+                db.delete(model.__table__).where(model.__table__.c.id.in_(row_ids))
+            )
+            db.session.commit()
+
+            archived[table] += len(row_ids)
+
+            if progress is not None:
+                progress(table, archived[table])
+
+    return archived
+
+
+def table_sizes() -> dict:
+    """Bytes used by each archivable table and its indexes
+
+    Empty on SQLite builds without the dbstat virtual table.
+    """
+    sizes = {}
+
+    for model in ARCHIVE_TABLES:
+        table = model.__tablename__
+
+        if db.engine.dialect.name == "postgresql":
+            statement = db.text("SELECT pg_total_relation_size(quote_ident(:table))")
+        else:
+            statement = db.text(
+                "SELECT coalesce(sum(pgsize), 0) FROM dbstat WHERE name IN "
+                "(SELECT name FROM sqlite_master WHERE tbl_name = :table)"
+            )
+
+        try:
+            sizes[table] = db.session.execute(statement, {"table": table}).scalar()
+        except OperationalError:
+            db.session.rollback()
+            return {}
+
+    return sizes
+
+
+def database_size() -> int:
+    """Bytes used by the database"""
+    if db.engine.dialect.name == "postgresql":
+        return db.session.execute(
+            db.text("SELECT pg_database_size(current_database())")
+        ).scalar()
+
+    page_count = db.session.execute(db.text("PRAGMA page_count")).scalar()
+    page_size = db.session.execute(db.text("PRAGMA page_size")).scalar()
+
+    return page_count * page_size
+
+
+def compact_database(full: bool = False):
+    """Reclaim the space freed by archival and refresh the planner statistics
+
+    On PostgreSQL a plain VACUUM makes the space reusable without returning it
+    to the system, full rewrites the tables (locking them) to shrink them.
+    SQLite always rewrites the whole file.
+    """
+    db.session.commit()
+
+    with db.engine.connect().execution_options(
+        isolation_level="AUTOCOMMIT"
+    ) as connection:
+        if connection.dialect.name == "postgresql":
+            quote = connection.dialect.identifier_preparer.quote
+
+            for model in ARCHIVE_TABLES:
+                connection.execute(
+                    db.text(
+                        f"VACUUM ({'FULL, ' if full else ''}ANALYZE) "
+                        f"{quote(model.__tablename__)}"
+                    )
+                )
+        else:
+            connection.execute(db.text("VACUUM"))
+            connection.execute(db.text("ANALYZE"))
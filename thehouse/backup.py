@@ -0,0 +1,196 @@
+"""
+The House reloaded
+Streaming NDJSON export and import of the board
+"""
+
+import json
+import os
+from datetime import datetime
+from typing import IO
+
+from .extensions import db
+from .models import Category, Post, Thread, User, reset_id_sequences
+
+BACKUP_BATCH_SIZE = 1000
+# In dependency order, an import inserts them in the order they are exported
+BACKUP_MODELS = [User, Category, Thread, Post]
+
+
+def _datetime_columns(model) -> set:
+    """Names of the DateTime columns of a model"""
+    return {
+        column.name
+        for column in model.__table__.columns
+        if isinstance(column.type, db.DateTime)
+    }
+
+
+def _serialize(value):
+    """JSON fallback for the values of a row"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+
+    # Password hashes of users registered on SQLite are stored as bytes, they
+    # are imported as text like on PostgreSQL
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def export_board(output: IO[str], batch_size: int, progress=None) -> dict:
+    """Write every user, category, thread and post to output as NDJSON lines
+
+    Each line is {"table": ..., "row": {...}}. Rows are streamed from a
+    server-side cursor batch_size at a time, so memory does not grow with the
+    board. progress(table, rows) is called after every batch. Returns the
+    rows exported per table.
+    """
+    exported = {}
+
+    for model in BACKUP_MODELS:
+        table = model.__tablename__
+        exported[table] = 0
+
+        result = db.session.execute(
+            db.select(model.__table__).order_by(model.__table__.c.id),
+            execution_options={"yield_per": batch_size},
+        ).mappings()
+
+        for rows in result.partitions():
+            for row in rows:
+                output.write(
+                    json.dumps(
+                        {"table": table, "row": dict(row)},
+                        default=_serialize,
+                        ensure_ascii=False,
+                    )
+                    + "\n"
+                )
+
+            exported[table] += len(rows)
+
+            if progress is not None:
+                progress(table, exported[table])
+
+        result.close()
+
+    return exported
+
+
+def _read_checkpoint(checkpoint_path: str) -> int:
+    """Number of lines already imported, 0 without a checkpoint"""
+    try:
+        with open(checkpoint_path, encoding="utf-8") as checkpoint:
+            return int(checkpoint.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def _write_checkpoint(checkpoint_path: str, lines: int):
+    """Record the number of imported lines, atomically"""
+    temporary_path = f"{checkpoint_path}.tmp"
+
+    with open(temporary_path, "w", encoding="utf-8") as checkpoint:
+        checkpoint.write(str(lines))
+
+    os.replace(temporary_path, checkpoint_path)
+
+
+class _Importer:  # pylint: disable=too-few-public-methods
+    """Insert the rows of one table at a time, one transaction per batch"""
+
+    def __init__(self, checkpoint_path: str, progress, resumed: bool):
+        self.checkpoint_path = checkpoint_path
+        self.progress = progress
+        # The batch after the checkpoint may have been committed right before
+        # an interruption, its rows are checked against the database
+        self.resumed = resumed
+        self.model = None
+        self.rows = []
+        self.imported = {}
+
+    def flush(self, lines: int):
+        """Insert and commit the queued rows, then checkpoint at lines"""
+        if not self.rows:
+            return
+
+        table = self.model.__table__
+        rows = self.rows
+        self.rows = []
+
+        if self.resumed:
+            existing = set(
+                db.session.execute(
+                    db.select(table.c.id).where(
+                        table.c.id.in_([row["id"] for row in rows])
+                    )
+                ).scalars()
+            )
+            rows = [row for row in rows if row["id"] not in existing]
+            self.resumed = False
+
+        if rows:
+            db.session.execute(db.insert(table), rows)
+
+        db.session.commit()
+        _write_checkpoint(self.checkpoint_path, lines)
+
+        name = self.model.__tablename__
+        self.imported[name] = self.imported.get(name, 0) + len(rows)
+
+        if self.progress is not None:
+            self.progress(name, self.imported[name])
+
+
+def import_board(
+    source: IO[str],
+    batch_size: int,
+    checkpoint_path: str,
+    progress=None,
+) -> dict:
+    """Insert the rows of an export_board() dump into the database
+
+    Rows are committed batch_size at a time, and the number of imported lines
+    is written to checkpoint_path after every commit, so that an interrupted
+    import resumes where it stopped when run again. The checkpoint is removed
+    once the import is complete. progress(table, rows) is called after every
+    batch. Returns the rows imported per table.
+    """
+    models = {model.__tablename__: model for model in BACKUP_MODELS}
+    datetime_columns = {
+        table: _datetime_columns(model) for table, model in models.items()
+    }
+    skipped_lines = _read_checkpoint(checkpoint_path)
+    importer = _Importer(checkpoint_path, progress, resumed=skipped_lines > 0)
+    lines = 0
+
+    for lines, line in enumerate(source, start=1):
+        if lines <= skipped_lines or not line.strip():
+            continue
+
+        record = json.loads(line)
+        model = models.get(record["table"])
+
+        if model is None:
+            raise ValueError(f"Line {lines}: unknown table {record['table']!r}")
+
+        if model is not importer.model or len(importer.rows) >= batch_size:
+            importer.flush(lines - 1)
+            importer.model = model
+
+        row = record["row"]
+
+        for column in datetime_columns[record["table"]]:
+            if row.get(column) is not None:
+                row[column] = datetime.fromisoformat(row[column])
+
+        importer.rows.append(row)
+
+    importer.flush(lines)
+    reset_id_sequences()
+
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    return importer.imported
@@ -0,0 +1,123 @@
+"""
+The House reloaded
+In-process category registry
+"""
+
+import os
+from threading import Lock
+from typing import Dict, List, NamedTuple, Optional
+from uuid import uuid4
+
+
+class CachedCategory(NamedTuple):
+    """Read-only snapshot of a category row"""
+
+    id: int
+    title: str
+    description: str
+    deleted: bool
+
+
+class CategoryRegistry:
+    """Keep every category in memory, indexed by id and by title
+
+    Workers share a stamp file; whenever a category is created, updated or
+    deleted the stamp is replaced, and every worker reloads its registry on the
+    next request that notices the change.
+    """
+
+    def __init__(self, app=None):
+        self._by_id: Dict[int, CachedCategory] = {}
+        self._by_title: Dict[str, CachedCategory] = {}
+        self._stamp_path: Optional[str] = None
+        self._version = None
+        self._loaded = False
+        self._lock = Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Bind the registry to an app"""
+        self._stamp_path = app.config.get("CATEGORY_REGISTRY_STAMP") or os.path.join(
+            app.instance_path, "category-registry.stamp"
+        )
+        os.makedirs(os.path.dirname(os.path.abspath(self._stamp_path)), exist_ok=True)
+
+        app.extensions["category_registry"] = self
+        app.before_request(self.refresh_if_stale)
+
+    def _read_version(self):
+        """Identify the current stamp file, None if it was never written"""
+        try:
+            stat = os.stat(self._stamp_path)
+        except FileNotFoundError:
+            return None
+
+        return stat.st_ino, stat.st_mtime_ns
+
+    def load(self):
+        """(Re)load every category from the database"""
+        # Imported here to avoid a circular import with models -> extensions
+        from .models import Category  # pylint: disable=import-outside-toplevel
+
+        with self._lock:
+            version = self._read_version()
+
+            by_id = {}
+            by_title = {}
+
+            for category in Category.query.all():
+                cached = CachedCategory(
+                    id=category.id,
+                    title=category.title,
+                    description=category.description,
+                    deleted=category.deleted,
+                )
+                by_id[cached.id] = cached
+                by_title[cached.title] = cached
+
+            self._by_id = by_id
+            self._by_title = by_title
+            self._version = version
+            self._loaded = True
+
+    def refresh_if_stale(self):
+        """Reload the registry if another worker changed a category"""
+        if not self._loaded or self._read_version() != self._version:
+            self.load()
+
+    def invalidate(self):
+        """Signal every worker (including this one) to reload categories
+
+        Must be called after the transaction changing a category is committed.
+        """
+        temporary_path = f"{self._stamp_path}.{uuid4().hex}"
+
+        with open(temporary_path, "w", encoding="utf-8") as stamp:
+            stamp.write(uuid4().hex)
+
+        # A fresh inode every time, so that changes within the same clock tick
+        # are still noticed
+        os.replace(temporary_path, self._stamp_path)
+
+        self.load()
+
+    def get(self, cat_id) -> Optional[CachedCategory]:
+        """Get a category by its id"""
+        try:
+            return self._by_id.get(int(cat_id))
+        except (TypeError, ValueError):
+            return None
+
+    def get_by_title(self, title: str) -> Optional[CachedCategory]:
+        """Get a category by its title"""
+        return self._by_title.get(title)
+
+    def all(self, include_deleted: bool = False) -> List[CachedCategory]:
+        """List categories ordered by id"""
+        return [
+            category
+            for _, category in sorted(self._by_id.items())
+            if include_deleted or not category.deleted
+        ]
@@ -0,0 +1,410 @@
+"""
+The House reloaded
+Flask CLI commands
+"""
+
+import gzip
+import os
+import sys
+import time
+from datetime import timedelta
+from itertools import islice
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from .archive import (
+    ARCHIVE_BATCH_SIZE,
+    archive_deleted,
+    compact_database,
+    database_size,
+    table_sizes,
+)
+from .backup import BACKUP_BATCH_SIZE, export_board, import_board
+from .extensions import category_registry, db
+from .jobs import drain_jobs
+from .migrations import backfill_post_paths, compress_contents
+from .search import (
+    index_new_rows,
+    last_row_ids,
+    rebuild_search_index,
+    search_index_size,
+)
+from .seeding import SEED_BATCH_SIZE, seed_board
+from .upload_gc import UploadCollector
+from .utils import upload_path
+
+
+@click.command("shard-uploads")
+@click.option("--batch-size", default=500, show_default=True, help="Files per batch.")
+@click.option(
+    "--pause", default=0.5, show_default=True, help="Seconds to wait between batches."
+)
+@with_appcontext
+def shard_uploads(batch_size: int, pause: float):
+    """Move uploads from the flat directory into the sharded layout
+
+    Safe to run while the board is serving, uploads are looked up in both
+    layouts until they are moved.
+    """
+    uploads_directory = current_app.config["UPLOADS_DIRECTORY"]
+    moved = 0
+    duplicates = 0
+
+    while True:
+        with os.scandir(uploads_directory) as entries:
+            batch = list(
+                islice(
+                    (
+                        entry.name
+                        for entry in entries
+                        if entry.is_file()
+                        and not entry.name.startswith(".")
+                        and not entry.name.endswith(".tmp")
+                    ),
+                    batch_size,
+                )
+            )
+
+        if not batch:
+            break
+
+        for filename in batch:
+            flat_path = os.path.join(uploads_directory, filename)
+            sharded_path = upload_path(filename)
+
+            if os.path.exists(sharded_path):
+                os.remove(flat_path)
+                duplicates += 1
+            else:
+                os.makedirs(os.path.dirname(sharded_path), exist_ok=True)
+                os.replace(flat_path, sharded_path)
+                moved += 1
+
+        click.echo(f"{moved} moved, {duplicates} duplicates removed")
+        time.sleep(pause)
+
+    click.echo(f"Done: {moved} moved, {duplicates} duplicates removed")
+
+
+@click.command("run-jobs")
+@click.option("--once", is_flag=True, help="Exit once the queue is empty.")
+@with_appcontext
+def run_jobs(once: bool):
+    """Run queued jobs, set THR_JOB_WORKER_THREADS=0 for web workers to skip them"""
+    while True:
+        count = drain_jobs()
+
+        if count:
+            click.echo(f"{count} jobs run")
+
+        if once:
+            break
+
+        time.sleep(current_app.config["JOB_POLL_INTERVAL"])
+
+
+def _index_progress(table: str, rows: int):
+    """Report the rows added to the search index so far"""
+    click.echo(f"{table}: {rows} rows indexed")
+
+
+@click.command("seed")
+@click.option("--users", default=1000, show_default=True, help="Users to create.")
+@click.option(
+    "--categories", default=10, show_default=True, help="Categories to create."
+)
+@click.option("--threads", default=10000, show_default=True, help="Threads to create.")
+@click.option("--posts", default=100000, show_default=True, help="Posts to create.")
+@click.option(
+    "--reply-depth", default=3, show_default=True, help="Deepest reply chains."
+)
+@click.option(
+    "--deleted-ratio",
+    default=0.02,
+    show_default=True,
+    help="Share of soft-deleted users, threads and posts.",
+)
+@click.option(
+    "--seed",
+    "seed_value",
+    default=1,
+    show_default=True,
+    help="Random seed, use another one to seed the same database twice.",
+)
+@click.option(
+    "--batch-size",
+    default=SEED_BATCH_SIZE,
+    show_default=True,
+    help="Rows inserted per transaction.",
+)
+@with_appcontext
+def seed_database(  # pylint: disable=too-many-arguments
+    users: int,
+    categories: int,
+    threads: int,
+    posts: int,
+    reply_depth: int,
+    deleted_ratio: float,
+    seed_value: int,
+    batch_size: int,
+):
+    """Fill the database with a synthetic board for capacity tests"""
+    if users < 1 or (threads and categories < 1) or (posts and threads < 1):
+        raise click.UsageError("Posts need threads, threads need categories and users")
+
+    started = time.perf_counter()
+
+    def progress(table: str, rows: int, seconds: float):
+        click.echo(f"{table}: {rows} rows, {rows / seconds:.0f} rows/s")
+
+    last_ids = last_row_ids()
+    inserted = seed_board(
+        users,
+        categories,
+        threads,
+        posts,
+        reply_depth=reply_depth,
+        deleted_ratio=deleted_ratio,
+        seed=seed_value,
+        batch_size=batch_size,
+        progress=progress,
+    )
+    category_registry.invalidate()
+    # Only the seeded rows, the index of a board seeded before is kept
+    index_new_rows(batch_size, last_ids, _index_progress)
+
+    total = sum(inserted.values())
+    seconds = time.perf_counter() - started
+    click.echo(f"Done: {total} rows in {seconds:.1f}s, {total / seconds:.0f} rows/s")
+
+
+@click.command("reindex-search")
+@click.option(
+    "--batch-size", default=1000, show_default=True, help="Rows indexed per batch."
+)
+@with_appcontext
+def reindex_search(batch_size: int):
+    """Rebuild the full-text search index from the threads and posts"""
+    started = time.perf_counter()
+    indexed = rebuild_search_index(batch_size, _index_progress)
+    click.echo(f"Done: {indexed} rows in {time.perf_counter() - started:.1f}s")
+
+
+def _open_dump(path: str, mode: str):
+    """Open an NDJSON dump, gzip-compressed if its name ends with .gz"""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+
+    return open(path, mode, encoding="utf-8")  # pylint: disable=consider-using-with
+
+
+@click.command("export")
+@click.argument("path")
+@click.option(
+    "--batch-size",
+    default=BACKUP_BATCH_SIZE,
+    show_default=True,
+    help="Rows fetched per round trip.",
+)
+@with_appcontext
+def export_database(path: str, batch_size: int):
+    """Dump users, categories, threads and posts as NDJSON to PATH (- for stdout)"""
+    started = time.perf_counter()
+
+    def progress(table: str, rows: int):
+        click.echo(f"{table}: {rows} rows exported", err=True)
+
+    if path == "-":
+        exported = export_board(sys.stdout, batch_size, progress)
+    else:
+        with _open_dump(path, "w") as output:
+            exported = export_board(output, batch_size, progress)
+
+    total = sum(exported.values())
+    click.echo(f"Done: {total} rows in {time.perf_counter() - started:.1f}s", err=True)
+
+
+@click.command("import")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--batch-size",
+    default=BACKUP_BATCH_SIZE,
+    show_default=True,
+    help="Rows inserted per transaction.",
+)
+@click.option(
+    "--checkpoint",
+    help="File recording the progress of the import (default: PATH.checkpoint).",
+)
+@with_appcontext
+def import_database(path: str, batch_size: int, checkpoint: str):
+    """Load an NDJSON dump made by the export command into the database
+
+    An interrupted import resumes from its checkpoint when run again.
+    """
+    checkpoint = checkpoint or f"{path}.checkpoint"
+    started = time.perf_counter()
+
+    if os.path.exists(checkpoint):
+        click.echo(f"Resuming from {checkpoint}")
+
+    def progress(table: str, rows: int):
+        click.echo(f"{table}: {rows} rows imported")
+
+    with _open_dump(path, "r") as source:
+        imported = import_board(source, batch_size, checkpoint, progress)
+
+    category_registry.invalidate()
+    # Rows of an interrupted run included, the database was empty
+    index_new_rows(batch_size, progress=_index_progress)
+
+    total = sum(imported.values())
+    click.echo(f"Done: {total} rows in {time.perf_counter() - started:.1f}s")
+
+
+@click.command("archive")
+@click.option(
+    "--retention",
+    default=365,
+    show_default=True,
+    help="Days a deleted row is kept before being archived.",
+)
+@click.option(
+    "--batch-size",
+    default=ARCHIVE_BATCH_SIZE,
+    show_default=True,
+    help="Rows moved per transaction.",
+)
+@click.option(
+    "--full", is_flag=True, help="VACUUM FULL on PostgreSQL, locking the tables."
+)
+@with_appcontext
+def archive_database(retention: int, batch_size: int, full: bool):
+    """Move old soft-deleted rows to the archived_ tables and compact the database"""
+    started = time.perf_counter()
+    size_before = database_size()
+    tables_before = table_sizes()
+
+    def progress(table: str, rows: int):
+        click.echo(f"{table}: {rows} rows archived")
+
+    archived = archive_deleted(timedelta(days=retention), batch_size, progress)
+    category_registry.invalidate()
+
+    click.echo("Compacting the database...")
+    compact_database(full)
+    size_after = database_size()
+
+    # The archived rows stay in the database, the gain is in the live tables
+    for table, size in table_sizes().items():
+        if table in tables_before:
+            click.echo(
+                f"{table}: {tables_before[table] / 1e6:.1f} MB -> "
+                f"{size / 1e6:.1f} MB ({(tables_before[table] - size) / 1e6:.1f} "
+                "MB reclaimed)"
+            )
+
+    click.echo(
+        f"Done: {sum(archived.values())} rows archived in "
+        f"{time.perf_counter() - started:.1f}s, database {size_before / 1e6:.1f} MB"
+        f" -> {size_after / 1e6:.1f} MB"
+    )
+
+
+@click.command("collect-uploads")
+@click.option(
+    "--min-age",
+    default=24.0,
+    show_default=True,
+    help="Hours since a file was written before it can be deleted.",
+)
+@click.option("--dry-run", is_flag=True, help="List the files without deleting them.")
+@click.option("--verbose", is_flag=True, help="Print every deleted file.")
+@with_appcontext
+def collect_uploads(min_age: float, dry_run: bool, verbose: bool):
+    """Delete uploads, thumbnails and temporary files no row references"""
+    started = time.perf_counter()
+
+    def progress(path: str, dry_run: bool):
+        if verbose or dry_run:
+            click.echo(("Would delete " if dry_run else "Deleted ") + path)
+
+    stats = UploadCollector(min_age * 3600, dry_run, progress).collect()
+
+    click.echo(
+        f"Done: {stats['scanned']} files scanned in "
+        f"{time.perf_counter() - started:.1f}s, "
+        f"{'would delete' if dry_run else 'deleted'} {stats['uploads']} uploads, "
+        f"{stats['thumbnails']} thumbnails and {stats['temporary']} temporary "
+        f"files ({stats['bytes'] / 1e6:.1f} MB)"
+    )
+
+
+@click.command("backfill-post-paths")
+@click.option(
+    "--batch-size", default=100, show_default=True, help="Threads per transaction."
+)
+@with_appcontext
+def backfill_paths(batch_size: int):
+    """Compute the reply tree paths of posts from before they existed
+
+    Run setup_db.py first to add the columns.
+    """
+    started = time.perf_counter()
+
+    def progress(posts: int):
+        click.echo(f"{posts} posts updated")
+
+    updated = backfill_post_paths(batch_size, progress)
+    click.echo(f"Done: {updated} posts in {time.perf_counter() - started:.1f}s")
+
+
+@click.command("compress-content")
+@click.option(
+    "--batch-size", default=1000, show_default=True, help="Rows per transaction."
+)
+@click.option("--compact", is_flag=True, help="VACUUM afterwards to shrink the file.")
+@with_appcontext
+def compress_content(batch_size: int, compact: bool):
+    """Compress (or decompress) the contents of existing threads and posts
+
+    Applies THR_CONTENT_COMPRESSION and its threshold to the rows written
+    before they were set.
+    """
+    if db.engine.dialect.name != "sqlite":
+        raise click.UsageError(
+            "Only SQLite contents are compressed, PostgreSQL compresses large "
+            "values on its own"
+        )
+
+    started = time.perf_counter()
+    size_before = database_size()
+
+    def progress(table: str, rows: int):
+        click.echo(f"{table}: {rows} rows rewritten")
+
+    results = compress_contents(batch_size, progress)
+
+    for table, result in results.items():
+        click.echo(
+            f"{table}: {result['rows']} rows, contents {result['before'] / 1e6:.1f} MB"
+            f" -> {result['after'] / 1e6:.1f} MB "
+            f"({(result['after'] - result['before']) / 1e6:+.1f} MB)"
+        )
+
+    # Not compressed, highlighting needs the text
+    click.echo(
+        f"search index: {search_index_size() / 1e6:.1f} MB of uncompressed "
+        "titles and contents"
+    )
+
+    if compact:
+        click.echo("Compacting the database...")
+        compact_database()
+
+    click.echo(
+        f"Done in {time.perf_counter() - started:.1f}s, database "
+        f"{size_before / 1e6:.1f} MB -> {database_size() / 1e6:.1f} MB"
+    )
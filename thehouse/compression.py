@@ -0,0 +1,101 @@
+"""
+The House reloaded
+Transparent compression of thread and post contents
+"""
+
+import zlib
+from typing import Optional, Union
+
+from sqlalchemy.types import Text, TypeDecorator
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, zlib is always there
+    zstandard = None
+
+# Compressed values are stored as blobs starting with the codec that made them
+CODEC_TAGS = {"zlib": b"z", "zstd": b"s"}
+
+
+class ContentCompressor:
+    """Compress and decompress contents, configured by init_compression()
+
+    Contents are only compressed on SQLite, which stores blobs in a TEXT
+    column as they are. PostgreSQL already compresses large values (TOAST)
+    and keeps text columns for text.
+    """
+
+    def __init__(self, codec: Optional[str] = None, threshold: int = 1024):
+        self.codec = codec
+        self.threshold = threshold
+
+    def compress(self, value: str) -> Union[str, bytes]:
+        """Compressed value when enabled and worth it, the value itself otherwise"""
+        if self.codec is None or len(value) < self.threshold:
+            return value
+
+        data = value.encode("utf-8")
+
+        if self.codec == "zstd":
+            compressed = CODEC_TAGS["zstd"] + zstandard.ZstdCompressor().compress(data)
+        else:
+            compressed = CODEC_TAGS["zlib"] + zlib.compress(data)
+
+        return compressed if len(compressed) < len(data) else value
+
+    @staticmethod
+    def decompress(value: Union[str, bytes]) -> str:
+        """Text of a stored value, whichever codec (if any) compressed it"""
+        if not isinstance(value, bytes):
+            return value
+
+        tag, data = value[:1], value[1:]
+
+        if tag == CODEC_TAGS["zstd"]:
+            if zstandard is None:
+                raise RuntimeError("zstd compressed content needs zstandard")
+
+            data = zstandard.ZstdDecompressor().decompress(data)
+        else:
+            data = zlib.decompress(data)
+
+        return data.decode("utf-8")
+
+
+compressor = ContentCompressor()
+
+
+class CompressedText(TypeDecorator):  # pylint: disable=too-many-ancestors
+    """Text column compressed by the content compressor above a size threshold"""
+
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None or dialect.name != "sqlite":
+            return value
+
+        return compressor.compress(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return value
+
+        return compressor.decompress(value)
+
+    def process_literal_param(self, value, dialect):
+        return value
+
+
+def init_compression(app):
+    """Configure the content compressor from the app config"""
+    codec = app.config["CONTENT_COMPRESSION"]
+
+    if codec not in (None, *CODEC_TAGS):
+        raise ValueError(f"Unknown content compression {codec!r}")
+
+    if codec == "zstd" and zstandard is None:
+        raise ValueError("zstd content compression needs the zstd extra")
+
+    compressor.codec = codec
+    compressor.threshold = app.config["CONTENT_COMPRESSION_THRESHOLD"]
@@ -15,8 +15,51 @@ class Config:  # pylint: disable=too-few-public-methods
 
     SITE_NAME = os.getenv("THR_SITE_NAME") or "The House"
     SQLALCHEMY_DATABASE_URI = os.getenv("THR_DATABASE_URI") or "sqlite:///thehouse.db"
+    DATABASE_REPLICA_URI = os.getenv("THR_DATABASE_REPLICA_URI")
+    DATABASE_REPLICA_PIN = int(os.getenv("THR_DATABASE_REPLICA_PIN") or 10)  # seconds
+    DATABASE_POOL_SIZE = int(os.getenv("THR_DATABASE_POOL_SIZE") or 5)
+    DATABASE_MAX_OVERFLOW = int(os.getenv("THR_DATABASE_MAX_OVERFLOW") or 10)
+    DATABASE_POOL_RECYCLE = int(os.getenv("THR_DATABASE_POOL_RECYCLE") or 1800)
+    DATABASE_POOL_PRE_PING = os.getenv("THR_DATABASE_POOL_PRE_PING") != "no"
+    SQLITE_TUNING = os.getenv("THR_SQLITE_TUNING") != "no"
+    SQLITE_PRAGMAS = {
+        "journal_mode": os.getenv("THR_SQLITE_JOURNAL_MODE") or "WAL",
+        "synchronous": os.getenv("THR_SQLITE_SYNCHRONOUS") or "NORMAL",
+        "busy_timeout": int(os.getenv("THR_SQLITE_BUSY_TIMEOUT") or 5000),  # ms
+        "mmap_size": int(os.getenv("THR_SQLITE_MMAP_SIZE") or 256 * 1024 * 1024),
+        "cache_size": int(os.getenv("THR_SQLITE_CACHE_SIZE") or -20000),  # 20mb
+        "temp_store": os.getenv("THR_SQLITE_TEMP_STORE") or "MEMORY",
+    }
+    SQLITE_BUSY_RETRIES = int(os.getenv("THR_SQLITE_BUSY_RETRIES") or 3)
     SECRET_KEY = os.getenv("THR_SECRET_KEY")
     UPLOADS_DIRECTORY = os.getenv("THR_UPLOADS_DIRECTORY") or "uploads"
+    UPLOADS_OFFLOAD = os.getenv("THR_UPLOADS_OFFLOAD")
+    UPLOADS_ACCEL_PREFIX = os.getenv("THR_UPLOADS_ACCEL_PREFIX") or "/_uploads/"
+    UPLOADS_MAX_AGE = 365 * 24 * 60 * 60  # upload filenames are never reused
+    UPLOADS_DELETE_GRACE = float(os.getenv("THR_UPLOADS_DELETE_GRACE") or 300)
+    USE_X_SENDFILE = UPLOADS_OFFLOAD == "x-sendfile"
+    THUMBNAIL_SIZE = int(os.getenv("THR_THUMBNAIL_SIZE") or 400)
+    THUMBNAIL_WORKERS = int(os.getenv("THR_THUMBNAIL_WORKERS") or 2)
+    JOB_WORKER_THREADS = int(os.getenv("THR_JOB_WORKER_THREADS") or 1)
+    JOB_POLL_INTERVAL = float(os.getenv("THR_JOB_POLL_INTERVAL") or 1)
+    JOB_MAX_ATTEMPTS = 5
+    METRICS_ENABLED = os.getenv("THR_METRICS") == "yes"
+    METRICS_TOKEN = os.getenv("THR_METRICS_TOKEN")
+    METRICS_DIRECTORY = os.getenv("THR_METRICS_DIRECTORY")
+    QUERY_BUDGET = int(os.getenv("THR_QUERY_BUDGET") or 0)
+    PROFILING_ENABLED = os.getenv("THR_PROFILING") == "yes"
+    PROFILE_DIRECTORY = os.getenv("THR_PROFILE_DIRECTORY")
+    PROFILE_THRESHOLD = float(os.getenv("THR_PROFILE_THRESHOLD") or 0)  # seconds
+    PROFILE_INTERVAL = float(os.getenv("THR_PROFILE_INTERVAL") or 0.005)  # seconds
+    PROFILE_KEEP = int(os.getenv("THR_PROFILE_KEEP") or 100)
+    EVENTS_POLL_INTERVAL = float(os.getenv("THR_EVENTS_POLL_INTERVAL") or 0.5)
+    EVENTS_STREAM_SECONDS = int(os.getenv("THR_EVENTS_STREAM_SECONDS") or 300)
+    CONTENT_COMPRESSION = os.getenv("THR_CONTENT_COMPRESSION") or None  # zlib, zstd
+    CONTENT_COMPRESSION_THRESHOLD = int(
+        os.getenv("THR_CONTENT_COMPRESSION_THRESHOLD") or 1024
+    )  # characters
+    SEARCH_PAGE_SIZE = int(os.getenv("THR_SEARCH_PAGE_SIZE") or 20)
     ENABLE_ADMIN_KEY = os.getenv("THR_ENABLE_ADMIN_KEY") == "yes"
     ADMIN_KEY = None if not ENABLE_ADMIN_KEY else os.getenv("THR_ADMIN_KEY")
+    CATEGORY_REGISTRY_STAMP = os.getenv("THR_CATEGORY_REGISTRY_STAMP")
     MAX_CONTENT_LENGTH = 10 * 1024 * 1024  # 10mb
@@ -0,0 +1,182 @@
+"""
+The House reloaded
+Database engine setup and read replica routing
+"""
+
+import os
+import sqlite3
+import time
+from functools import wraps
+
+import sqlalchemy as sa
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+
+BUSY_BACKOFF = 0.05  # seconds, doubled on every retry
+REPLICA_BIND = "replica"
+
+
+def _is_busy(error: sqlite3.OperationalError) -> bool:
+    """Check whether SQLite failed because another connection holds a lock"""
+    return "database is locked" in str(error) or "database is busy" in str(error)
+
+
+def _retry_busy(function, retries: int, *args):
+    """Call function, retrying with a backoff while SQLite reports SQLITE_BUSY"""
+    for attempt in range(retries + 1):
+        try:
+            return function(*args)
+        except sqlite3.OperationalError as error:
+            if attempt == retries or not _is_busy(error):
+                raise
+
+            time.sleep(BUSY_BACKOFF * 2**attempt)
+
+    return None
+
+
+class RetryingCursor(sqlite3.Cursor):
+    """SQLite cursor retrying statements that hit SQLITE_BUSY"""
+
+    def execute(self, *args):
+        return _retry_busy(super().execute, self.connection.busy_retries, *args)
+
+    def executemany(self, *args):
+        return _retry_busy(super().executemany, self.connection.busy_retries, *args)
+
+
+class RetryingConnection(sqlite3.Connection):
+    """SQLite connection retrying commits that hit SQLITE_BUSY
+
+    A statement or COMMIT failing with SQLITE_BUSY leaves the transaction
+    open, so they can be retried as is.
+    """
+
+    busy_retries = 3
+
+    def cursor(self, factory=RetryingCursor):  # pylint: disable=arguments-differ
+        return super().cursor(factory)
+
+    def commit(self):
+        return _retry_busy(super().commit, self.busy_retries)
+
+
+def _pool_options(app) -> dict:
+    """Connection pool settings for client/server databases"""
+    return {
+        "pool_size": app.config["DATABASE_POOL_SIZE"],
+        "max_overflow": app.config["DATABASE_MAX_OVERFLOW"],
+        "pool_recycle": app.config["DATABASE_POOL_RECYCLE"],
+        "pool_pre_ping": app.config["DATABASE_POOL_PRE_PING"],
+    }
+
+
+def configure_engine_options(app):
+    """Fill the engine options and binds, must run before db.init_app()"""
+    # Copied so that the Config class attributes are left untouched
+    engine_options = dict(app.config.get("SQLALCHEMY_ENGINE_OPTIONS") or {})
+
+    if app.config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+        if app.config["SQLITE_TUNING"]:
+            RetryingConnection.busy_retries = app.config["SQLITE_BUSY_RETRIES"]
+
+            engine_options["connect_args"] = {
+                **engine_options.get("connect_args", {}),
+                "factory": RetryingConnection,
+            }
+    else:
+        engine_options = {**_pool_options(app), **engine_options}
+
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options
+
+    if app.config["DATABASE_REPLICA_URI"]:
+        # Binds don't inherit SQLALCHEMY_ENGINE_OPTIONS
+        app.config["SQLALCHEMY_BINDS"] = {
+            **(app.config.get("SQLALCHEMY_BINDS") or {}),
+            REPLICA_BIND: {**engine_options, "url": app.config["DATABASE_REPLICA_URI"]},
+        }
+
+
+def apply_sqlite_pragmas(app, engine):
+    """Set the configured pragmas on every new SQLite connection"""
+    if engine.dialect.name != "sqlite" or not app.config["SQLITE_TUNING"]:
+        return
+
+    pragmas = dict(app.config["SQLITE_PRAGMAS"])
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, _):
+        cursor = dbapi_connection.cursor()
+
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+
+        cursor.close()
+
+
+def reset_engines_after_fork(app, db):
+    """Drop the pooled connections a forked child inherits from its parent
+
+    Lets gunicorn preload the app: every worker opens its own connections
+    instead of sharing the sockets of the master.
+    """
+    if not hasattr(os, "register_at_fork"):  # Windows
+        return
+
+    def reset():
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose(close=False)
+
+    os.register_at_fork(after_in_child=reset)
+
+
+class RoutingSession(Session):
+    """Session sending the reads of GET requests to the read replica
+
+    Anything but a SELECT goes to the primary and keeps the rest of the
+    request on it, so that a request reads its own writes.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context():
+            if not isinstance(clause, (sa.Select, sa.TextualSelect)) or self._flushing:
+                g.db_wrote = True
+            elif g.get("use_replica") and not g.get("db_wrote"):
+                return self._db.engines[REPLICA_BIND]
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def use_replica_for_reads():
+    """Decide whether the queries of this request may go to the read replica"""
+    g.use_replica = (
+        bool(current_app.config["DATABASE_REPLICA_URI"])
+        and request.method in ("GET", "HEAD")
+        and session.get("primary_until", 0) < time.time()
+    )
+
+
+def pin_to_primary_after_write(response):
+    """Keep the client on the primary while the replica catches up on its writes"""
+    if not current_app.config["DATABASE_REPLICA_URI"]:
+        return response
+
+    if g.get("db_wrote"):
+        session["primary_until"] = (
+            time.time() + current_app.config["DATABASE_REPLICA_PIN"]
+        )
+
+    return response
+
+
+def use_primary(function):
+    """Decorator for GET views that write, so that they read from the primary"""
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        g.use_replica = False
+        return function(*args, **kwargs)
+
+    return wrapper
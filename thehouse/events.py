@@ -0,0 +1,335 @@
+"""
+The House reloaded
+Live thread and inbox events for Server-Sent Events streams
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from datetime import timedelta
+from typing import Iterator, List, Optional, Set
+
+from flask import current_app
+from sqlalchemy import event as sqlalchemy_event
+from sqlalchemy import inspect
+
+from .extensions import db
+from .models import Event, Post, record_events, utcnow
+from .utils import eprint
+
+EVENT_BUFFER_SIZE = 1000
+EVENT_BACKLOG_LIMIT = 500
+EVENT_RETENTION = timedelta(days=1)
+EVENT_PRUNE_INTERVAL = 600  # seconds
+# How long a missing event id holds later ones back, it may still be committed
+EVENT_GAP_GRACE = 5  # seconds
+HEARTBEAT_INTERVAL = 15  # seconds
+RECONNECT_DELAY = 3000  # ms
+UPDATED_ATTRIBUTES = {
+    "thread": ["title", "content", "attachment_filename"],
+    "post": ["content", "attachment_filename"],
+}
+
+
+def _changed(instance, attributes: List[str]) -> bool:
+    """Whether any of the attributes of an instance changed since it was loaded"""
+    state = inspect(instance)
+
+    return any(state.attrs[name].history.has_changes() for name in attributes)
+
+
+def record_flushed_changes(session, _):
+    """Turn the threads and posts of a flush into events, inserted on commit"""
+    events = session.info.setdefault("pending_events", [])
+
+    for instance in [*session.new, *session.dirty]:
+        table = getattr(instance, "__tablename__", None)
+
+        if table not in UPDATED_ATTRIBUTES:
+            continue
+
+        thread_id = instance.id if table == "thread" else instance.thread_id
+        post_id = instance.id if table == "post" else None
+
+        if instance in session.new:
+            if table != "post":
+                continue
+
+            events.append(
+                {"kind": "post_created", "thread_id": thread_id, "post_id": post_id}
+            )
+
+            if instance.replying_to:
+                parent_author = (
+                    session.connection()
+                    .execute(
+                        db.select(Post.author).where(Post.id == instance.replying_to)
+                    )
+                    .scalar()
+                )
+
+                if parent_author and parent_author != instance.author:
+                    events.append(
+                        {
+                            "kind": "inbox",
+                            "thread_id": thread_id,
+                            "post_id": post_id,
+                            "recipient": parent_author,
+                        }
+                    )
+        elif instance.deleted and _changed(instance, ["deleted"]):
+            events.append(
+                {"kind": f"{table}_deleted", "thread_id": thread_id, "post_id": post_id}
+            )
+        elif not instance.deleted and _changed(instance, UPDATED_ATTRIBUTES[table]):
+            events.append(
+                {"kind": f"{table}_updated", "thread_id": thread_id, "post_id": post_id}
+            )
+
+
+def insert_pending_events(session):
+    """Insert the events of the transaction's flushes right before it commits
+
+    Keeps the time between an event getting its id and being committed short,
+    and rolled back transactions from using up ids.
+    """
+    # Commits flush after this hook, flushing first catches their changes
+    session.flush()
+    events = session.info.pop("pending_events", None)
+
+    if events:
+        record_events(session.connection(), events)
+
+
+def discard_pending_events(session, transaction):
+    """Forget the events of a transaction that ended without committing them"""
+    if transaction.parent is None:
+        session.info.pop("pending_events", None)
+
+
+class EventBroker:
+    """Fan the events of the database out to the streams of this worker
+
+    A single thread per worker polls the event table and wakes the streams
+    up, which then only look at the events kept in memory. Threading
+    primitives are patched by gevent, so this works with its workers too.
+
+    Streams follow events by id. On PostgreSQL a transaction may commit a
+    higher id before another one commits a lower id, so events behind a
+    missing id are held back until it shows up, or for EVENT_GAP_GRACE
+    seconds if it never does (its transaction rolled back). Every event up
+    to last_id is then final and buffered in order.
+    """
+
+    def __init__(self):
+        self._events = deque(maxlen=EVENT_BUFFER_SIZE)
+        self._held = {}  # id -> event fetched behind a missing id
+        self._gaps = {}  # missing id -> when it was first missed
+        self._condition = threading.Condition()
+        self._lock = threading.Lock()
+        self._pid = None
+        self.fetched_id = 0
+        self.last_id = 0
+
+    def ensure_thread(self):
+        """Start the polling thread of this worker process if not running yet"""
+        # Compared to the pid so that forked workers start their own thread
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            app = current_app._get_current_object()  # pylint: disable=protected-access
+            self._events.clear()
+            self._held.clear()
+            self._gaps.clear()
+            self.last_id = self.fetched_id = (
+                db.session.execute(db.select(db.func.max(Event.id))).scalar() or 0
+            )
+            db.session.close()
+
+            threading.Thread(
+                target=self._run, args=(app,), name="events", daemon=True
+            ).start()
+
+            self._pid = os.getpid()
+
+    def _poll(self):
+        """Buffer the events committed since the last poll, and wake streams up"""
+        events = (
+            db.session.execute(
+                db.select(Event)
+                .where(
+                    db.or_(Event.id > self.fetched_id, Event.id.in_(list(self._gaps)))
+                )
+                .order_by(Event.id)
+                .limit(EVENT_BUFFER_SIZE)
+            )
+            .scalars()
+            .all()
+        )
+        db.session.expunge_all()
+        now = time.monotonic()
+
+        for event in events:
+            self._gaps.pop(event.id, None)
+            self._held[event.id] = event
+
+            if event.id > self.fetched_id:
+                # Larger jumps are sequence values lost to a crash, not gaps
+                if event.id - self.fetched_id <= EVENT_BUFFER_SIZE:
+                    self._gaps.update(
+                        dict.fromkeys(range(self.fetched_id + 1, event.id), now)
+                    )
+
+                self.fetched_id = event.id
+
+        self._gaps = {
+            gap_id: missed
+            for gap_id, missed in self._gaps.items()
+            if now - missed < EVENT_GAP_GRACE
+        }
+        last_id = min(self._gaps) - 1 if self._gaps else self.fetched_id
+
+        if last_id <= self.last_id:
+            return
+
+        released = [
+            self._held.pop(event_id)
+            for event_id in sorted(self._held)
+            if event_id <= last_id
+        ]
+
+        with self._condition:
+            self._events.extend(released)
+            self.last_id = last_id
+            self._condition.notify_all()
+
+    def _run(self, app):
+        """Polling loop"""
+        last_prune = 0
+
+        while True:
+            with app.app_context():
+                try:
+                    self._poll()
+
+                    if time.monotonic() - last_prune > EVENT_PRUNE_INTERVAL:
+                        db.session.execute(
+                            db.delete(Event).where(
+                                Event.created_date < utcnow() - EVENT_RETENTION
+                            )
+                        )
+                        last_prune = time.monotonic()
+
+                    db.session.commit()
+                except Exception as error:  # pylint: disable=broad-exception-caught
+                    db.session.rollback()
+                    eprint(error)
+
+            time.sleep(app.config["EVENTS_POLL_INTERVAL"])
+
+    def oldest_id(self) -> Optional[int]:
+        """Id of the oldest event in memory, None if there is none"""
+        with self._condition:
+            return self._events[0].id if self._events else None
+
+    def wait(self, after_id: int, timeout: float) -> List[Event]:
+        """Events in memory newer than after_id, waiting up to timeout for one"""
+        with self._condition:
+            self._condition.wait_for(lambda: self.last_id > after_id, timeout)
+
+            return [event for event in self._events if event.id > after_id]
+
+
+broker = EventBroker()
+
+
+def _format(event: Event) -> str:
+    """An event in the Server-Sent Events format"""
+    data = json.dumps({"thread_id": event.thread_id, "post_id": event.post_id})
+
+    return f"id: {event.id}\nevent: {event.kind}\ndata: {data}\n\n"
+
+
+def event_stream(
+    threads: Set[int], recipient: Optional[str], last_event_id: Optional[int]
+) -> Iterator[str]:
+    """Server-Sent Events of a set of threads and of the inbox of recipient
+
+    Resumes after last_event_id when given. Ends after EVENTS_STREAM_SECONDS
+    so that clients reconnect (with Last-Event-ID) to another worker when
+    this one restarts.
+    """
+
+    def wanted(event: Event) -> bool:
+        if event.kind == "inbox":
+            return recipient is not None and event.recipient == recipient
+
+        return event.thread_id in threads
+
+    broker.ensure_thread()
+    deadline = time.monotonic() + current_app.config["EVENTS_STREAM_SECONDS"]
+    cursor = broker.last_id if last_event_id is None else last_event_id
+
+    yield f"retry: {RECONNECT_DELAY}\n\n"
+
+    # Events the client missed that are no longer (or not yet) in memory
+    oldest_id = broker.oldest_id()
+
+    while oldest_id is None or cursor < oldest_id - 1:
+        backlog = (
+            db.session.execute(
+                db.select(Event)
+                .where(Event.id > cursor, Event.id <= broker.last_id)
+                .order_by(Event.id)
+                .limit(EVENT_BACKLOG_LIMIT)
+            )
+            .scalars()
+            .all()
+        )
+
+        if not backlog:
+            break
+
+        for event in backlog:
+            if wanted(event):
+                yield _format(event)
+
+        cursor = backlog[-1].id
+        oldest_id = broker.oldest_id()
+
+    # Streams hold no database connection while waiting
+    db.session.close()
+
+    while time.monotonic() < deadline:
+        events = broker.wait(
+            cursor, min(HEARTBEAT_INTERVAL, max(deadline - time.monotonic(), 0))
+        )
+
+        if not events:
+            yield ": keep-alive\n\n"
+            continue
+
+        for event in events:
+            if wanted(event):
+                yield _format(event)
+
+        cursor = events[-1].id
+
+
+def init_events(app):  # pylint: disable=unused-argument
+    """Record the thread and post changes committed by db.session as events"""
+    listeners = [
+        ("after_flush", record_flushed_changes),
+        ("before_commit", insert_pending_events),
+        ("after_transaction_end", discard_pending_events),
+    ]
+
+    for identifier, listener in listeners:
+        if not sqlalchemy_event.contains(db.session, identifier, listener):
+            sqlalchemy_event.listen(db.session, identifier, listener)
@@ -8,7 +8,11 @@ from flask_login import LoginManager
 from flask_marshmallow import Marshmallow
 from flask_sqlalchemy import SQLAlchemy
 
-db = SQLAlchemy()
+from .category_registry import CategoryRegistry
+from .database import RoutingSession
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 bcrypt = Bcrypt()
 login_manager = LoginManager()
 ma = Marshmallow()
+category_registry = CategoryRegistry()
@@ -7,8 +7,8 @@ from flask_wtf import FlaskForm
 from wtforms import FileField, PasswordField, StringField, SubmitField, TextAreaField
 from wtforms.validators import InputRequired, Length, ValidationError
 
-from .extensions import bcrypt
-from .models import Category, User
+from .extensions import bcrypt, category_registry
+from .models import User
 
 
 class RegisterForm(FlaskForm):
@@ -62,7 +62,7 @@ class CreateCategoryForm(FlaskForm):
 
     def validate_title(self, field):
         """Make sure the new title isn't used"""
-        if Category.query.filter_by(title=field.data).first():
+        if category_registry.get_by_title(field.data):
             raise ValidationError("Title must be unique")
 
         if " " in field.data:
@@ -0,0 +1,206 @@
+"""
+The House reloaded
+Background job queue
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+
+from flask import current_app
+
+from .extensions import db
+from .models import Job, RetryJob, Thread, utcnow
+from .utils import delete_upload, eprint
+
+JOB_HANDLERS = {}
+JOB_LEASE = timedelta(minutes=5)
+
+_pending_views = Counter()
+_views_lock = threading.Lock()
+_threads_lock = threading.Lock()
+_threads_pid = None  # pylint: disable=invalid-name
+
+
+def job_handler(kind: str):
+    """Register a function running jobs of a kind
+
+    Handlers must be idempotent, a job may run again after a crash.
+    """
+
+    def decorator(function):
+        JOB_HANDLERS[kind] = function
+        return function
+
+    return decorator
+
+
+job_handler("delete_upload")(delete_upload)
+
+
+def count_view(thread_id: int):
+    """Count a thread view, written to the database by the job threads"""
+    with _views_lock:
+        _pending_views[thread_id] += 1
+
+
+def flush_views():
+    """Add buffered view counts to their threads, one transaction per call"""
+    with _views_lock:
+        views = dict(_pending_views)
+        _pending_views.clear()
+
+    if not views:
+        return
+
+    try:
+        for thread_id, count in views.items():
+            db.session.execute(
+                db.update(Thread)
+                .where(Thread.id == thread_id)
+                .values(views=Thread.views + count)
+            )
+
+        db.session.commit()
+    except Exception:
+        # Counted again by the next flush rather than lost
+        db.session.rollback()
+
+        with _views_lock:
+            _pending_views.update(views)
+
+        raise
+
+
+def _flush_views_at_exit(app):
+    """Write the views counted since the last flush before the worker exits"""
+    with app.app_context():
+        try:
+            flush_views()
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            eprint(f"Lost {sum(_pending_views.values())} thread views: {error!r}")
+
+
+def _claim_job():
+    """Lock the next runnable job for this worker, None if there's none"""
+    while True:
+        now = utcnow()
+        unlocked = db.or_(Job.locked_until.is_(None), Job.locked_until < now)
+
+        job_id = db.session.execute(
+            db.select(Job.id)
+            .where(
+                Job.attempts < current_app.config["JOB_MAX_ATTEMPTS"],
+                Job.run_after <= now,
+                unlocked,
+            )
+            .order_by(Job.id)
+            .limit(1)
+        ).scalar()
+
+        if job_id is None:
+            return None
+
+        claimed = db.session.execute(
+            db.update(Job)
+            .where(Job.id == job_id, unlocked)
+            .values(locked_until=now + JOB_LEASE, attempts=Job.attempts + 1)
+        ).rowcount
+        db.session.commit()
+
+        # Another worker got it first otherwise
+        if claimed:
+            return db.session.get(Job, job_id)
+
+
+def run_job(job: Job):
+    """Run a claimed job, rescheduling it with a backoff on failure"""
+    job_id = job.id
+
+    try:
+        JOB_HANDLERS[job.kind](**json.loads(job.payload))
+    except RetryJob as retry:
+        db.session.rollback()
+
+        job = db.session.get(Job, job_id)
+        job.attempts -= 1  # not a failure
+        job.locked_until = None
+        job.run_after = retry.run_after
+        db.session.commit()
+
+        return False
+    except Exception as error:  # pylint: disable=broad-exception-caught
+        db.session.rollback()
+        eprint(f"Job {job_id} failed: {error!r}")
+
+        job = db.session.get(Job, job_id)
+        job.last_error = repr(error)
+        job.locked_until = None
+        job.run_after = utcnow() + timedelta(seconds=2**job.attempts)
+        db.session.commit()
+
+        return False
+
+    db.session.delete(job)
+    db.session.commit()
+
+    return True
+
+
+def drain_jobs() -> int:
+    """Run jobs until none is left, return how many were run"""
+    count = 0
+
+    while (job := _claim_job()) is not None:
+        run_job(job)
+        count += 1
+
+    return count
+
+
+def _job_thread(app, drain: bool):
+    """Loop of a job thread inside a web worker"""
+    while True:
+        with app.app_context():
+            try:
+                flush_views()
+
+                if drain:
+                    drain_jobs()
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                db.session.rollback()
+                eprint(error)
+
+        time.sleep(app.config["JOB_POLL_INTERVAL"])
+
+
+def start_job_threads():
+    """Start the job threads of this worker process if not running yet"""
+    global _threads_pid  # pylint: disable=global-statement
+
+    # Compared to the pid so that forked workers start their own threads
+    if _threads_pid == os.getpid():
+        return
+
+    with _threads_lock:
+        if _threads_pid == os.getpid():
+            return
+
+        app = current_app._get_current_object()  # pylint: disable=protected-access
+        thread_count = app.config["JOB_WORKER_THREADS"]
+
+        # View counts are flushed even when jobs are drained by `flask run-jobs`
+        for index in range(max(thread_count, 1)):
+            threading.Thread(
+                target=_job_thread,
+                args=(app, index < thread_count),
+                name=f"job-{index}",
+                daemon=True,
+            ).start()
+
+        atexit.register(_flush_views_at_exit, app)
+        _threads_pid = os.getpid()
@@ -0,0 +1,122 @@
+"""
+The House reloaded
+Request-scoped batched lookups for views and templates
+"""
+
+from typing import Dict, Iterable, Optional
+
+from flask import g
+
+from .category_registry import CachedCategory
+from .extensions import category_registry, db
+from .models import Post, Thread, User
+
+LOADER_BATCH_SIZE = 500
+# Templates only show the title of looked up threads
+LOADER_OPTIONS = {User: [], Thread: [db.defer(Thread.content)], Post: []}
+
+
+class RequestLoader:
+    """Memoized lookups of users, threads and posts by id for one request
+
+    Views prime the loader with every id a page needs, which fetches them in
+    a few IN queries, then templates look them up one at a time for free.
+    Ids nobody primed are still fetched once on first use.
+    """
+
+    def __init__(self):
+        self._rows = {User: {}, Thread: {}, Post: {}}
+        self._post_counts = {}
+
+    @staticmethod
+    def _key(model, row_id):
+        """Id as the type of the primary key, form values are strings"""
+        try:
+            return model.id.type.python_type(row_id)
+        except (TypeError, ValueError):
+            return None
+
+    def _prime(self, model, row_ids: Iterable) -> Dict:
+        """Fetch the rows of a model not loaded yet, return the model's cache"""
+        rows = self._rows[model]
+        missing = list(
+            {self._key(model, row_id) for row_id in row_ids} - rows.keys() - {None}
+        )
+
+        for start in range(0, len(missing), LOADER_BATCH_SIZE):
+            chunk = missing[start : start + LOADER_BATCH_SIZE]
+            rows.update(dict.fromkeys(chunk))  # remembers the missing ones too
+            rows.update(
+                (row.id, row)
+                for row in model.query.filter(model.id.in_(chunk)).options(
+                    *LOADER_OPTIONS[model]
+                )
+            )
+
+        return rows
+
+    def _get(self, model, row_id):
+        return self._prime(model, [row_id]).get(self._key(model, row_id))
+
+    def users(self, user_ids: Iterable[str]):
+        """Fetch the given users in batches"""
+        self._prime(User, user_ids)
+
+    def threads(self, thread_ids: Iterable[int]):
+        """Fetch the given threads in batches"""
+        self._prime(Thread, thread_ids)
+
+    def posts(self, post_ids: Iterable[int]):
+        """Fetch the given posts in batches"""
+        self._prime(Post, post_ids)
+
+    def user(self, user_id) -> Optional[User]:
+        """Get a user by its id"""
+        return self._get(User, user_id)
+
+    def thread(self, thread_id) -> Optional[Thread]:
+        """Get a thread by its id"""
+        return self._get(Thread, thread_id)
+
+    def post(self, post_id) -> Optional[Post]:
+        """Get a post by its id"""
+        return self._get(Post, post_id)
+
+    @staticmethod
+    def category(cat_id) -> Optional[CachedCategory]:
+        """Get a category by its id, from the category registry"""
+        return category_registry.get(cat_id)
+
+    def post_counts(self, user_ids: Iterable[str]):
+        """Count the posts of the given users in batches"""
+        missing = list(set(user_ids) - self._post_counts.keys())
+
+        for start in range(0, len(missing), LOADER_BATCH_SIZE):
+            chunk = missing[start : start + LOADER_BATCH_SIZE]
+            self._post_counts.update(dict.fromkeys(chunk, 0))
+            self._post_counts.update(
+                db.session.execute(
+                    db.select(Post.author, db.func.count())
+                    .where(Post.author.in_(chunk))
+                    .group_by(Post.author)
+                ).all()
+            )
+
+    def post_count(self, user_id: str) -> int:
+        """Number of posts of a user, deleted ones included"""
+        self.post_counts([user_id])
+
+        return self._post_counts[user_id]
+
+
+def get_loader() -> RequestLoader:
+    """The loader of the current request"""
+    if "loader" not in g:
+        g.loader = RequestLoader()
+
+    return g.loader
+
+
+def inject_loader() -> dict:
+    """Context processor making the request's loader available as loader"""
+    return {"loader": get_loader()}
@@ -0,0 +1,129 @@
+"""
+The House reloaded
+Worker memory instrumentation
+"""
+
+import os
+import tracemalloc
+from collections import defaultdict
+from threading import Lock
+from typing import List, Optional
+
+from flask import g, request
+
+MAX_SNAPSHOTS = 5
+SNAPSHOT_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+]
+
+_snapshots: List[tracemalloc.Snapshot] = []
+_endpoint_peaks = defaultdict(int)
+_lock = Lock()
+
+
+def _format_statistic(statistic) -> dict:
+    """Serialize a tracemalloc statistic (or statistic diff)"""
+    frame = statistic.traceback[0]
+    result = {
+        "site": f"{frame.filename}:{frame.lineno}",
+        "size": statistic.size,
+        "count": statistic.count,
+    }
+
+    if isinstance(statistic, tracemalloc.StatisticDiff):
+        result["size_diff"] = statistic.size_diff
+        result["count_diff"] = statistic.count_diff
+
+    return result
+
+
+def start_tracing(frames: int = 1):
+    """Start tracing allocations of this worker"""
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+
+
+def stop_tracing():
+    """Stop tracing and drop the snapshots and endpoint peaks"""
+    tracemalloc.stop()
+
+    with _lock:
+        _snapshots.clear()
+        _endpoint_peaks.clear()
+
+
+def take_snapshot(limit: int = 20) -> Optional[dict]:
+    """Snapshot allocations, return the top sites and the diff to the last snapshot
+
+    Returns None if tracing is off.
+    """
+    if not tracemalloc.is_tracing():
+        return None
+
+    snapshot = tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+
+    with _lock:
+        previous = _snapshots[-1] if _snapshots else None
+        _snapshots.append(snapshot)
+        del _snapshots[:-MAX_SNAPSHOTS]
+
+    return {
+        "top": [
+            _format_statistic(statistic)
+            for statistic in snapshot.statistics("lineno")[:limit]
+        ],
+        "diff": (
+            [
+                _format_statistic(statistic)
+                for statistic in snapshot.compare_to(previous, "lineno")[:limit]
+            ]
+            if previous is not None
+            else None
+        ),
+    }
+
+
+def memory_status() -> dict:
+    """Tracing state, traced memory and peak memory per endpoint of this worker"""
+    tracing = tracemalloc.is_tracing()
+    current, peak = tracemalloc.get_traced_memory() if tracing else (0, 0)
+
+    with _lock:
+        endpoint_peaks = dict(
+            sorted(_endpoint_peaks.items(), key=lambda item: item[1], reverse=True)
+        )
+        snapshot_count = len(_snapshots)
+
+    return {
+        "pid": os.getpid(),
+        "tracing": tracing,
+        "traceback_limit": tracemalloc.get_traceback_limit() if tracing else None,
+        "current": current,
+        "peak": peak,
+        "snapshots": snapshot_count,
+        "endpoint_peaks": endpoint_peaks,
+    }
+
+
+def start_request_peak():
+    """Reset the peak traced memory at the start of a request"""
+    if tracemalloc.is_tracing():
+        # The peak is process-wide, concurrent requests of a threaded worker
+        # share it
+        g.memory_start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+
+
+def record_request_peak(response):
+    """Record how much memory the request needed above what was allocated before"""
+    if "memory_start" in g and tracemalloc.is_tracing() and request.endpoint:
+        used = tracemalloc.get_traced_memory()[1] - g.memory_start
+
+        with _lock:
+            _endpoint_peaks[request.endpoint] = max(
+                _endpoint_peaks[request.endpoint], used
+            )
+
+    return response
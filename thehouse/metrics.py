@@ -0,0 +1,341 @@
+"""
+The House reloaded
+Request and database metrics
+"""
+
+import fcntl
+import hmac
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import List, Tuple
+
+from flask import abort, current_app, g, has_request_context, request
+from sqlalchemy import event
+
+from .utils import eprint
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SAVE_INTERVAL = 1  # seconds
+RETIRED_FILENAME = "retired.json"
+
+
+class QueryBudgetExceeded(RuntimeError):
+    """A request ran more queries than THR_QUERY_BUDGET allows"""
+
+
+class EndpointStats:  # pylint: disable=too-few-public-methods
+    """Counters of a single endpoint"""
+
+    def __init__(self):
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.requests = 0
+        self.seconds = 0.0
+        self.queries = 0
+        self.query_seconds = 0.0
+
+    def add(self, counters: dict):
+        """Add the counters of another worker, as saved by Metrics.save()"""
+        self.buckets = [
+            mine + other for mine, other in zip(self.buckets, counters["buckets"])
+        ]
+        self.requests += counters["requests"]
+        self.seconds += counters["seconds"]
+        self.queries += counters["queries"]
+        self.query_seconds += counters["query_seconds"]
+
+
+def _read_counters(path: str) -> dict:
+    """Counters per endpoint saved in a file, empty if it's gone"""
+    try:
+        with open(path, encoding="utf-8") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def _write_counters(path: str, counters: dict):
+    """Save counters per endpoint, atomically so that readers never see half"""
+    descriptor, temporary_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix=os.path.basename(path), suffix=".tmp"
+    )
+
+    with open(descriptor, "w", encoding="utf-8") as file:
+        json.dump(counters, file)
+
+    os.replace(temporary_path, path)
+
+
+@contextmanager
+def _directory_lock(directory: str, operation: int):
+    """Lock the metrics directory, shared to read it, exclusive to retire workers"""
+    with open(os.path.join(directory, "lock"), "a", encoding="utf-8") as lock_file:
+        fcntl.flock(lock_file, operation)
+
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def retire_worker_metrics(directory: str, pid: int):
+    """Fold the counters of an exited worker into those of the retired ones
+
+    Called by the gunicorn master, so that totals never go down (which
+    Prometheus would take for a restart) and dead workers don't pile up.
+    """
+    worker_path = os.path.join(directory, f"{pid}.json")
+    retired_path = os.path.join(directory, RETIRED_FILENAME)
+
+    with _directory_lock(directory, fcntl.LOCK_EX):
+        counters = _read_counters(worker_path)
+
+        if not counters:
+            return
+
+        retired = defaultdict(EndpointStats)
+
+        for path in (retired_path, worker_path):
+            for endpoint, endpoint_counters in _read_counters(path).items():
+                retired[endpoint].add(endpoint_counters)
+
+        _write_counters(
+            retired_path, {endpoint: vars(stats) for endpoint, stats in retired.items()}
+        )
+        os.remove(worker_path)
+
+
+class Metrics:
+    """Request metrics, rendered in Prometheus text format
+
+    Every worker counts its own requests. With a metrics directory, a thread
+    per worker saves its counters there every SAVE_INTERVAL seconds (and
+    gunicorn once more when the worker exits), and /metrics adds up those of
+    every worker, past ones included.
+    """
+
+    def __init__(self):
+        self._endpoints = defaultdict(EndpointStats)
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._thread_lock = threading.Lock()
+        self._changed = False
+        self._pid = None
+        self.directory = None
+
+    def _ensure_thread(self):
+        """Start the saving thread of this worker process if not running yet"""
+        # Compared to the pid so that forked workers start their own thread
+        if self._pid == os.getpid():
+            return
+
+        with self._thread_lock:
+            if self._pid == os.getpid():
+                return
+
+            threading.Thread(target=self._run, name="metrics", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        """Saving loop"""
+        while True:
+            time.sleep(SAVE_INTERVAL)
+
+            if self._changed:
+                try:
+                    self.save()
+                except OSError as error:
+                    eprint(error)
+
+    def observe(
+        self, endpoint: str, seconds: float, queries: int, query_seconds: float
+    ):
+        """Record a finished request"""
+        with self._lock:
+            stats = self._endpoints[endpoint]
+            stats.requests += 1
+            stats.seconds += seconds
+            stats.queries += queries
+            stats.query_seconds += query_seconds
+
+            for index, bound in enumerate(DURATION_BUCKETS):
+                if seconds <= bound:
+                    stats.buckets[index] += 1
+
+            self._changed = True
+
+        if self.directory:
+            self._ensure_thread()
+
+    def _counters(self) -> dict:
+        """Copy of the counters of this worker per endpoint"""
+        with self._lock:
+            self._changed = False
+
+            return {
+                endpoint: {**vars(stats), "buckets": list(stats.buckets)}
+                for endpoint, stats in self._endpoints.items()
+            }
+
+    def save(self):
+        """Save the counters of this worker to the metrics directory"""
+        if not self.directory:
+            return
+
+        # One writer at a time, so that an older copy never replaces a newer one
+        with self._save_lock:
+            _write_counters(
+                os.path.join(self.directory, f"{os.getpid()}.json"), self._counters()
+            )
+
+    def _totals(self) -> List[Tuple[str, EndpointStats]]:
+        """Counters per endpoint of every worker when sharing them, else this one's"""
+        if not self.directory:
+            with self._lock:
+                return sorted(self._endpoints.items())
+
+        self.save()
+        totals = defaultdict(EndpointStats)
+
+        with _directory_lock(self.directory, fcntl.LOCK_SH):
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".json"):
+                    for endpoint, counters in _read_counters(entry.path).items():
+                        totals[endpoint].add(counters)
+
+        return sorted(totals.items())
+
+    def render(self) -> str:
+        """Prometheus text exposition of every metric"""
+        endpoints = self._totals()
+        lines = [
+            "# HELP thehouse_request_duration_seconds Time spent handling requests.",
+            "# TYPE thehouse_request_duration_seconds histogram",
+        ]
+
+        for endpoint, stats in endpoints:
+            labels = f'endpoint="{endpoint}"'
+
+            for bound, count in zip(DURATION_BUCKETS, stats.buckets):
+                lines.append(
+                    "thehouse_request_duration_seconds_bucket"
+                    f'{{{labels},le="{bound}"}} {count}'
+                )
+
+            lines += [
+                "thehouse_request_duration_seconds_bucket"
+                f'{{{labels},le="+Inf"}} {stats.requests}',
+                f"thehouse_request_duration_seconds_sum{{{labels}}} {stats.seconds}",
+                f"thehouse_request_duration_seconds_count{{{labels}}} {stats.requests}",
+            ]
+
+        lines += [
+            "# HELP thehouse_db_queries_total Database queries run by requests.",
+            "# TYPE thehouse_db_queries_total counter",
+        ]
+        lines += [
+            f'thehouse_db_queries_total{{endpoint="{endpoint}"}} {stats.queries}'
+            for endpoint, stats in endpoints
+        ]
+
+        lines += [
+            "# HELP thehouse_db_seconds_total Time requests spent in the database.",
+            "# TYPE thehouse_db_seconds_total counter",
+        ]
+        lines += [
+            f'thehouse_db_seconds_total{{endpoint="{endpoint}"}} {stats.query_seconds}'
+            for endpoint, stats in endpoints
+        ]
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def _before_cursor_execute(_conn, _cursor, _statement, _parameters, context, _many):
+    """Time a query run on behalf of a request"""
+    if has_request_context():
+        context.thr_started = time.perf_counter()
+
+
+def _after_cursor_execute(_conn, _cursor, _statement, _parameters, context, _many):
+    """Add a finished query to the request counters"""
+    if has_request_context() and hasattr(context, "thr_started"):
+        g.query_count = g.get("query_count", 0) + 1
+        g.query_seconds = (
+            g.get("query_seconds", 0.0) + time.perf_counter() - context.thr_started
+        )
+
+
+def start_request_timer():
+    """Remember when the request started"""
+    g.request_started = time.perf_counter()
+
+
+def record_request(response):
+    """Record the request metrics and enforce the query budget"""
+    if request.blueprint not in ("main", "api") or "request_started" not in g:
+        return response
+
+    queries = g.get("query_count", 0)
+    metrics.observe(
+        request.endpoint,
+        time.perf_counter() - g.request_started,
+        queries,
+        g.get("query_seconds", 0.0),
+    )
+
+    budget = current_app.config["QUERY_BUDGET"]
+
+    if budget and queries > budget:
+        message = (
+            f"{request.method} {request.path} ran {queries} queries (budget: {budget})"
+        )
+
+        if current_app.testing:
+            raise QueryBudgetExceeded(message)
+
+        current_app.logger.warning(message)
+
+    return response
+
+
+def metrics_endpoint():
+    """Prometheus metrics of every worker"""
+    token = current_app.config["METRICS_TOKEN"]
+
+    if not current_app.config["METRICS_ENABLED"]:
+        abort(404)
+
+    if token and not hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {token}"
+    ):
+        abort(401)
+
+    return current_app.response_class(
+        metrics.render(), mimetype="text/plain; version=0.0.4"
+    )
+
+
+def init_metrics(app, db):
+    """Hook request timing and query counting into the app"""
+    if not app.config["METRICS_ENABLED"] and not app.config["QUERY_BUDGET"]:
+        return
+
+    if app.config["METRICS_DIRECTORY"]:
+        os.makedirs(app.config["METRICS_DIRECTORY"], exist_ok=True)
+        metrics.directory = app.config["METRICS_DIRECTORY"]
+
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+    app.before_request(start_request_timer)
+    app.after_request(record_request)
+    app.add_url_rule("/metrics", "metrics", metrics_endpoint)
@@ -0,0 +1,200 @@
+"""
+The House reloaded
+Upgrades of existing databases
+"""
+
+from typing import List
+
+from sqlalchemy import inspect
+
+from .compression import compressor
+from .extensions import db
+from .models import Post, Thread, path_segment
+
+
+def add_missing_columns(connection) -> List[str]:
+    """Add the model columns missing from existing tables, return their names
+
+    create_all() only creates missing tables. New columns must be nullable or
+    have a scalar default, which existing rows get.
+    """
+    inspector = inspect(connection)
+    quote = connection.dialect.identifier_preparer.quote
+    added = []
+
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+
+        for column in table.columns:
+            if column.name in existing:
+                continue
+
+            statement = (
+                f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} "
+                f"{column.type.compile(dialect=connection.dialect)}"
+            )
+
+            if not column.nullable:
+                if column.default is None or not column.default.is_scalar:
+                    raise ValueError(
+                        f"{table.name}.{column.name} is NOT NULL without a default"
+                    )
+
+                default = db.literal(column.default.arg).compile(
+                    dialect=connection.dialect,
+                    compile_kwargs={"literal_binds": True},
+                )
+                statement += f" NOT NULL DEFAULT {default}"
+
+            connection.execute(db.text(statement))
+            added.append(f"{table.name}.{column.name}")
+
+    return added
+
+
+def _thread_paths(posts: list) -> List[dict]:
+    """Path and depth of every post of a thread from their replying_to"""
+    placed = {}
+
+    # Replies always come after the post they reply to
+    for post_id, replying_to in sorted(posts):
+        parent = (
+            placed.get(int(replying_to)) if str(replying_to or "").isdigit() else None
+        )
+
+        if parent is None:
+            placed[post_id] = {"id": post_id, "path": path_segment(post_id), "depth": 0}
+        else:
+            placed[post_id] = {
+                "id": post_id,
+                "path": parent["path"] + path_segment(post_id),
+                "depth": parent["depth"] + 1,
+            }
+
+    return list(placed.values())
+
+
+def backfill_post_paths(batch_size: int, progress=None) -> int:
+    """Compute the path of every post of the threads having posts without one
+
+    Whole threads are recomputed, a reply made before the backfill to a post
+    without a path was placed at the top level. One transaction per batch of
+    threads, progress(posts) is called after each. Returns the updated posts.
+    """
+    table = Post.__table__
+    updated = 0
+
+    while True:
+        thread_ids = (
+            db.session.execute(
+                db.select(Post.thread_id)
+                .where(Post.path.is_(None))
+                .distinct()
+                .limit(batch_size)
+            )
+            .scalars()
+            .all()
+        )
+
+        if not thread_ids:
+            break
+
+        posts = {}
+
+        for thread_id, post_id, replying_to in db.session.execute(
+            db.select(Post.thread_id, Post.id, Post.replying_to).where(
+                Post.thread_id.in_(thread_ids)
+            )
+        ):
+            posts.setdefault(thread_id, []).append((post_id, replying_to))
+
+        rows = [row for thread in posts.values() for row in _thread_paths(thread)]
+        db.session.execute(
+            db.update(table)
+            .where(table.c.id == db.bindparam("post_id"))
+            .values(path=db.bindparam("post_path"), depth=db.bindparam("post_depth")),
+            [
+                {
+                    "post_id": row["id"],
+                    "post_path": row["path"],
+                    "post_depth": row["depth"],
+                }
+                for row in rows
+            ],
+        )
+        db.session.commit()
+
+        updated += len(rows)
+
+        if progress is not None:
+            progress(updated)
+
+    return updated
+
+
+def _stored_size(value) -> int:
+    """Bytes taken by a content as stored"""
+    return len(value) if isinstance(value, bytes) else len(value.encode("utf-8"))
+
+
+def compress_contents(batch_size: int, progress=None) -> dict:
+    """Store the thread and post contents the way the compressor now would
+
+    Contents above the threshold get compressed (or recompressed with another
+    codec), and compressed ones are stored as text again when compression is
+    off. SQLite only, one transaction per batch. progress(table, rows) is
+    called after every batch. Returns the rewritten rows and the bytes of
+    their contents before and after, per table.
+    """
+    results = {}
+
+    for model in (Thread, Post):
+        table = model.__tablename__
+        results[table] = {"rows": 0, "before": 0, "after": 0}
+        last_id = 0
+
+        while True:
+            # Raw values, the content column type would decompress them
+            rows = db.session.execute(
+                db.text(
+                    f"SELECT id, content FROM {table} WHERE id > :last_id AND "
+                    "(typeof(content) = 'blob' OR length(content) >= :threshold) "
+                    "ORDER BY id LIMIT :limit"
+                ),
+                {
+                    "last_id": last_id,
+                    "threshold": compressor.threshold,
+                    "limit": batch_size,
+                },
+            ).all()
+
+            if not rows:
+                break
+
+            last_id = rows[-1].id
+            updates = []
+
+            for row_id, stored in rows:
+                restored = compressor.compress(compressor.decompress(stored))
+
+                if restored != stored:
+                    updates.append({"row_id": row_id, "stored": restored})
+                    results[table]["before"] += _stored_size(stored)
+                    results[table]["after"] += _stored_size(restored)
+
+            if updates:
+                db.session.execute(
+                    db.text(f"UPDATE {table} SET content = :stored WHERE id = :row_id"),
+                    updates,
+                )
+
+            db.session.commit()
+            results[table]["rows"] += len(updates)
+
+            if progress is not None:
+                progress(table, results[table]["rows"])
+
+    return results
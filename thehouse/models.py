@@ -3,12 +3,18 @@ The House reloaded
 Database models
 """
 
+import json
+from datetime import datetime, timezone
+from typing import List, Optional
 from uuid import uuid4
 
 from flask_login import UserMixin
 
+from .compression import CompressedText
 from .extensions import db
-from .utils import delete_upload
+from .search import remove_from_index
+
+BULK_DELETE_CHUNK_SIZE = 1000
 
 
 class User(db.Model, UserMixin):  # pylint: disable=too-few-public-methods
@@ -26,18 +32,22 @@ class User(db.Model, UserMixin):  # pylint: disable=too-few-public-methods
     role = db.Column(
         db.Enum("admin", "moderator", "user", name="user_roles"), default="user"
     )
-    picture_filename = db.Column(db.Text)
+    picture_filename = db.Column(db.Text, index=True)
     bio = db.Column(db.String(60))
     deleted = db.Column(db.Boolean, nullable=False, default=False)
+    deleted_date = db.Column(db.DateTime)
+    # API reads stay on the primary until then, see api_routes.py
+    primary_until = db.Column(db.DateTime)
 
     def delete(self):
         """Demote the user and flag him as deleted"""
 
         self.deleted = True
+        self.deleted_date = utcnow()
         self.role = "user"
 
         if self.picture_filename:
-            delete_upload(self.picture_filename)
+            enqueue_job("delete_upload", filename=self.picture_filename)
             self.picture_filename = None
 
 
@@ -48,11 +58,13 @@ class Category(db.Model):  # pylint: disable=too-few-public-methods
     title = db.Column(db.String(20), nullable=False, unique=True)
     description = db.Column(db.String(150), nullable=False)
     deleted = db.Column(db.Boolean, nullable=False, default=False)
+    deleted_date = db.Column(db.DateTime)
 
     def delete(self):
         """Remove category description and flag it as deleted"""
 
         self.deleted = True
+        self.deleted_date = utcnow()
         self.description = ""
 
 
@@ -63,46 +75,263 @@ class Thread(db.Model):  # pylint: disable=too-few-public-methods
     cat_id = db.Column(db.Integer, nullable=False)
     title = db.Column(db.String(255), nullable=False)
     creator = db.Column(db.String(36), nullable=False)
-    content = db.Column(db.Text)
-    attachment_filename = db.Column(db.Text)
+    content = db.Column(CompressedText)
+    attachment_filename = db.Column(db.Text, index=True)
     creation_date = db.Column(
         db.DateTime, nullable=False, server_default=db.func.current_timestamp()
     )
     views = db.Column(db.Integer, nullable=False, default=0)
     deleted = db.Column(db.Boolean, nullable=False, default=False)
+    deleted_date = db.Column(db.DateTime)
 
     def delete(self):
         """Remove thread contents and flag it as deleted"""
 
         self.deleted = True
+        self.deleted_date = utcnow()
         self.title = ""
         self.content = ""
 
         if self.attachment_filename:
-            delete_upload(self.attachment_filename)
+            enqueue_job("delete_upload", filename=self.attachment_filename)
             self.attachment_filename = None
 
 
 class Post(db.Model):  # pylint: disable=too-few-public-methods
     """A post on the House"""
 
+    __table_args__ = (db.Index("ix_post_thread_id_path", "thread_id", "path"),)
+
     id = db.Column(db.Integer, primary_key=True)
     cat_id = db.Column(db.Integer, nullable=False)
     thread_id = db.Column(db.Integer, nullable=False)
     author = db.Column(db.String(36), nullable=False)
-    content = db.Column(db.Text, nullable=False)
+    content = db.Column(CompressedText, nullable=False)
     creation_date = db.Column(
         db.DateTime, nullable=False, server_default=db.func.current_timestamp()
     )
     replying_to = db.Column(db.Integer)
-    attachment_filename = db.Column(db.Text)
+    # Ids of the ancestors and of the post, sorting by it gives the display order
+    path = db.Column(db.Text)
+    depth = db.Column(db.Integer, nullable=False, default=0)
+    attachment_filename = db.Column(db.Text, index=True)
     deleted = db.Column(db.Boolean, nullable=False, default=False)
+    deleted_date = db.Column(db.DateTime)
 
     def delete(self):
         """Remove post contents and flag it as deleted"""
         self.deleted = True
+        self.deleted_date = utcnow()
         self.content = ""
 
         if self.attachment_filename:
-            delete_upload(self.attachment_filename)
+            enqueue_job("delete_upload", filename=self.attachment_filename)
             self.attachment_filename = None
+
+
+def utcnow() -> datetime:
+    """Naive UTC timestamp, as stored in the database"""
+
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class Job(db.Model):  # pylint: disable=too-few-public-methods
+    """A side effect queued to run after the request, see jobs.py"""
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_after = db.Column(db.DateTime, nullable=False, default=utcnow, index=True)
+    locked_until = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+
+
+class Event(db.Model):  # pylint: disable=too-few-public-methods
+    """A change pushed to event streams, see events.py"""
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)
+    thread_id = db.Column(db.Integer, nullable=False)
+    post_id = db.Column(db.Integer)
+    recipient = db.Column(db.String(36))  # user whose inbox it goes to
+    created_date = db.Column(db.DateTime, nullable=False, default=utcnow, index=True)
+
+
+def record_events(connection, events: List[dict]):
+    """Insert events (kind, thread_id, post_id, recipient) on a connection
+
+    For the write paths that bypass the ORM, or run inside a flush.
+    """
+
+    if events:
+        connection.execute(
+            db.insert(Event),
+            [
+                {"post_id": None, "recipient": None, **event, "created_date": utcnow()}
+                for event in events
+            ],
+        )
+
+
+class RetryJob(Exception):
+    """Raised by a job handler to run its job again later, without a failure"""
+
+    def __init__(self, run_after: datetime):
+        super().__init__(f"Retry after {run_after}")
+        self.run_after = run_after
+
+
+def enqueue_job(kind: str, **payload):
+    """Queue a job, it becomes visible to workers when the session commits"""
+
+    db.session.add(Job(kind=kind, payload=json.dumps(payload)))
+
+
+def path_segment(post_id: int) -> str:
+    """Fixed-width part of a post path, so that paths sort like the tree"""
+
+    return f"{post_id:08x}"
+
+
+def add_post(post: Post):
+    """Add a post to the session along with its path in the reply tree
+
+    Replies to posts missing from the thread are placed at the top level.
+    """
+
+    db.session.add(post)
+    db.session.flush()
+
+    parent = (
+        db.session.get(Post, int(post.replying_to))
+        if str(post.replying_to or "").isdigit()
+        else None
+    )
+
+    # Form values may still be strings
+    if (
+        parent is not None
+        and str(parent.thread_id) == str(post.thread_id)
+        and parent.path
+    ):
+        post.path = parent.path + path_segment(post.id)
+        post.depth = parent.depth + 1
+    else:
+        post.path = path_segment(post.id)
+        post.depth = 0
+
+
+def thread_posts(
+    thread_id: int, root: Optional[Post] = None, limit: Optional[int] = None
+):
+    """Query the posts of a thread, or of the subtree of root, in display order
+
+    A single range scan of the (thread_id, path) index.
+    """
+
+    query = Post.query.filter(Post.thread_id == thread_id)
+
+    if root is not None:
+        # Paths are hexadecimal, the next character bounds the subtree
+        upper_bound = root.path[:-1] + chr(ord(root.path[-1]) + 1)
+        query = query.filter(Post.path >= root.path, Post.path < upper_bound)
+
+    query = query.order_by(Post.path)
+
+    return query.limit(limit) if limit else query
+
+
+def upload_is_referenced(filename: str) -> bool:
+    """Check whether any user, thread or post still points to an upload"""
+
+    return (
+        User.query.filter_by(picture_filename=filename).first() is not None
+        or Thread.query.filter_by(attachment_filename=filename).first() is not None
+        or Post.query.filter_by(attachment_filename=filename).first() is not None
+    )
+
+
+def _bulk_soft_delete(model, file_column, blanked_values: dict, criteria) -> int:
+    """Soft-delete matching rows with set-based updates, one transaction per chunk
+
+    Uploads referenced by the deleted rows are queued for deletion in the same
+    transaction. Returns the number of deleted rows.
+    """
+
+    deleted_count = 0
+    thread_column = Post.thread_id if model is Post else Thread.id
+
+    while True:
+        rows = db.session.execute(
+            db.select(model.id, file_column, thread_column)
+            .where(model.deleted.is_(False), *criteria)
+            .limit(BULK_DELETE_CHUNK_SIZE)
+        ).all()
+
+        if not rows:
+            break
+
+        deleted_count += len(rows)
+        row_ids = [row_id for row_id, _, _ in rows]
+
+        for filename in {filename for _, filename, _ in rows if filename}:
+            enqueue_job("delete_upload", filename=filename)
+
+        db.session.execute(
+            db.update(model)
+            .where(model.id.in_(row_ids))
+            .values(
+                deleted=True,
+                deleted_date=utcnow(),
+                **{file_column.key: None},
+                **blanked_values,
+            ),
+            execution_options={"synchronize_session": False},
+        )
+        remove_from_index(db.session.connection(), model.__tablename__, row_ids)
+        record_events(
+            db.session.connection(),
+            [
+                {
+                    "kind": f"{model.__tablename__}_deleted",
+                    "thread_id": thread_id,
+                    "post_id": row_id if model is Post else None,
+                }
+                for row_id, _, thread_id in rows
+            ],
+        )
+        db.session.commit()
+
+    return deleted_count
+
+
+def delete_posts(*criteria) -> int:
+    """Soft-delete every post matching the criteria like Post.delete() does"""
+
+    return _bulk_soft_delete(Post, Post.attachment_filename, {"content": ""}, criteria)
+
+
+def delete_threads(*criteria) -> int:
+    """Soft-delete every thread matching the criteria like Thread.delete() does"""
+
+    return _bulk_soft_delete(
+        Thread, Thread.attachment_filename, {"title": "", "content": ""}, criteria
+    )
+
+
+def reset_id_sequences():
+    """Move the PostgreSQL id sequences past ids inserted explicitly"""
+
+    if db.engine.dialect.name != "postgresql":
+        return
+
+    for model in (Category, Thread, Post):
+        db.session.execute(
+            db.text(
+                f"SELECT setval(pg_get_serial_sequence('{model.__tablename__}', "
+                f"'id'), (SELECT MAX(id) FROM {model.__tablename__}))"
+            )
+        )
+
+    db.session.commit()
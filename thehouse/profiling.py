@@ -0,0 +1,173 @@
+"""
+The House reloaded
+On-demand request profiling
+"""
+
+import cProfile
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from uuid import uuid4
+
+from flask import current_app, g, request
+from flask_login import current_user
+
+from .utils import eprint
+
+
+def _collapse_stack(frame) -> str:
+    """Turn a frame into a line of collapsed stack (outermost call first)"""
+    calls = []
+
+    while frame is not None:
+        code = frame.f_code
+        calls.append(
+            f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        )
+        frame = frame.f_back
+
+    return ";".join(reversed(calls))
+
+
+class SlowRequestSampler:
+    """Sample the stacks of requests running for longer than a threshold
+
+    A single thread per worker looks at the requests in flight every
+    interval, so requests that stay under the threshold only pay for a dict
+    insertion and removal.
+    """
+
+    def __init__(self, threshold: float, interval: float):
+        self.threshold = threshold
+        self.interval = interval
+        self._requests = {}  # thread id -> [start time, Counter of stacks]
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_thread(self):
+        """Start the sampling thread of this worker process if not running yet"""
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            threading.Thread(target=self._run, name="profiler", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        """Sampling loop"""
+        while True:
+            time.sleep(self.interval)
+
+            now = time.perf_counter()
+            frames = None
+
+            for ident, (started, stacks) in list(self._requests.items()):
+                if now - started < self.threshold:
+                    continue
+
+                if frames is None:
+                    frames = sys._current_frames()  # pylint: disable=protected-access
+
+                if ident in frames:
+                    stacks[_collapse_stack(frames[ident])] += 1
+
+    def start_request(self):
+        """Track the request of the current thread"""
+        self._ensure_thread()
+        self._requests[threading.get_ident()] = [time.perf_counter(), Counter()]
+
+    def end_request(self) -> Counter:
+        """Stop tracking the current request and return its samples, if any"""
+        _, stacks = self._requests.pop(threading.get_ident(), (None, Counter()))
+
+        return stacks
+
+
+sampler = SlowRequestSampler(threshold=0, interval=0.005)
+
+
+def _profile_path(extension: str) -> str:
+    """Path of a new profile of the current request, dropping the oldest ones"""
+    directory = current_app.config["PROFILE_DIRECTORY"] or os.path.join(
+        current_app.instance_path, "profiles"
+    )
+    os.makedirs(directory, exist_ok=True)
+
+    profiles = sorted(
+        (entry for entry in os.scandir(directory) if entry.is_file()),
+        key=lambda entry: entry.stat().st_mtime,
+    )
+
+    for entry in profiles[
+        : max(len(profiles) - current_app.config["PROFILE_KEEP"] + 1, 0)
+    ]:
+        os.remove(entry.path)
+
+    endpoint = (request.endpoint or "unknown").replace(".", "-")
+
+    return os.path.join(
+        directory,
+        # Several requests of a worker may end within the same second
+        f"{time.strftime('%Y%m%d-%H%M%S')}-{endpoint}-{os.getpid()}-"
+        f"{uuid4().hex[:8]}.{extension}",
+    )
+
+
+def start_profiling():
+    """Profile the request when an admin asks for it, sample it when slow"""
+    if (
+        request.args.get("profile") == "1"
+        and current_user.is_authenticated
+        and current_user.role == "admin"
+    ):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+    elif sampler.threshold:
+        sampler.start_request()
+
+
+def stop_profiling(_):
+    """Write the profile of the request, if any"""
+    try:
+        if "profiler" in g:
+            g.profiler.disable()
+            g.profiler.dump_stats(_profile_path("pstats"))
+        elif sampler.threshold:
+            stacks = sampler.end_request()
+
+            if stacks:
+                with open(_profile_path("folded"), "w", encoding="utf-8") as profile:
+                    for stack, count in stacks.items():
+                        profile.write(f"{stack} {count}\n")
+    except OSError as error:
+        eprint(error)
+
+
+def _gevent_patched() -> bool:
+    """Whether gevent turned threads into greenlets, which have no frames of their own"""
+    monkey = sys.modules.get("gevent.monkey")
+
+    return monkey is not None and monkey.is_module_patched("threading")
+
+
+def init_profiling(app):
+    """Hook request profiling into the app when enabled"""
+    if not app.config["PROFILING_ENABLED"]:
+        return
+
+    sampler.threshold = app.config["PROFILE_THRESHOLD"]
+
+    # sys._current_frames() only knows OS threads, not the greenlets of requests
+    if sampler.threshold and _gevent_patched():
+        app.logger.warning("THR_PROFILE_THRESHOLD is ignored with gevent workers")
+        sampler.threshold = 0
+
+    sampler.interval = app.config["PROFILE_INTERVAL"]
+
+    app.before_request(start_profiling)
+    app.teardown_request(stop_profiling)
@@ -4,7 +4,7 @@ Routes
 """
 
 from os import path
-from typing import List, Optional
+from typing import Iterable
 from uuid import uuid4
 
 from flask import (
@@ -22,7 +22,8 @@ from flask_wtf import FlaskForm
 from wtforms import FileField, StringField, SubmitField
 from wtforms.validators import Length
 
-from .extensions import bcrypt, db
+from .database import use_primary
+from .extensions import bcrypt, category_registry, db
 from .forms import (
     CreateCategoryForm,
     CreatePostForm,
@@ -30,14 +31,28 @@ from .forms import (
     LoginForm,
     RegisterForm,
 )
-from .models import Category, Post, Thread, User
+from .jobs import count_view
+from .loaders import get_loader
+from .models import (
+    Category,
+    Post,
+    Thread,
+    User,
+    add_post,
+    delete_posts,
+    delete_threads,
+    enqueue_job,
+    thread_posts,
+)
+from .search import search_page
 from .utils import (
-    delete_upload,
+    find_upload,
     generate_file_embed,
-    generate_uploads_filename,
     get_inbox,
+    offload_upload,
     render_content,
     save_to_uploads,
+    thumbnail_url,
 )
 
 main = Blueprint("main", __name__)
@@ -48,17 +63,32 @@ def index():
     """Homepage"""
 
     categories = Category.query.filter_by(deleted=False).all()
+    loader = get_loader()
 
     for category in categories:
         category.activities = []
+        threads = (
+            Thread.query.filter_by(cat_id=category.id)
+            .options(db.defer(Thread.content))
+            .all()
+        )
+        posts = (
+            Post.query.filter_by(cat_id=category.id)
+            .options(db.defer(Post.content), db.defer(Post.path))
+            .all()
+        )
+        loader.users(
+            [thread.creator for thread in threads] + [post.author for post in posts]
+        )
+        loader.threads(post.thread_id for post in posts)
 
-        for thread in Thread.query.filter_by(cat_id=category.id):
+        for thread in threads:
             if not thread.deleted:
-                if not User.query.filter_by(id=thread.creator).first().deleted:
+                if not loader.user(thread.creator).deleted:
                     category.activities.append({"type": "thread", "data": thread})
-        for post in Post.query.filter_by(cat_id=category.id):
+        for post in posts:
             if not post.deleted:
-                if not User.query.filter_by(id=post.author).first().deleted:
+                if not loader.user(post.author).deleted:
                     category.activities.append({"type": "post", "data": post})
 
         category.activities = sorted(
@@ -69,9 +99,6 @@ def index():
     return render_template(
         "index.html",
         categories=categories,
-        Thread=Thread,
-        Post=Post,
-        User=User,
     )
 
 
@@ -133,6 +160,7 @@ def login():
 
 
 @main.get("/promote")
+@use_primary
 def promote():
     """Endpoint that promotes a user to admin if he has an admin key"""
     if current_user.is_authenticated:
@@ -169,7 +197,6 @@ def settings():
 
     if form.validate_on_submit():
         user = User.query.filter_by(id=current_user.id).first()
-        profile_picture_filename = ""
 
         if form.bio.data != current_user.bio:
             user.bio = form.bio.data.strip() if form.bio.data.strip() != "" else None
@@ -177,20 +204,13 @@ def settings():
 
         if form.profile_picture_file.data:
             if user.picture_filename:
-                delete_upload(user.picture_filename)
-
-            profile_picture_filename = generate_uploads_filename(
-                form.profile_picture_file.data
-            )
+                enqueue_job("delete_upload", filename=user.picture_filename)
 
-            user.picture_filename = profile_picture_filename
+            user.picture_filename = save_to_uploads(form.profile_picture_file.data)
             db.session.add(user)
 
         db.session.commit()
 
-        if len(profile_picture_filename) > 0:
-            save_to_uploads(form.profile_picture_file.data, profile_picture_filename)
-
         return redirect(request.args.get("referer", url_for("main.index")))
 
     return render_template(
@@ -200,6 +220,7 @@ def settings():
 
 
 @main.get("/token")
+@use_primary
 def manage_token():
     """View for managing the user token"""
 
@@ -228,7 +249,7 @@ def inbox():
             original_post = Post.query.filter_by(id=post.replying_to).first()
 
             message = {
-                "category": Category.query.filter_by(id=post.cat_id).first(),
+                "category": category_registry.get(post.cat_id),
                 "thread": Thread.query.filter_by(id=post.thread_id).first(),
                 "original_post": original_post,
                 "original_author": User.query.filter_by(
@@ -247,7 +268,18 @@ def inbox():
     return render_template("401.html"), 401
 
 
+@main.get("/search")
+def search():
+    """View for searching threads and posts"""
+
+    query = request.args.get("q", "").strip()
+    page = request.args.get("page", 1, type=int)
+
+    return render_template("search.html", search=search_page(query, page))
+
+
 @main.get("/~<username>/toggle-mod")
+@use_primary
 def toggle_mod(username: str):
     """View for toggling moderation permissions of a user"""
     user = User.query.filter_by(username=username).first()
@@ -297,6 +329,7 @@ def create_category():
         )
         db.session.add(new_category)
         db.session.commit()
+        category_registry.invalidate()
 
         return redirect(url_for("main.index"))
 
@@ -313,7 +346,7 @@ def create_category():
 def create_thread(cat_title: str):
     """Create thread page"""
 
-    category = Category.query.filter_by(title=cat_title).first()
+    category = category_registry.get_by_title(cat_title)
 
     form = CreateThreadForm()
 
@@ -321,7 +354,7 @@ def create_thread(cat_title: str):
         form.content.data = form.content.data.strip()
 
         if form.file.data:
-            attachment_filename = generate_uploads_filename(form.file.data)
+            attachment_filename = save_to_uploads(form.file.data)
 
             new_thread = Thread(
                 cat_id=category.id,
@@ -331,7 +364,6 @@ def create_thread(cat_title: str):
                 attachment_filename=attachment_filename,
             )
         else:
-            attachment_filename = None
             new_thread = Thread(
                 cat_id=category.id,
                 title=form.title.data,
@@ -340,13 +372,8 @@ def create_thread(cat_title: str):
             )
 
         db.session.add(new_thread)
-        category.last_active_user = current_user.id
-        category.last_activity_date = db.func.current_timestamp()
         db.session.commit()
 
-        if attachment_filename:
-            save_to_uploads(form.file.data, attachment_filename)
-
         return redirect(
             url_for(
                 "main.view_thread", cat_title=category.title, thread_id=new_thread.id
@@ -363,7 +390,7 @@ def create_thread(cat_title: str):
 def create_post(cat_title: str, thread_id: int):
     """View for posting a comment inside a thread"""
 
-    category = Category.query.filter_by(title=cat_title).first()
+    category = category_registry.get_by_title(cat_title)
     thread = Thread.query.filter_by(id=thread_id).first()
     reply_to = request.args.get("reply_to")
 
@@ -371,7 +398,7 @@ def create_post(cat_title: str, thread_id: int):
 
     if form.validate_on_submit():
         if form.file.data:
-            attachment_filename = generate_uploads_filename(form.file.data)
+            attachment_filename = save_to_uploads(form.file.data)
 
             new_post = Post(
                 cat_id=category.id,
@@ -382,8 +409,6 @@ def create_post(cat_title: str, thread_id: int):
                 attachment_filename=attachment_filename,
             )
         else:
-            attachment_filename = None
-
             new_post = Post(
                 cat_id=category.id,
                 thread_id=thread.id,
@@ -392,19 +417,13 @@ def create_post(cat_title: str, thread_id: int):
                 replying_to=reply_to,
             )
 
-        db.session.add(new_post)
-
-        category.last_active_user = current_user.id
-        category.last_activity_date = db.func.current_timestamp()
+        add_post(new_post)
 
         thread.last_active_user = current_user.id
         thread.last_activity_date = db.func.current_timestamp()
 
         db.session.commit()
 
-        if attachment_filename:
-            save_to_uploads(form.file.data, attachment_filename)
-
         return redirect(
             url_for("main.view_thread", cat_title=category.title, thread_id=thread_id)
             + "#"
@@ -413,7 +432,7 @@ def create_post(cat_title: str, thread_id: int):
 
     if current_user.is_authenticated:
         if reply_to is not None:
-            replied_to = Post.query.filter_by(id=reply_to).first()
+            replied_to = get_loader().post(reply_to)
 
             if not replied_to or (
                 category.id != replied_to.cat_id or thread_id != replied_to.thread_id
@@ -428,8 +447,6 @@ def create_post(cat_title: str, thread_id: int):
             form=form,
             category=category,
             thread=thread,
-            User=User,
-            Post=Post,
             reply_to=reply_to,
         )
 
@@ -457,13 +474,16 @@ def view_user(username: str):
                 key=lambda activity: activity["data"].creation_date,
                 reverse=True,
             )
+            get_loader().threads(
+                activity["data"].thread_id
+                for activity in activities
+                if activity["type"] == "post"
+            )
 
             return render_template(
                 "view-user.html",
                 user=user,
                 activities=activities,
-                Category=Category,
-                Thread=Thread,
             )
 
     return render_template("404.html"), 404
@@ -473,30 +493,37 @@ def view_user(username: str):
 def view_category(cat_title: str):
     """View for viewing a category"""
 
-    category = Category.query.filter_by(title=cat_title).first()
+    category = category_registry.get_by_title(cat_title)
 
     if category:
-        threads = Thread.query.filter_by(cat_id=category.id, deleted=False).all()
+        threads = (
+            Thread.query.filter_by(cat_id=category.id, deleted=False)
+            .options(db.defer(Thread.content))
+            .all()
+        )
+        threads_by_id = {thread.id: thread for thread in threads}
+        posts = (
+            Post.query.filter_by(cat_id=category.id, deleted=False)
+            .options(db.defer(Post.content), db.defer(Post.path))
+            .all()
+        )
+        loader = get_loader()
+        loader.users(
+            [thread.creator for thread in threads] + [post.author for post in posts]
+        )
 
         for thread in threads:
             thread.posts = []
 
-            for post in Post.query.filter_by(thread_id=thread.id):
-                if not post.deleted:
-                    if not User.query.filter_by(id=post.author).first().deleted:
-                        thread.posts.append(post)
-
-            thread.posts = sorted(
-                thread.posts,
-                key=lambda post: post.creation_date,
-            )
+        for post in sorted(posts, key=lambda post: post.creation_date):
+            if post.thread_id in threads_by_id:
+                if not loader.user(post.author).deleted:
+                    threads_by_id[post.thread_id].posts.append(post)
 
         return render_template(
             "view-category.html",
             category=category,
             threads=threads,
-            User=User,
-            Post=Post,
         )
 
     return render_template("404.html"), 404
@@ -506,172 +533,186 @@ def view_category(cat_title: str):
 def view_thread(cat_title: str, thread_id: int):
     """View for viewing a thread"""
 
-    def build_tree(posts: List[Post], parent_id: Optional[int] = None) -> str:
-        """Build post tree in view_thread()"""
+    def render_post(post: Post) -> str:
+        """Render a post of view_thread(), leaving its div open for replies"""
         html = ""
 
-        for post in posts:
-            author = User.query.filter_by(id=post.author).first()
-            category = Category.query.filter_by(id=post.cat_id).first()
+        author = loader.user(post.author)
+        category = category_registry.get(post.cat_id)
 
-            author_post_count = len(Post.query.filter_by(author=author.id).all())
-            author_profile_url = url_for("main.view_user", username=author.username)
+        author_post_count = loader.post_count(author.id)
+        author_profile_url = url_for("main.view_user", username=author.username)
 
-            if author.role == "user":
-                author_rendered_role = (
-                    f"""<span style="color: lightgreen;">{author.role}</span>"""
-                )
-            elif author.role == "moderator":
-                author_rendered_role = (
-                    f"""<span style="color: yellow;">{author.role}</span>"""
-                )
-            else:
-                author_rendered_role = (
-                    f"""<span style="color: red;">{author.role}</span>"""
-                )
-
-            picture_url = (
-                url_for("main.uploads", filename=author.picture_filename)
-                if author.picture_filename
-                else url_for("static", filename="default.png")
+        if author.role == "user":
+            author_rendered_role = (
+                f"""<span style="color: lightgreen;">{author.role}</span>"""
             )
-            post_url = (
-                url_for(
-                    "main.view_thread",
-                    cat_title=category.title,
-                    thread_id=post.thread_id,
-                )
-                + "#"
-                + str(post.id)
+        elif author.role == "moderator":
+            author_rendered_role = (
+                f"""<span style="color: yellow;">{author.role}</span>"""
             )
-            reply_url = (
-                url_for(
-                    "main.create_post",
-                    cat_title=category.title,
-                    thread_id=post.thread_id,
-                )
-                + "?reply_to="
-                + str(post.id)
+        else:
+            author_rendered_role = f"""<span style="color: red;">{author.role}</span>"""
+
+        picture_url = (
+            thumbnail_url(author.picture_filename)
+            if author.picture_filename
+            else url_for("static", filename="default.png")
+        )
+        post_url = (
+            url_for(
+                "main.view_thread",
+                cat_title=category.title,
+                thread_id=post.thread_id,
+            )
+            + "#"
+            + str(post.id)
+        )
+        reply_url = (
+            url_for(
+                "main.create_post",
+                cat_title=category.title,
+                thread_id=post.thread_id,
             )
+            + "?reply_to="
+            + str(post.id)
+        )
 
-            if post.replying_to == parent_id:
-                html += f"""<div id="{post.id}" class="comment">
+        html += f"""<div id="{post.id}" class="comment">
             <div class="top-comment">
             <div class="tooltip-wrap">"""
 
-                if author.deleted:
-                    html += """<p style="color: #808080; font-style: italic;">[deleted]</p></div>"""
-                else:
-                    html += f"""<a
-                    style="color: #808080"
-                    href="{author_profile_url}"
-                    >{author.username}</a
-                    >
-                    <div class="tooltip-content">
-                    <p>
-                        <a href="{author_profile_url}"
-                        >{author.username}</a
-                        >
-                        | {author_rendered_role} | {author_post_count} posts
-                    </p>"""
-
-                    if author.bio:
-                        html += f"""<p style="color: #808080; font-size: 13px">Bio:</p>
-                    <p class="bio">{author.bio}</p>"""
-
-                    html += f"""
-                            <img
-                                src="{picture_url}"
-                                style="max-width: 160px; margin-top: 3px"
-                            />
-                            </div>
-                        </div>"""
+        if author.deleted:
+            html += (
+                """<p style="color: #808080; font-style: italic;">[deleted]</p></div>"""
+            )
+        else:
+            html += f"""<a
+            style="color: #808080"
+            href="{author_profile_url}"
+            >{author.username}</a
+            >
+            <div class="tooltip-content">
+            <p>
+                <a href="{author_profile_url}"
+                >{author.username}</a
+                >
+                | {author_rendered_role} | {author_post_count} posts
+            </p>"""
+
+            if author.bio:
+                html += f"""<p style="color: #808080; font-size: 13px">Bio:</p>
+            <p class="bio">{author.bio}</p>"""
+
+            html += f"""
+                    <img
+                        src="{picture_url}"
+                        loading="lazy"
+                        style="max-width: 160px; margin-top: 3px"
+                    />
+                    </div>
+                </div>"""
+
+        html += f"""<p class="comment-tr">
+                <a
+                style="color: #808080"
+                href="{post_url}"
+                >
+                {post.creation_date}
+                </a>
+            </p>"""
 
+        if current_user.is_authenticated:
+            html += f"""
+            <p class="comment-tr">
+                <a
+                href="{reply_url}"
+                >[reply]</a
+                >
+            </p>
+            """
+
+            if post.attachment_filename and not post.deleted:
                 html += f"""<p class="comment-tr">
-                        <a
-                        style="color: #808080"
-                        href="{post_url}"
-                        >
-                        {post.creation_date}
-                        </a>
-                    </p>"""
-
-                if current_user.is_authenticated:
-                    html += f"""
-                    <p class="comment-tr">
-                        <a
-                        href="{reply_url}"
-                        >[reply]</a
-                        >
-                    </p>
-                    """
-
-                    if post.attachment_filename and not post.deleted:
-                        html += f"""<p class="comment-tr">
-                        <a href="{
-                            url_for("main.uploads", filename=post.attachment_filename)
-                            + "?download=true"
-                        }">[save]</a></p>"""
-
-                    if not post.deleted and (
-                        current_user.role == "admin"
-                        or (current_user.role == "moderator" and author.role == "user")
-                        or current_user.id == post.author
-                    ):
-                        html += f"""<p class="comment-tr">
-                                    <a href="{
-                            url_for(
-                                "main.delete_post",
-                                cat_title=category.title,
-                                thread_id=post.thread_id,
-                                post_id=post.id,
-                            )
-                        }">[delete]</a></p>"""
+                <a href="{
+                    url_for("main.uploads", filename=post.attachment_filename)
+                    + "?download=true"
+                }">[save]</a></p>"""
+
+            if not post.deleted and (
+                current_user.role == "admin"
+                or (current_user.role == "moderator" and author.role == "user")
+                or current_user.id == post.author
+            ):
+                html += f"""<p class="comment-tr">
+                            <a href="{
+                    url_for(
+                        "main.delete_post",
+                        cat_title=category.title,
+                        thread_id=post.thread_id,
+                        post_id=post.id,
+                    )
+                }">[delete]</a></p>"""
+
+        elif post.attachment_filename and not post.deleted:
+            html += f"""<p class="comment-tr">
+            <a href="{
+                url_for("main.uploads", filename=post.attachment_filename)
+                + "?download=true"
+            }">[save]</a>
+            </p>"""
+
+        html += "</div>"
+
+        if post.deleted:
+            html += """<div class="comment-content" style="font-style: italic;"
+                >[deleted]
+            </div>"""
+
+        if post.content:
+            html += (
+                f"""<div class="comment-content">{render_content(post.content)}</div>"""
+            )
 
-                elif post.attachment_filename and not post.deleted:
-                    html += f"""<p class="comment-tr">
-                    <a href="{
-                        url_for("main.uploads", filename=post.attachment_filename)
-                        + "?download=true"
-                    }">[save]</a>
-                    </p>"""
+        if post.attachment_filename and not post.deleted:
+            html += generate_file_embed(post.attachment_filename)
 
-                html += "</div>"
+        return html
 
-                if post.deleted:
-                    html += """<div class="comment-content" style="font-style: italic;"
-                        >[deleted]
-                    </div>"""
+    def build_tree(posts: Iterable[Post]) -> str:
+        """Nest the posts of view_thread(), given in path order"""
+        html = ""
+        open_posts = []  # [depth, has replies] of the posts left open
 
-                if post.content:
-                    html += f"""<div class="comment-content">{
-                        render_content(post.content)
-                    }</div>"""
+        for post in posts:
+            while open_posts and open_posts[-1][0] >= post.depth:
+                html += "</div></div>" if open_posts.pop()[1] else "</div>"
 
-                if post.attachment_filename and not post.deleted:
-                    html += generate_file_embed(post.attachment_filename)
+            if open_posts and not open_posts[-1][1]:
+                html += """<div class="comment-children">"""
+                open_posts[-1][1] = True
 
-                child_html = build_tree(posts, post.id)
-                if child_html.strip():
-                    html += """<div class="comment-children">"""
-                    html += child_html
-                    html += "</div>"
+            html += render_post(post)
+            open_posts.append([post.depth, False])
 
-                html += "</div>"
+        while open_posts:
+            html += "</div></div>" if open_posts.pop()[1] else "</div>"
 
         return html
 
-    category = Category.query.filter_by(title=cat_title).first()
+    category = category_registry.get_by_title(cat_title)
     thread = Thread.query.filter_by(id=thread_id).first()
-    posts = Post.query.filter_by(thread_id=thread_id).all()
+    posts = thread_posts(thread_id).all()
+    loader = get_loader()
+    loader.users([post.author for post in posts] + ([thread.creator] if thread else []))
+    loader.post_counts(post.author for post in posts)
     rendered_posts = build_tree(posts)
     form = CreatePostForm()
 
     if category:
         if thread:
             if thread.cat_id == category.id:
-                thread.views += 1
-                db.session.commit()
+                count_view(thread.id)
 
                 return render_template(
                     "view-thread.html",
@@ -679,34 +720,24 @@ def view_thread(cat_title: str, thread_id: int):
                     category=category,
                     thread=thread,
                     rendered_posts=rendered_posts,
-                    User=User,
-                    Post=Post,
                 )
 
     return render_template("404.html"), 404
 
 
 @main.get("/~<username>/delete")
+@use_primary
 def delete_user(username: str):
     """View for deleting a user"""
 
     user = User.query.filter_by(username=username).first()
-    threads = Thread.query.filter_by(creator=user.id).all()
-    posts = Post.query.filter_by(author=user.id).all()
 
     if not user.deleted:
         if current_user.is_authenticated:
             if current_user.role == "admin" or current_user.id == user.id:
                 if request.args.get("confirm") == "yes":
-                    for post in posts:
-                        if not post.deleted:
-                            post.delete()
-                            db.session.add(post)
-
-                    for thread in threads:
-                        if not thread.deleted:
-                            thread.delete()
-                            db.session.add(thread)
+                    delete_posts(Post.author == user.id)
+                    delete_threads(Thread.creator == user.id)
 
                     user.delete()
                     db.session.add(user)
@@ -721,8 +752,8 @@ def delete_user(username: str):
                 return render_template(
                     "delete-user.html",
                     user=user,
-                    threads=threads,
-                    posts=posts,
+                    thread_count=Thread.query.filter_by(creator=user.id).count(),
+                    post_count=Post.query.filter_by(author=user.id).count(),
                 )
 
             return render_template("403.html"), 403
@@ -731,39 +762,33 @@ def delete_user(username: str):
 
 
 @main.get("/<cat_title>/delete")
+@use_primary
 def delete_category(cat_title: str):
     """View for deleting a category"""
 
-    category = Category.query.filter_by(title=cat_title).first()
-    threads = Thread.query.filter_by(cat_id=category.id).all()
-    posts = Post.query.filter_by(cat_id=category.id).all()
+    category = category_registry.get_by_title(cat_title)
 
     if not category.deleted:
         if current_user.is_authenticated:
             if current_user.role == "admin":
                 if request.args.get("confirm") == "yes":
-                    for post in posts:
-                        if not post.deleted:
-                            post.delete()
-                            db.session.add(post)
+                    delete_posts(Post.cat_id == category.id)
+                    delete_threads(Thread.cat_id == category.id)
 
-                    for thread in threads:
-                        if not thread.deleted:
-                            thread.delete()
-                            db.session.add(thread)
-
-                    category.delete()
-                    db.session.add(category)
+                    db_category = Category.query.get(category.id)
+                    db_category.delete()
+                    db.session.add(db_category)
 
                     db.session.commit()
+                    category_registry.invalidate()
 
                     return redirect(url_for("main.index"))
 
                 return render_template(
                     "delete-category.html",
                     category=category,
-                    threads=threads,
-                    posts=posts,
+                    thread_count=Thread.query.filter_by(cat_id=category.id).count(),
+                    post_count=Post.query.filter_by(cat_id=category.id).count(),
                 )
 
             return render_template("403.html"), 403
@@ -772,11 +797,14 @@ def delete_category(cat_title: str):
 
 
 @main.get("/<cat_title>/<int:thread_id>/delete")
+@use_primary
 def delete_thread(cat_title: str, thread_id: int):
     """View for deleting a thread"""
 
-    category = Category.query.filter_by(title=cat_title).first()
-    thread = Thread.query.filter_by(id=thread_id).first()
+    category = category_registry.get_by_title(cat_title)
+    thread = (
+        Thread.query.filter_by(id=thread_id).options(db.defer(Thread.content)).first()
+    )
     creator = User.query.filter_by(id=thread.creator).first()
 
     if thread.cat_id == category.id:
@@ -788,9 +816,7 @@ def delete_thread(cat_title: str, thread_id: int):
                     or current_user.id == creator.id
                 ):
                     if request.args.get("confirm") == "yes":
-                        for post in Post.query.filter_by(thread_id=thread.id).all():
-                            post.delete()
-                            db.session.add(post)
+                        delete_posts(Post.thread_id == thread.id)
 
                         thread.delete()
                         db.session.add(thread)
@@ -808,7 +834,7 @@ def delete_thread(cat_title: str, thread_id: int):
                         "delete-thread.html",
                         category=category,
                         thread=thread,
-                        posts=Post.query.filter_by(thread_id=thread.id).all(),
+                        post_count=Post.query.filter_by(thread_id=thread.id).count(),
                     )
 
                 return render_template("403.html"), 403
@@ -817,11 +843,14 @@ def delete_thread(cat_title: str, thread_id: int):
 
 
 @main.get("/<cat_title>/<int:thread_id>/<int:post_id>/delete")
+@use_primary
 def delete_post(cat_title: str, thread_id: int, post_id: int):
     """View for deleting a post"""
 
-    category = Category.query.filter_by(title=cat_title).first()
-    thread = Thread.query.filter_by(id=thread_id).first()
+    category = category_registry.get_by_title(cat_title)
+    thread = (
+        Thread.query.filter_by(id=thread_id).options(db.defer(Thread.content)).first()
+    )
     post = Post.query.filter_by(id=post_id).first()
     author = User.query.filter_by(id=post.author).first()
 
@@ -865,19 +894,30 @@ def delete_post(cat_title: str, thread_id: int, post_id: int):
 def uploads(filename: str):
     """Serve uploaded files"""
 
-    if not path.exists(path.join(current_app.config["UPLOADS_DIRECTORY"], filename)):
+    upload = find_upload(filename)
+
+    if upload is None:
         return redirect(url_for("static", filename="filenotfound.jpg"))
 
-    if request.args.get("download") == "true":
-        return send_from_directory(
+    relative_path = path.relpath(upload, current_app.config["UPLOADS_DIRECTORY"])
+    as_attachment = request.args.get("download") == "true"
+
+    if current_app.config["UPLOADS_OFFLOAD"] == "x-accel-redirect":
+        response = offload_upload(relative_path, as_attachment=as_attachment)
+    else:
+        # Also covers X-Sendfile through Flask's USE_X_SENDFILE, otherwise
+        # Range and conditional requests are answered by send_file
+        response = send_from_directory(
             path.join(path.pardir, current_app.config["UPLOADS_DIRECTORY"]),
-            filename,
-            as_attachment=True,
+            relative_path,
+            as_attachment=as_attachment,
         )
 
-    return send_from_directory(
-        path.join(path.pardir, current_app.config["UPLOADS_DIRECTORY"]), filename
-    )
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config["UPLOADS_MAX_AGE"]
+    response.cache_control.immutable = True
+
+    return response
 
 
 @main.get("/about")
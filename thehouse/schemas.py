@@ -6,7 +6,7 @@ Datbase model schemas
 from flask import url_for
 from marshmallow import post_dump
 
-from .extensions import ma
+from .extensions import db, ma
 from .models import Category, Post, Thread, User
 
 
@@ -19,7 +19,7 @@ class UserSchema(ma.SQLAlchemyAutoSchema):
     @post_dump
     def exclude_fields(self, data, **kwargs):  # pylint: disable=unused-argument
         """Exclude confidential user information"""
-        fields_to_exclude = ["id", "token", "password"]
+        fields_to_exclude = ["id", "token", "password", "primary_until", "deleted_date"]
 
         for field in fields_to_exclude:
             data.pop(field, None)
@@ -47,28 +47,33 @@ class UserSchema(ma.SQLAlchemyAutoSchema):
 
         activities = []
 
-        for thread in Thread.query.filter_by(creator=data["id"], deleted=False).all():
+        for thread_id, creation_date in db.session.execute(
+            db.select(Thread.id, Thread.creation_date).where(
+                Thread.creator == data["id"], Thread.deleted.is_(False)
+            )
+        ):
             activities.append(
-                {"type": "thread_creation", "data": ThreadSchema().dump(thread)}
+                {"type": "thread_creation", "id": thread_id, "date": creation_date}
             )
 
-        for post in Post.query.filter_by(author=data["id"], deleted=False).all():
-            activities.append({"type": "new_post", "data": PostSchema().dump(post)})
+        for post_id, creation_date in db.session.execute(
+            db.select(Post.id, Post.creation_date).where(
+                Post.author == data["id"], Post.deleted.is_(False)
+            )
+        ):
+            activities.append(
+                {"type": "new_post", "id": post_id, "date": creation_date}
+            )
 
         activities = sorted(
             activities,
-            key=lambda activity: activity["data"]["creation_date"],
+            key=lambda activity: activity["date"],
             reverse=True,
         )
 
-        data["recent_activities"] = []
-
-        for activity in activities:
-            data["recent_activities"].append(
-                {"type": activity["type"], "id": activity["data"]["id"]}
-                if activity["type"] == "thread_creation"
-                else {"type": activity["type"], "id": activity["data"]["id"]}
-            )
+        data["recent_activities"] = [
+            {"type": activity["type"], "id": activity["id"]} for activity in activities
+        ]
 
         return data
 
@@ -78,15 +83,21 @@ class CategorySchema(ma.SQLAlchemyAutoSchema):
 
     class Meta:  # pylint: disable=missing-class-docstring disable=too-few-public-methods
         model = Category
+        exclude = ("deleted_date",)  # only used to archive deleted rows
 
     @post_dump
     def add_threads(self, data, **kwargs):  # pylint: disable=unused-argument
         """Add threads field"""
 
-        data["threads"] = []
-
-        for thread in Thread.query.filter_by(cat_id=data["id"], deleted=False).all():
-            data["threads"].append(thread.id)
+        data["threads"] = (
+            db.session.execute(
+                db.select(Thread.id).where(
+                    Thread.cat_id == data["id"], Thread.deleted.is_(False)
+                )
+            )
+            .scalars()
+            .all()
+        )
 
         return data
 
@@ -96,34 +107,42 @@ class CategorySchema(ma.SQLAlchemyAutoSchema):
 
         activities = []
 
-        for thread in Thread.query.filter_by(cat_id=data["id"], deleted=False):
-            if not User.query.filter_by(id=thread.creator).first().deleted:
-                activities.append(
-                    {"type": "thread_creation", "data": ThreadSchema().dump(thread)}
-                )
-        for post in Post.query.filter_by(cat_id=data["id"], deleted=False):
-            if not User.query.filter_by(id=post.author).first().deleted:
-                activities.append({"type": "new_post", "data": PostSchema().dump(post)})
+        for thread_id, creation_date in db.session.execute(
+            db.select(Thread.id, Thread.creation_date)
+            .join(User, User.id == Thread.creator)
+            .where(
+                Thread.cat_id == data["id"],
+                Thread.deleted.is_(False),
+                User.deleted.is_(False),
+            )
+            .order_by(Thread.id)
+        ):
+            activities.append(
+                {"type": "thread_creation", "id": thread_id, "date": creation_date}
+            )
+        for post_id, creation_date in db.session.execute(
+            db.select(Post.id, Post.creation_date)
+            .join(User, User.id == Post.author)
+            .where(
+                Post.cat_id == data["id"],
+                Post.deleted.is_(False),
+                User.deleted.is_(False),
+            )
+            .order_by(Post.id)
+        ):
+            activities.append(
+                {"type": "new_post", "id": post_id, "date": creation_date}
+            )
 
         activities = sorted(
             activities,
-            key=lambda activity: activity["data"]["creation_date"],
+            key=lambda activity: activity["date"],
         )
 
         last_activity = activities[-1] if len(activities) != 0 else None
 
         data["last_activity"] = (
-            (
-                {
-                    "type": last_activity["type"],
-                    "id": last_activity["data"]["id"],
-                }
-                if last_activity["type"] == "thread_creation"
-                else {
-                    "type": last_activity["type"],
-                    "id": last_activity["data"]["id"],
-                }
-            )
+            {"type": last_activity["type"], "id": last_activity["id"]}
             if last_activity
             else None
         )
@@ -136,6 +155,7 @@ class ThreadSchema(ma.SQLAlchemyAutoSchema):
 
     class Meta:  # pylint: disable=missing-class-docstring disable=too-few-public-methods
         model = Thread
+        exclude = ("deleted_date",)  # only used to archive deleted rows
 
     @post_dump
     def replace_creator(self, data, **kwargs):  # pylint: disable=unused-argument
@@ -166,10 +186,11 @@ class ThreadSchema(ma.SQLAlchemyAutoSchema):
     def add_posts(self, data, **kwargs):  # pylint: disable=unused-argument
         """Add posts under this thread"""
 
-        data["posts"] = []
-
-        for post in Post.query.filter_by(thread_id=data["id"]).all():
-            data["posts"].append(post.id)
+        data["posts"] = (
+            db.session.execute(db.select(Post.id).where(Post.thread_id == data["id"]))
+            .scalars()
+            .all()
+        )
 
         return data
 
@@ -179,6 +200,8 @@ class PostSchema(ma.SQLAlchemyAutoSchema):
 
     class Meta:  # pylint: disable=missing-class-docstring disable=too-few-public-methods
         model = Post
+        # Reply tree bookkeeping and archival, replying_to tells the tree
+        exclude = ("deleted_date", "path", "depth")
 
     @post_dump
     def replace_author(self, data, **kwargs):  # pylint: disable=unused-argument
@@ -0,0 +1,393 @@
+"""
+The House reloaded
+Full-text search over threads and posts
+"""
+
+import re
+from typing import List, Tuple
+
+from flask import current_app
+from markupsafe import Markup, escape
+from sqlalchemy import event, inspect
+
+from .compression import CompressedText
+from .extensions import category_registry, db
+
+# Highlight delimiters, swapped for <mark> once the text has been escaped
+HIGHLIGHT_START = "\x02"
+HIGHLIGHT_END = "\x03"
+INDEXED_TABLES = ["thread", "post"]
+INDEXED_ATTRIBUTES = ["title", "content", "deleted", "cat_id", "thread_id"]
+SEARCH_TERM = re.compile(r"\w+", re.UNICODE)
+
+
+def search_key(table: str, row_id: int) -> int:
+    """Index key of a thread or post, both share one index"""
+    return row_id * 2 + (table == "thread")
+
+
+def create_search_index(connection):
+    """Create the search index table of the database dialect if it is missing"""
+    if connection.dialect.name == "postgresql":
+        connection.execute(
+            db.text(
+                """CREATE TABLE IF NOT EXISTS search_index (
+                    id BIGINT PRIMARY KEY,
+                    cat_id INTEGER NOT NULL,
+                    thread_id INTEGER NOT NULL,
+                    title TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    document TSVECTOR GENERATED ALWAYS AS (
+                        setweight(to_tsvector('simple', title), 'A')
+                        || setweight(to_tsvector('simple', content), 'B')
+                    ) STORED
+                )"""
+            )
+        )
+        connection.execute(
+            db.text(
+                "CREATE INDEX IF NOT EXISTS search_index_document "
+                "ON search_index USING GIN (document)"
+            )
+        )
+    else:
+        connection.execute(
+            db.text(
+                """CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+                    title,
+                    content,
+                    cat_id UNINDEXED,
+                    thread_id UNINDEXED,
+                    tokenize = 'unicode61 remove_diacritics 2'
+                )"""
+            )
+        )
+
+
+def remove_from_index(connection, table: str, row_ids: List[int]):
+    """Drop threads or posts from the search index"""
+    if not row_ids:
+        return
+
+    key = "id" if connection.dialect.name == "postgresql" else "rowid"
+    connection.execute(
+        db.text(f"DELETE FROM search_index WHERE {key} = :key"),
+        [{"key": search_key(table, row_id)} for row_id in row_ids],
+    )
+
+
+def add_to_index(connection, table: str, rows: List[dict]):
+    """(Re)index threads or posts, rows have id, cat_id, thread_id, title, content"""
+    if not rows:
+        return
+
+    remove_from_index(connection, table, [row["id"] for row in rows])
+
+    key = "id" if connection.dialect.name == "postgresql" else "rowid"
+    connection.execute(
+        db.text(
+            f"INSERT INTO search_index ({key}, cat_id, thread_id, title, content) "
+            "VALUES (:key, :cat_id, :thread_id, :title, :content)"
+        ),
+        [
+            {
+                "key": search_key(table, row["id"]),
+                "cat_id": row["cat_id"],
+                "thread_id": row["thread_id"],
+                "title": row["title"] or "",
+                "content": row["content"] or "",
+            }
+            for row in rows
+        ],
+    )
+
+
+def _index_row(instance) -> dict:
+    """Search index row of a Thread or Post instance"""
+    is_thread = instance.__tablename__ == "thread"
+
+    return {
+        "id": instance.id,
+        "cat_id": instance.cat_id,
+        "thread_id": instance.id if is_thread else instance.thread_id,
+        "title": instance.title if is_thread else "",
+        "content": instance.content,
+    }
+
+
+def index_flushed_changes(session, _):
+    """Keep the index in sync with the threads and posts of a flush
+
+    Runs in the flush transaction, so the index commits (or rolls back) along
+    with the rows.
+    """
+    added = {table: [] for table in INDEXED_TABLES}
+    removed = {table: [] for table in INDEXED_TABLES}
+
+    for instance in [*session.new, *session.dirty, *session.deleted]:
+        table = getattr(instance, "__tablename__", None)
+
+        if table not in INDEXED_TABLES:
+            continue
+
+        if instance in session.deleted or instance.deleted:
+            removed[table].append(instance.id)
+        elif instance in session.new or any(
+            inspect(instance).attrs[name].history.has_changes()
+            for name in INDEXED_ATTRIBUTES
+            if name in inspect(instance).attrs
+        ):
+            added[table].append(_index_row(instance))
+
+    if not any(added.values()) and not any(removed.values()):
+        return
+
+    connection = session.connection()
+
+    for table in INDEXED_TABLES:
+        remove_from_index(connection, table, removed[table])
+        add_to_index(connection, table, added[table])
+
+
+def highlight(text: str) -> Markup:
+    """Escape a highlighted snippet and turn its delimiters into <mark>"""
+    return Markup(
+        str(escape(text))
+        .replace(HIGHLIGHT_START, "<mark>")
+        .replace(HIGHLIGHT_END, "</mark>")
+    )
+
+
+def search(query: str, page: int, per_page: int) -> Tuple[List[dict], int]:
+    """Ranked results of a page of a search, along with the result count
+
+    Results have kind, id, cat_id, thread_id, thread_title and snippet, the
+    snippet and the title of threads being highlighted HTML. Only categories
+    of the registry that aren't deleted are searched.
+    """
+    terms = SEARCH_TERM.findall(query)
+
+    if not terms:
+        return [], 0
+
+    parameters = {
+        "limit": per_page,
+        "offset": (page - 1) * per_page,
+        # Filtered before paginating, so that the count matches the pages
+        "cat_ids": [category.id for category in category_registry.all()],
+    }
+
+    if db.engine.dialect.name == "postgresql":
+        parameters["query"] = " ".join(terms)
+        parameters["options"] = (
+            f"StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_END}, "
+            "MaxWords=35, MinWords=15"
+        )
+        tables = "search_index CROSS JOIN websearch_to_tsquery('simple', :query) query"
+        condition = "search_index.document @@ query"
+        columns = (
+            "search_index.id, ts_headline('simple', search_index.title, query, "
+            ":options || ', HighlightAll=true'), "
+            "ts_headline('simple', search_index.content, query, :options)"
+        )
+        order = "ts_rank(search_index.document, query) DESC, search_index.id DESC"
+    else:
+        # Every term quoted so that FTS5 operators can't be injected, the last
+        # one matches as a prefix
+        parameters["query"] = " ".join(f'"{term}"' for term in terms) + "*"
+        parameters["start"] = HIGHLIGHT_START
+        parameters["end"] = HIGHLIGHT_END
+        tables = "search_index"
+        condition = "search_index MATCH :query"
+        columns = (
+            "search_index.rowid, highlight(search_index, 0, :start, :end), "
+            "snippet(search_index, 1, :start, :end, '…', 24)"
+        )
+        # Title matches weigh more than content ones
+        order = "bm25(search_index, 5.0, 1.0), search_index.rowid DESC"
+
+    condition += " AND search_index.cat_id IN :cat_ids"
+    cat_ids = db.bindparam("cat_ids", expanding=True)
+
+    # Textual selects rather than bare text so that reads may use the replica
+    total = db.session.execute(
+        db.text(f"SELECT count(*) AS total FROM {tables} WHERE {condition}")
+        .bindparams(cat_ids)
+        .columns(db.column("total")),
+        parameters,
+    ).scalar()
+    rows = db.session.execute(
+        db.text(
+            f"SELECT {columns}, search_index.cat_id, search_index.thread_id, "
+            "thread.title "
+            f"FROM {tables} JOIN thread ON thread.id = search_index.thread_id "
+            f"WHERE {condition} "
+            f"ORDER BY {order} LIMIT :limit OFFSET :offset"
+        )
+        .bindparams(cat_ids)
+        .columns(
+            *[
+                db.column(name)
+                for name in (
+                    "key",
+                    "title",
+                    "snippet",
+                    "cat_id",
+                    "thread_id",
+                    "thread_title",
+                )
+            ]
+        ),
+        parameters,
+    ).all()
+
+    return [
+        {
+            "kind": "thread" if key % 2 else "post",
+            "id": key // 2,
+            "cat_id": int(cat_id),
+            "thread_id": int(thread_id),
+            "thread_title": highlight(title) if key % 2 else escape(thread_title),
+            "snippet": highlight(snippet),
+        }
+        for key, title, snippet, cat_id, thread_id, thread_title in rows
+    ], total
+
+
+def search_page(query: str, page: int) -> dict:
+    """A page of search results with their category titles, for the views"""
+    per_page = current_app.config["SEARCH_PAGE_SIZE"]
+    page = max(page, 1)
+    results, total = search(query, page, per_page)
+
+    for result in results:
+        result["cat_title"] = category_registry.get(result["cat_id"]).title
+
+    return {
+        "query": query,
+        "page": page,
+        "pages": (total + per_page - 1) // per_page,
+        "total": total,
+        "results": results,
+    }
+
+
+def _index_chunks(table: str, last_id: int, chunk_size: int):
+    """Index the live rows of a table past last_id, yield the size of each chunk"""
+    thread_id = "id" if table == "thread" else "thread_id"
+    title = "title" if table == "thread" else "''"
+
+    while True:
+        # Fetched again every time, the caller may commit between chunks
+        connection = db.session.connection()
+        rows = (
+            connection.execute(
+                db.text(
+                    f"SELECT id, cat_id, {thread_id} AS thread_id, "
+                    f"{title} AS title, content FROM {table} "
+                    "WHERE deleted = :deleted AND id > :last_id "
+                    "ORDER BY id LIMIT :limit"
+                ).columns(content=CompressedText),
+                {"deleted": False, "last_id": last_id, "limit": chunk_size},
+            )
+            .mappings()
+            .all()
+        )
+
+        if not rows:
+            return
+
+        add_to_index(connection, table, rows)
+        last_id = rows[-1]["id"]
+
+        yield len(rows)
+
+
+def rebuild_search_index(chunk_size: int, progress=None) -> int:
+    """Index every live thread and post from scratch, return the indexed rows
+
+    One transaction, searches see the old index until it commits.
+    progress(table, rows) is called after every chunk.
+    """
+    db.session.connection().execute(db.text("DELETE FROM search_index"))
+    indexed = 0
+
+    for table in INDEXED_TABLES:
+        table_indexed = 0
+
+        for rows in _index_chunks(table, 0, chunk_size):
+            table_indexed += rows
+
+            if progress is not None:
+                progress(table, table_indexed)
+
+        indexed += table_indexed
+
+    db.session.commit()
+
+    return indexed
+
+
+def last_row_ids() -> dict:
+    """Highest thread and post ids, for index_new_rows() to skip them"""
+    return {
+        table: db.session.execute(db.text(f"SELECT max(id) FROM {table}")).scalar() or 0
+        for table in INDEXED_TABLES
+    }
+
+
+def index_new_rows(chunk_size: int, last_ids=None, progress=None) -> int:
+    """Index the threads and posts inserted without the ORM, return the rows
+
+    Rows inserted by flask seed or imports skip the hooks keeping the index
+    in sync. Only those with ids above last_ids (see last_row_ids()) are
+    indexed, every row without it. Each chunk commits on its own and rows
+    already indexed are replaced. progress(table, rows) is called after every
+    chunk.
+    """
+    indexed = 0
+
+    for table in INDEXED_TABLES:
+        table_indexed = 0
+
+        for rows in _index_chunks(table, (last_ids or {}).get(table, 0), chunk_size):
+            db.session.commit()
+            table_indexed += rows
+
+            if progress is not None:
+                progress(table, table_indexed)
+
+        indexed += table_indexed
+
+    return indexed
+
+
+def search_index_size() -> int:
+    """Bytes of the titles and contents copied into the search index
+
+    The index keeps them uncompressed for highlight() and snippet(), whatever
+    THR_CONTENT_COMPRESSION.
+    """
+    return (
+        db.session.execute(
+            db.text(
+                "SELECT sum(length(CAST(title AS BLOB)) + "
+                "length(CAST(content AS BLOB))) AS size FROM search_index"
+            ).columns(db.column("size"))
+        ).scalar()
+        or 0
+    )
+
+
+def _create_search_index(_, connection, **__):
+    """Create the search index along with the tables"""
+    create_search_index(connection)
+
+
+def init_search(app):  # pylint: disable=unused-argument
+    """Index the threads and posts flushed by db.session"""
+    if not event.contains(db.session, "after_flush", index_flushed_changes):
+        event.listen(db.session, "after_flush", index_flushed_changes)
+
+    if not event.contains(db.metadata, "after_create", _create_search_index):
+        event.listen(db.metadata, "after_create", _create_search_index)
@@ -0,0 +1,223 @@
+"""
+The House reloaded
+Synthetic board generation
+"""
+
+import random
+import time
+from datetime import datetime, timedelta
+from uuid import NAMESPACE_URL, uuid5
+
+from .extensions import db
+from .models import (
+    Category,
+    Post,
+    Thread,
+    User,
+    path_segment,
+    reset_id_sequences,
+)
+
+SEED_BATCH_SIZE = 50000
+BASE_DATE = datetime(2020, 1, 1)
+WORDS = (
+    "house board thread post reply forum user admin category title content "
+    "old school social web python flask lorem ipsum dolor sit amet"
+).split()
+
+
+def seeded_uuid(seed: int, kind: str, index: int) -> str:
+    """UUID of the index-th seeded row of a kind, stable for a given seed"""
+    return str(uuid5(NAMESPACE_URL, f"thehouse:{seed}:{kind}:{index}"))
+
+
+def _text(rng: random.Random, words: int) -> str:
+    """Random sentence"""
+    return " ".join(rng.choices(WORDS, k=words))
+
+
+def _next_id(model) -> int:
+    """First free id of a table with an integer primary key"""
+    return (db.session.execute(db.select(db.func.max(model.id))).scalar() or 0) + 1
+
+
+class _BatchWriter:
+    """Insert rows with executemany, committing every batch_size rows"""
+
+    def __init__(self, batch_size: int, progress):
+        self.batch_size = batch_size
+        self.progress = progress
+        self.pending = {}
+        self.inserted = {}
+        self.started = {}
+
+    def add(self, model, row: dict):
+        """Queue a row, flushing the queue of the table once it's full"""
+        self.started.setdefault(model.__tablename__, time.perf_counter())
+        rows = self.pending.setdefault(model, [])
+        rows.append(row)
+
+        if len(rows) >= self.batch_size:
+            self.flush(model)
+
+    def flush(self, model):
+        """Insert and commit the queued rows of a table"""
+        rows = self.pending.pop(model, [])
+
+        if not rows:
+            return
+
+        db.session.execute(db.insert(model.__table__), rows)
+        db.session.commit()
+
+        table = model.__tablename__
+        self.inserted[table] = self.inserted.get(table, 0) + len(rows)
+
+        if self.progress is not None:
+            self.progress(
+                table, self.inserted[table], time.perf_counter() - self.started[table]
+            )
+
+
+def seed_board(  # pylint: disable=too-many-arguments,too-many-locals
+    users: int,
+    categories: int,
+    threads: int,
+    posts: int,
+    *,
+    reply_depth: int = 3,
+    deleted_ratio: float = 0.02,
+    seed: int = 1,
+    batch_size: int = SEED_BATCH_SIZE,
+    progress=None,
+) -> dict:
+    """Add a synthetic board to the database, return the rows inserted per table
+
+    Rows go through Core executemany without ORM objects, and the same seed
+    always yields the same board. Usernames, category titles and user ids
+    derive from the seed, so seeding twice needs two seeds. Deleted rows are
+    blanked like the delete() methods do. progress(table, rows, seconds) is
+    called after every batch.
+    """
+    rng = random.Random(seed)
+    writer = _BatchWriter(batch_size, progress)
+
+    for index in range(users):
+        deleted = index != 0 and rng.random() < deleted_ratio
+        joined_date = BASE_DATE + timedelta(seconds=index)
+        writer.add(
+            User,
+            {
+                "id": seeded_uuid(seed, "user", index),
+                "token": seeded_uuid(seed, "token", index),
+                "username": f"u{seed}_{index}",
+                # Not a valid hash, seeded users cannot log in with a password
+                "password": "!",
+                "joined_date": joined_date,
+                "role": "admin" if index == 0 else "user",
+                "bio": None if deleted else _text(rng, 5)[:60],
+                "deleted": deleted,
+                "deleted_date": joined_date if deleted else None,
+            },
+        )
+
+    writer.flush(User)
+
+    first_category = _next_id(Category)
+
+    for index in range(categories):
+        writer.add(
+            Category,
+            {
+                "id": first_category + index,
+                "title": f"c{seed}_{index}",
+                "description": _text(rng, 8)[:150],
+                "deleted": False,
+                "deleted_date": None,
+            },
+        )
+
+    writer.flush(Category)
+
+    first_thread = _next_id(Thread)
+    next_post = _next_id(Post)
+    remaining_posts = posts
+
+    for index in range(threads):
+        thread_id = first_thread + index
+        cat_id = first_category + rng.randrange(categories)
+        creation_date = BASE_DATE + timedelta(minutes=index)
+        deleted = rng.random() < deleted_ratio
+
+        writer.add(
+            Thread,
+            {
+                "id": thread_id,
+                "cat_id": cat_id,
+                "title": "" if deleted else _text(rng, 6),
+                "creator": seeded_uuid(seed, "user", rng.randrange(users)),
+                "content": "" if deleted else _text(rng, 40),
+                "creation_date": creation_date,
+                "views": rng.randint(0, 1000),
+                "deleted": deleted,
+                "deleted_date": creation_date if deleted else None,
+            },
+        )
+
+        # Exponentially distributed sizes, a few threads get most replies
+        if index == threads - 1:
+            post_count = remaining_posts
+        else:
+            post_count = min(
+                round(remaining_posts / (threads - index) * rng.expovariate(1)),
+                remaining_posts,
+            )
+
+        remaining_posts -= post_count
+        depths = []  # depth in the reply tree of each post of the thread
+        paths = []
+
+        for position in range(post_count):
+            replying_to = None
+            depth = 0
+            path = path_segment(next_post + position)
+
+            if depths and rng.random() < 0.6:
+                parent = rng.randrange(len(depths))
+
+                if depths[parent] < reply_depth:
+                    replying_to = next_post + parent
+                    depth = depths[parent] + 1
+                    path = paths[parent] + path
+
+            depths.append(depth)
+            paths.append(path)
+            deleted = rng.random() < deleted_ratio
+
+            writer.add(
+                Post,
+                {
+                    "id": next_post + position,
+                    "cat_id": cat_id,
+                    "thread_id": thread_id,
+                    "author": seeded_uuid(seed, "user", rng.randrange(users)),
+                    "content": "" if deleted else _text(rng, rng.randint(5, 60)),
+                    "creation_date": creation_date + timedelta(seconds=position),
+                    "replying_to": replying_to,
+                    "path": path,
+                    "depth": depth,
+                    "deleted": deleted,
+                    "deleted_date": (
+                        creation_date + timedelta(seconds=position) if deleted else None
+                    ),
+                },
+            )
+
+        next_post += post_count
+
+    writer.flush(Thread)
+    writer.flush(Post)
+
+    reset_id_sequences()
+
+    return writer.inserted
@@ -0,0 +1,202 @@
+"""
+The House reloaded
+Garbage collection of unreferenced uploads
+"""
+
+import os
+import time
+from typing import Iterable, List
+
+from flask import current_app
+
+from .extensions import db
+from .models import Post, Thread, User
+
+UPLOAD_GC_BATCH_SIZE = 500
+THUMBNAIL_SUFFIX = ".thumb.webp"
+UPLOAD_COLUMNS = [
+    User.picture_filename,
+    Thread.attachment_filename,
+    Post.attachment_filename,
+]
+
+
+def _referenced(filenames: List[str]) -> set:
+    """The filenames that a user, thread or post points to"""
+    referenced = set()
+
+    for start in range(0, len(filenames), UPLOAD_GC_BATCH_SIZE):
+        chunk = filenames[start : start + UPLOAD_GC_BATCH_SIZE]
+
+        for column in UPLOAD_COLUMNS:
+            referenced.update(
+                db.session.execute(db.select(column).where(column.in_(chunk)))
+                .scalars()
+                .all()
+            )
+
+    return referenced
+
+
+def _referenced_with_prefix(prefix: str) -> set:
+    """Every referenced filename starting with prefix, through index range scans"""
+    upper_bound = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    referenced = set()
+
+    for column in UPLOAD_COLUMNS:
+        referenced.update(
+            filename
+            for filename in db.session.execute(
+                db.select(column).where(column >= prefix, column < upper_bound)
+            ).scalars()
+            if filename.startswith(prefix)
+        )
+
+    return referenced
+
+
+def _stem(filename: str) -> str:
+    """Filename without its extension"""
+    return filename.rsplit(".", 1)[0]
+
+
+class UploadCollector:  # pylint: disable=too-few-public-methods
+    """Delete the uploads, thumbnails and temporary files nothing needs
+
+    Files younger than min_age seconds are left alone: an upload is written
+    before the row pointing to it is committed, and uploading a file again
+    refreshes its modification time.
+    """
+
+    def __init__(self, min_age: float, dry_run: bool, progress=None):
+        self.min_age = min_age
+        self.dry_run = dry_run
+        self.progress = progress
+        self.stats = {
+            "scanned": 0,
+            "uploads": 0,
+            "thumbnails": 0,
+            "temporary": 0,
+            "bytes": 0,
+        }
+
+    def _is_old(self, entry: os.DirEntry) -> bool:
+        try:
+            return time.time() - entry.stat().st_mtime >= self.min_age
+        except FileNotFoundError:
+            return False
+
+    def _remove(self, entry: os.DirEntry, kind: str):
+        size = entry.stat().st_size
+
+        if self.progress is not None:
+            self.progress(entry.path, self.dry_run)
+
+        if not self.dry_run:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                return
+
+        self.stats[kind] += 1
+        self.stats["bytes"] += size
+
+    def _collect_files(self, entries: Iterable[os.DirEntry], referenced: set):
+        """Remove the files of a batch given the referenced filenames among them"""
+        for entry in entries:
+            if entry.name in referenced or not self._is_old(entry):
+                continue
+
+            self._remove(entry, "uploads")
+
+    def collect_shard(self, path: str, prefix: str):
+        """Collect a directory of the sharded layout, uploads/ab/cd/"""
+        with os.scandir(path) as scanned:
+            entries = [entry for entry in scanned if entry.is_file()]
+
+        self.stats["scanned"] += len(entries)
+        referenced = _referenced_with_prefix(prefix)
+        referenced_stems = {_stem(filename) for filename in referenced}
+        uploads = []
+
+        for entry in entries:
+            if entry.name.endswith(".tmp"):
+                if self._is_old(entry):
+                    self._remove(entry, "temporary")
+            elif entry.name.endswith(THUMBNAIL_SUFFIX):
+                # Thumbnails are regenerated when missing, no need to double
+                # check them
+                stem = entry.name[: -len(THUMBNAIL_SUFFIX)]
+
+                if stem not in referenced_stems and self._is_old(entry):
+                    self._remove(entry, "thumbnails")
+            elif entry.name not in referenced and not entry.name.startswith("."):
+                uploads.append(entry)
+
+        # Checked again by exact match, should the range scan have missed any
+        self._collect_files(uploads, _referenced([entry.name for entry in uploads]))
+
+    def collect_flat(self, path: str):
+        """Collect the uploads directory itself: temporary and unsharded files
+
+        Thumbnails of unsharded uploads are kept, shard-uploads moves them.
+        """
+        batch = []
+
+        with os.scandir(path) as scanned:
+            for entry in scanned:
+                if not entry.is_file():
+                    continue
+
+                self.stats["scanned"] += 1
+
+                if entry.name.endswith(".tmp"):
+                    if self._is_old(entry):
+                        self._remove(entry, "temporary")
+                elif not entry.name.startswith(".") and not entry.name.endswith(
+                    THUMBNAIL_SUFFIX
+                ):
+                    batch.append(entry)
+
+                    if len(batch) >= UPLOAD_GC_BATCH_SIZE:
+                        self._collect_files(
+                            batch, _referenced([entry.name for entry in batch])
+                        )
+                        batch = []
+
+        self._collect_files(batch, _referenced([entry.name for entry in batch]))
+
+    def collect(self) -> dict:
+        """Walk the whole uploads directory, return what was (or would be) removed"""
+        uploads_directory = current_app.config["UPLOADS_DIRECTORY"]
+
+        if not os.path.isdir(uploads_directory):
+            return self.stats
+
+        self.collect_flat(uploads_directory)
+
+        with os.scandir(uploads_directory) as level_one:
+            first_levels = sorted(
+                entry.name
+                for entry in level_one
+                if entry.is_dir() and len(entry.name) == 2
+            )
+
+        for first_level in first_levels:
+            with os.scandir(os.path.join(uploads_directory, first_level)) as level_two:
+                second_levels = sorted(
+                    entry.name
+                    for entry in level_two
+                    if entry.is_dir() and len(entry.name) == 2
+                )
+
+            for second_level in second_levels:
+                self.collect_shard(
+                    os.path.join(uploads_directory, first_level, second_level),
+                    first_level + second_level,
+                )
+
+            # Release the session between shards, the walk can take a while
+            db.session.commit()
+
+        return self.stats
@@ -3,12 +3,38 @@ The House reloaded
 Utility functions
 """
 
+import hashlib
+import mimetypes
 import os
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import lru_cache
+from threading import Lock
+from typing import Optional, Tuple
+from urllib.parse import quote
 from uuid import uuid4
 
 import bleach
-from flask import current_app, url_for
+from flask import abort, current_app, url_for
+from werkzeug.security import safe_join
+from werkzeug.utils import secure_filename
+
+from .models import RetryJob, upload_is_referenced, utcnow
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Thumbnails are optional
+    Image = None
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+THUMBNAIL_EXTENSIONS = ["jpg", "jpeg", "webp", "png"]
+MAX_PENDING_THUMBNAILS = 64
+
+_thumbnail_executor = None  # pylint: disable=invalid-name
+_thumbnail_lock = Lock()
+_pending_thumbnails = set()
 
 
 def eprint(*args, **kwargs):
@@ -16,18 +42,210 @@ def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
-def generate_uploads_filename(file_data) -> str:
-    """Generate filename based on attachment extension"""
-    return str(uuid4())[:8] + "." + file_data.filename.rsplit(".")[-1]
+def upload_path(filename: str) -> str:
+    """Path of an upload in the sharded layout (uploads/ab/cd/abcd....png)"""
+    return os.path.join(
+        current_app.config["UPLOADS_DIRECTORY"], filename[:2], filename[2:4], filename
+    )
+
+
+def find_upload(filename: str) -> Optional[str]:
+    """Locate an upload, either sharded or still in the flat directory"""
+    flat_path = safe_join(current_app.config["UPLOADS_DIRECTORY"], filename)
+
+    if flat_path is None:
+        return None
+
+    sharded_path = upload_path(filename)
+
+    if os.path.isfile(sharded_path):
+        return sharded_path
+
+    if os.path.isfile(flat_path):
+        return flat_path
+
+    # shard-uploads may have moved it in between
+    if os.path.isfile(sharded_path):
+        return sharded_path
+
+    return None
+
+
+def save_to_uploads(file_data) -> str:
+    """Save attachment into uploads directory and return its filename
+
+    The file is streamed to disk while being hashed and stored under its
+    content hash, so identical uploads share a single file.
+    """
+    uploads_directory = current_app.config["UPLOADS_DIRECTORY"]
+    extension = secure_filename(file_data.filename).rsplit(".")[-1]
+    temporary_path = os.path.join(uploads_directory, f".{uuid4().hex}.tmp")
+    digest = hashlib.sha256()
+
+    try:
+        with open(temporary_path, "wb") as temporary_file:
+            for chunk in iter(lambda: file_data.stream.read(UPLOAD_CHUNK_SIZE), b""):
+                digest.update(chunk)
+                temporary_file.write(chunk)
+
+        attachment_filename = digest.hexdigest() + "." + extension
+
+        existing_path = find_upload(attachment_filename)
+
+        if existing_path:
+            try:
+                # Fresh again, so that collect-uploads and delete_upload leave
+                # it alone until the row pointing to it is committed
+                os.utime(existing_path)
+                os.remove(temporary_path)
+            except FileNotFoundError:
+                # Deleted in between, stored again below
+                existing_path = None
+
+        if not existing_path:
+            attachment_path = upload_path(attachment_filename)
+            os.makedirs(os.path.dirname(attachment_path), exist_ok=True)
+            os.replace(temporary_path, attachment_path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
 
+    schedule_thumbnail(attachment_filename)
 
-def save_to_uploads(file_data, attachment_filename: str):
-    """Save attachment into uploads directory"""
-    file_data.save(
-        os.path.join(current_app.config["UPLOADS_DIRECTORY"], attachment_filename)
+    return attachment_filename
+
+
+def thumbnail_filename(filename: str) -> str:
+    """Name of the thumbnail stored next to an uploaded image"""
+    return filename.rsplit(".", 1)[0] + ".thumb.webp"
+
+
+def _generate_thumbnail(source: str, destination: str, size: int):
+    """Write the thumbnail of an image (runs in the thumbnail pool)"""
+    temporary_path = destination + ".tmp"
+
+    try:
+        with Image.open(source) as image:
+            thumbnail = ImageOps.exif_transpose(image)
+            thumbnail.thumbnail((size, size))
+
+            if thumbnail.mode not in ("RGB", "RGBA"):
+                thumbnail = thumbnail.convert("RGBA")
+
+            thumbnail.save(temporary_path, "WEBP", quality=80)
+
+        os.replace(temporary_path, destination)
+    except (OSError, ValueError, Image.DecompressionBombError) as error:
+        eprint(error)
+    finally:
+        with _thumbnail_lock:
+            _pending_thumbnails.discard(destination)
+
+
+def schedule_thumbnail(filename: str):
+    """Generate the thumbnail of an uploaded image in the background"""
+    global _thumbnail_executor  # pylint: disable=global-statement
+
+    if Image is None or filename.rsplit(".")[-1].lower() not in THUMBNAIL_EXTENSIONS:
+        return
+
+    source = find_upload(filename)
+
+    if source is None:
+        return
+
+    destination = upload_path(thumbnail_filename(filename))
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+
+    with _thumbnail_lock:
+        # Skip when busy, the thumbnail will be requested again on next render
+        if (
+            destination in _pending_thumbnails
+            or len(_pending_thumbnails) >= MAX_PENDING_THUMBNAILS
+        ):
+            return
+
+        _pending_thumbnails.add(destination)
+
+        if _thumbnail_executor is None:
+            _thumbnail_executor = ThreadPoolExecutor(
+                max_workers=current_app.config["THUMBNAIL_WORKERS"],
+                thread_name_prefix="thumbnail",
+            )
+
+    _thumbnail_executor.submit(
+        _generate_thumbnail,
+        source,
+        destination,
+        current_app.config["THUMBNAIL_SIZE"],
     )
 
 
+@lru_cache(maxsize=4096)
+def _image_size(image_path: str) -> Tuple[int, int]:
+    """Read image dimensions from its header"""
+    with Image.open(image_path) as image:
+        return image.size
+
+
+def get_thumbnail(filename: str) -> Optional[Tuple[str, int, int]]:
+    """Get the thumbnail filename and dimensions of an uploaded image
+
+    Returns None (and schedules the thumbnail) if it doesn't exist yet.
+    """
+    if Image is None or filename.rsplit(".")[-1].lower() not in THUMBNAIL_EXTENSIONS:
+        return None
+
+    thumbnail = thumbnail_filename(filename)
+    thumbnail_path = find_upload(thumbnail)
+
+    if thumbnail_path is None:
+        schedule_thumbnail(filename)
+        return None
+
+    try:
+        width, height = _image_size(thumbnail_path)
+    except FileNotFoundError:
+        return None
+    except OSError as error:
+        eprint(error)
+        return None
+
+    return thumbnail, width, height
+
+
+def thumbnail_url(filename: str) -> str:
+    """URL of the thumbnail of an uploaded image, or of the image itself"""
+    thumbnail = get_thumbnail(filename)
+
+    return url_for("main.uploads", filename=thumbnail[0] if thumbnail else filename)
+
+
+def offload_upload(relative_path: str, as_attachment: bool = False):
+    """Let the front proxy deliver an uploaded file through X-Accel-Redirect"""
+    if safe_join(current_app.config["UPLOADS_DIRECTORY"], relative_path) is None:
+        abort(404)
+
+    response = current_app.response_class(
+        mimetype=mimetypes.guess_type(relative_path)[0] or "application/octet-stream"
+    )
+    response.headers["X-Accel-Redirect"] = (
+        current_app.config["UPLOADS_ACCEL_PREFIX"].rstrip("/")
+        + "/"
+        + quote(relative_path)
+    )
+
+    if as_attachment:
+        response.headers.set(
+            "Content-Disposition",
+            "attachment",
+            filename=os.path.basename(relative_path),
+        )
+
+    return response
+
+
 def render_content(value: str) -> str:
     """Turn thread/post contents into renderable HTML"""
     cleaned = bleach.clean(value)
@@ -38,11 +256,62 @@ def render_content(value: str) -> str:
 
 
 def delete_upload(filename: str):
-    """Delete an uploaded file"""
+    """Delete an uploaded file once no user, thread or post references it
+
+    Runs as the delete_upload job, once the referencing row stopped pointing
+    to the file. Files uploaded less than UPLOADS_DELETE_GRACE ago are
+    checked again once it has passed.
+    """
+    if upload_is_referenced(filename):
+        return
+
+    path = find_upload(filename) or upload_path(filename)
+
+    # Uploading the same file again only refreshes it, and the request doing
+    # so may not have committed the row pointing to it yet
     try:
-        os.remove(os.path.join(current_app.config["UPLOADS_DIRECTORY"], filename))
+        age = time.time() - os.stat(path).st_mtime
     except FileNotFoundError as error:
         eprint(error)
+        age = None
+
+    grace = current_app.config["UPLOADS_DELETE_GRACE"]
+
+    if age is not None and age < grace:
+        raise RetryJob(utcnow() + timedelta(seconds=grace - age))
+
+    # Moved aside before checking again: uploads of the same file from now on
+    # no longer find it and store it anew, those that refreshed it in between
+    # show in its age
+    aside_path = os.path.join(os.path.dirname(path), f".{uuid4().hex}.tmp")
+
+    try:
+        os.rename(path, aside_path)
+        age = time.time() - os.stat(aside_path).st_mtime
+
+        if age < grace or upload_is_referenced(filename):
+            try:
+                os.link(aside_path, path)
+            except FileExistsError:
+                pass  # stored again meanwhile
+
+            os.remove(aside_path)
+
+            if age < grace:
+                raise RetryJob(utcnow() + timedelta(seconds=grace - age))
+
+            return
+
+        os.remove(aside_path)
+    except FileNotFoundError as error:
+        eprint(error)
+
+    thumbnail = thumbnail_filename(filename)
+
+    try:
+        os.remove(find_upload(thumbnail) or upload_path(thumbnail))
+    except FileNotFoundError:
+        pass
 
 
 def get_inbox(current_user, db_post):
@@ -79,17 +348,34 @@ def generate_file_embed(filename: str, maxheight: int = 300) -> str:
     audio_extensions = ["flac", "mp3", "ogg", "opus", "m4a"]
 
     if extension in image_extensions:
-        result += f"""<img
-        src="{url_for("main.uploads", filename=filename)}"
+        thumbnail = get_thumbnail(filename)
+
+        if thumbnail:
+            thumbnail_name, width, height = thumbnail
+
+            if height > maxheight:
+                width, height = round(width * maxheight / height), maxheight
+
+            image_attributes = (
+                f'src="{url_for("main.uploads", filename=thumbnail_name)}"'
+                f' width="{width}" height="{height}"'
+            )
+        else:
+            image_attributes = f'src="{url_for("main.uploads", filename=filename)}"'
+
+        result += f"""<a href="{url_for("main.uploads", filename=filename)}"><img
+        {image_attributes}
+        loading="lazy"
         style="max-height: {maxheight}px; margin-top: 5px"
-        />"""
+        /></a>"""
     elif extension in video_extensions:
-        result += f"""<video height={maxheight} style='margin-top: 5px' controls>
+        result += f"""<video
+        height={maxheight} style='margin-top: 5px' preload="none" controls>
         <source src="{url_for("main.uploads", filename=filename)}">
         Error: Your browser does not support the audio element.
         </video>"""
     elif extension in audio_extensions:
-        result += f"""<audio controls>
+        result += f"""<audio preload="none" controls>
         <source src="{url_for("main.uploads", filename=filename)}">
         Error: Your browser does not support the audio element.
         </audio>"""